@@ -0,0 +1,80 @@
+import json
+import os
+import urllib.request
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Optional
+
+CHAT_API_URL = os.environ.get('CHAT_API_URL')
+CHAT_API_TIMEOUT = float(os.environ.get('CHAT_API_TIMEOUT', 300))
+
+
+def _request(method: str, path: str, payload: Optional[Dict[str, Any]] = None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(CHAT_API_URL.rstrip('/') + path, data=data, method=method,
+                                     headers={'Content-Type': 'application/json'})
+    return urllib.request.urlopen(request, timeout=CHAT_API_TIMEOUT)
+
+
+def _call(method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    with _request(method, path, payload) as response:
+        return json.loads(response.read())
+
+
+class ChatApiClient:
+    """
+    Thin client for `api_server.py` with the subset of the NeoLangService interface used by `app.py`.
+    Nothing but the conversation id is kept client-side; set `CHAT_API_URL` to use it.
+    """
+
+    def __init__(self, llm_type, temperature):
+        self.llm_type = llm_type
+        self.temperature = temperature
+        self.conversation_id: Optional[str] = None
+
+    def create_conversation(self, llm_type: str, streaming: bool = False, conversation_key: Optional[str] = None):
+        """
+        Starts a conversation on the API under `conversation_key` and returns its id,
+        which stands in for the ConversationChain in `run_turn`.
+        """
+        created = _call('POST', '/conversations', {'conversation_id': conversation_key, 'llm_type': llm_type,
+                                                   'temperature': self.temperature,
+                                                   'session_id': conversation_key})
+        self.conversation_id = created['conversation_id']
+        return self.conversation_id
+
+    def run_turn(self, question: str, conversation: str, new_conversation: bool,
+                 on_token: Optional[Callable[[str, str], None]] = None, use_cache: bool = True,
+                 conversation_key: Optional[str] = None) -> SimpleNamespace:
+        """
+        Runs one turn on the API. Returns the turn's fields (answer, timings, cache_hit, ...) as attributes.
+        """
+        payload = {'question': question, 'new_conversation': new_conversation, 'use_cache': use_cache,
+                   'stream': on_token is not None}
+        path = '/conversations/' + conversation + '/turns'
+        if on_token is None:
+            return SimpleNamespace(**_call('POST', path, payload)['turn'])
+
+        text = ""
+        with _request('POST', path, payload) as response:
+            for line in response:
+                event = json.loads(line)
+                if 'token' in event:
+                    text += event['token']
+                    on_token(event['token'], text)
+                elif 'turn' in event:
+                    return SimpleNamespace(**event['turn'])
+                elif 'error' in event:
+                    raise RuntimeError(event['error'])
+        raise RuntimeError("chat api closed the stream before the turn finished")
+
+    def rate_message(self, rating_dict):
+        if self.conversation_id is not None:
+            _call('POST', '/conversations/' + self.conversation_id + '/rating',
+                  {'score': rating_dict['score'], 'text': rating_dict['text']})
+
+    @staticmethod
+    def forget_conversation(conversation_key: str):
+        try:
+            _call('DELETE', '/conversations/' + conversation_key)
+        except Exception as e:
+            print(e)
@@ -0,0 +1,217 @@
+"""
+Stateless HTTP API over the NeoLangService turn pipeline.
+
+Conversation state lives in the conversation store (`CONVERSATION_STORE`, Neo4j by default), not in
+the process, so replicas can be scaled and load-tested independently of the Streamlit UI.
+
+    POST   /conversations                 {"conversation_id"?, "llm_type", "temperature", "session_id"?}
+    GET    /conversations/<id>
+    DELETE /conversations/<id>
+    POST   /conversations/<id>/turns      {"question", "use_cache"?, "stream"?, "new_conversation"?}
+    POST   /conversations/<id>/rating     {"score", "text"}
+    GET    /health
+
+With "stream": true a turn responds with newline-delimited JSON: one {"token": ...} line per
+answer token, then a final {"turn": {...}} line (or {"error": ...}).
+"""
+import dataclasses
+import json
+import os
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from async_service import SyncNeoLangService
+from conversation_store import get_conversation_store
+from metrics import metrics
+from service import NeoLangService, TurnResult
+
+CHAT_API_PORT = int(os.environ.get('CHAT_API_PORT', 8080))
+SERVICE_CLASS = SyncNeoLangService if os.environ.get('CHAT_SERVICE_MODE', 'sync') == 'async' else NeoLangService
+
+ROUTE = re.compile(r'^/conversations(?:/([^/]+))?(/turns|/rating)?/?$')
+
+
+# one service per (llm type, temperature); requests get a copy of it bound to their conversation's state
+_services: Dict[Tuple[str, float], NeoLangService] = {}
+_services_lock = threading.Lock()
+
+
+# per-conversation state carried between turns: the session and the ends of the message log chain
+RESUMED_STATE = ('session_id', 'latest_message_id', 'latest_llm_message_id')
+
+
+class NotFound(Exception):
+    pass
+
+
+def turn_to_dict(turn: TurnResult) -> Dict[str, Any]:
+    data = dataclasses.asdict(turn)
+    data.pop('embedding', None)
+    data['total_seconds'] = turn.total_seconds
+    data['prompt_seconds'] = turn.prompt_seconds
+    return data
+
+
+def create_conversation(body: Dict[str, Any]) -> Dict[str, Any]:
+    conversation_id = body.get('conversation_id') or 'c-' + str(uuid.uuid4())
+    record = {
+        'llm_type': body.get('llm_type', "GPT-4 8k"),
+        'temperature': float(body.get('temperature', 0.7)),
+        'state': {'session_id': body.get('session_id') or 's-' + str(uuid.uuid4())},
+        'memory': None,
+    }
+    get_conversation_store().save(conversation_id, record)
+    return {'conversation_id': conversation_id, 'llm_type': record['llm_type'],
+            'temperature': record['temperature'], 'session_id': record['state']['session_id']}
+
+
+def get_service(record: Dict[str, Any]) -> NeoLangService:
+    """
+    Returns the shared service for the record's llm type and temperature, bound to the record's state.
+    """
+    key = (record['llm_type'], record['temperature'])
+    with _services_lock:
+        service = _services.get(key)
+        if service is None:
+            service = _services[key] = SERVICE_CLASS(record['llm_type'], record['temperature'], state={})
+    return service.with_state(record['state'])
+
+
+def _load(conversation_id: str) -> Dict[str, Any]:
+    record = get_conversation_store().load(conversation_id)
+    if record is None:
+        raise NotFound(conversation_id)
+    return record
+
+
+def run_turn(conversation_id: str, body: Dict[str, Any],
+             on_token: Optional[Callable[[str, str], None]] = None) -> TurnResult:
+    """
+    Loads the conversation, runs one turn on the shared service bound to its state and saves the updated state.
+    Concurrent turns on the same conversation are not serialized; the last one to finish is kept.
+    """
+    record = _load(conversation_id)
+    service = get_service(record)
+    conversation = service.create_conversation(record['llm_type'], streaming=on_token is not None,
+                                               memory_snapshot=record['memory'])
+    turn = service.run_turn(body['question'], conversation,
+                            new_conversation=body.get('new_conversation', 'latest_message_id' not in record['state']),
+                            on_token=on_token, use_cache=body.get('use_cache', True))
+
+    # only what the next turn needs; the prompt and question embedding are already logged with the messages
+    record['state'] = {key: value for key, value in record['state'].items() if key in RESUMED_STATE}
+    record['memory'] = conversation.memory.to_dict()
+    get_conversation_store().save(conversation_id, record)
+    return turn
+
+
+def rate_message(conversation_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    record = _load(conversation_id)
+    service = get_service(record)
+    service.rate_message({'score': body['score'], 'text': body.get('text', '')})
+    return {'rated': record['state'].get('latest_llm_message_id')}
+
+
+class ChatApiHandler(BaseHTTPRequestHandler):
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _route(self):
+        match = ROUTE.match(self.path.split('?', 1)[0])
+        if match is None:
+            raise NotFound(self.path)
+        return match.group(1), match.group(2)
+
+    def _handle(self, method: str) -> None:
+        try:
+            if self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+                return
+            conversation_id, action = self._route()
+            with metrics.span('api_request', method=method, action=(action or '/conversations').strip('/')):
+                if method == 'POST' and conversation_id is None:
+                    self._send_json(201, create_conversation(self._read_json()))
+                elif method == 'GET' and conversation_id and action is None:
+                    self._send_json(200, _load(conversation_id))
+                elif method == 'DELETE' and conversation_id and action is None:
+                    get_conversation_store().delete(conversation_id)
+                    self._send_json(200, {'deleted': conversation_id})
+                elif method == 'POST' and action == '/turns':
+                    self._handle_turn(conversation_id, self._read_json())
+                elif method == 'POST' and action == '/rating':
+                    self._send_json(200, rate_message(conversation_id, self._read_json()))
+                else:
+                    raise NotFound(self.path)
+        except NotFound as e:
+            self._send_json(404, {'error': 'not found: ' + str(e)})
+        except (ValueError, KeyError) as e:
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            print(e)
+            self._send_json(500, {'error': str(e)})
+
+    def _handle_turn(self, conversation_id: str, body: Dict[str, Any]) -> None:
+        if not body.get('question'):
+            raise ValueError("a turn needs a question")
+        if not body.get('stream'):
+            self._send_json(200, {'turn': turn_to_dict(run_turn(conversation_id, body))})
+            return
+
+        _load(conversation_id)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        def write_line(payload: Dict[str, Any]) -> None:
+            self.wfile.write(json.dumps(payload, default=str).encode() + b'\n')
+            self.wfile.flush()
+
+        try:
+            turn = run_turn(conversation_id, body, on_token=lambda token, text: write_line({'token': token}))
+            write_line({'turn': turn_to_dict(turn)})
+        except Exception as e:
+            # the status line is already sent, so errors are reported in the stream
+            print(e)
+            write_line({'error': str(e)})
+        self.close_connection = True
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int = CHAT_API_PORT) -> None:
+    metrics.start_exporter()
+    if os.environ.get('PREWARM', 'true').lower() == 'true':
+        # build the shared pool, schema and chains before the first request arrives
+        from startup import prewarm_once
+        prewarm_once()
+    server = ThreadingHTTPServer(('0.0.0.0', port), ChatApiHandler)
+    print('chat api listening on port ' + str(port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve()
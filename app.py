@@ -1,9 +1,20 @@
+import os
 import uuid
 import streamlit as st
 from urllib.error import URLError
 from streamlit_feedback import streamlit_feedback
-import time
-from service import NeoLangService
+from chat_view import render_history
+from metrics import metrics
+from streaming import streamlit_placeholder_writer
+
+if os.environ.get('CHAT_API_URL'):
+    # thin client: turns run on the chat API (api_server.py), which keeps the conversation state
+    from api_client import ChatApiClient as SERVICE_CLASS
+elif os.environ.get('CHAT_SERVICE_MODE', 'sync') == 'async':
+    # turns run on the shared event loop, so one process can hold many conversations in flight
+    from async_service import SyncNeoLangService as SERVICE_CLASS
+else:
+    from service import NeoLangService as SERVICE_CLASS
 
 llm_avatar = 'resources/images/neo4j_icon_white.png'
 user_avatar = '👤'
@@ -36,6 +47,22 @@ with open("ui/sidebar.md", "r") as sidebar_file:
 with open("ui/bloglist.md", "r") as sidebar_file:
     blog_list = sidebar_file.read()
 
+# serve /metrics once per process if METRICS_PORT is set
+metrics.start_exporter()
+
+
+@st.cache_resource(show_spinner="Warming up...")
+def prewarm_backend():
+    """
+    Builds the driver pool, schema, chains and tokenizer once per process, before the first question.
+    """
+    from startup import prewarm_once
+    return prewarm_once()
+
+
+if not os.environ.get('CHAT_API_URL') and os.environ.get('PREWARM', 'true').lower() == 'true':
+    prewarm_backend()
+
 try:
     st.markdown("""
     <style>
@@ -62,6 +89,12 @@ try:
     if 'temperature' not in st.session_state:
         st.session_state['temperature'] = 0.7  # default value
 
+    if 'streaming' not in st.session_state:
+        st.session_state['streaming'] = True
+
+    if 'use_cache' not in st.session_state:
+        st.session_state['use_cache'] = True
+
     with st.sidebar.expander("Parameters"):
         # give options for llm
         st.session_state['llm'] = st.radio("Select LLM", ("chat-bison 32k", "GPT-4 8k"), index=1,
@@ -76,6 +109,17 @@ try:
                                             in developing its responses. Chat must be reset to have an effect.
                                             ''')
 
+        # stream answer tokens as they arrive, or paint the full answer at once
+        st.session_state['streaming'] = st.toggle("Stream answers", value=True,
+                                                  help="""
+                                        Show the answer as it is generated. Chat must be reset to have an effect.
+                                        """)
+
+        st.session_state['use_cache'] = st.checkbox("Use answer cache", value=True,
+                                                    help="""
+                                        Answer repeated questions from the cache. Uncheck to always query the graph.
+                                        """)
+
     with st.sidebar.expander("Description"):
         st.markdown(sidebar_content)
 
@@ -91,39 +135,43 @@ try:
         st.session_state["messages"] = RESET_MESSAGE
         st.session_state["history"] = []
         st.session_state['temperature'] = .07
+        SERVICE_CLASS.forget_conversation(st.session_state['session_id'])
 
     # init Communicator object
     if 'neolangservice' not in st.session_state:
-        st.session_state['neolangservice'] = NeoLangService(temperature=st.session_state['temperature'],
-                                                            llm_type=st.session_state['llm'])
+        st.session_state['neolangservice'] = SERVICE_CLASS(temperature=st.session_state['temperature'],
+                                                           llm_type=st.session_state['llm'])
 
     # Initialize the chat messages history
     if "messages" not in st.session_state:
         st.session_state["messages"] = INITIAL_MESSAGE
-        st.chat_message("assistant", avatar=llm_avatar).markdown(INITIAL_MESSAGE['content'])
 
     # Initialize the LLM conversation
     if "llm_conversation" not in st.session_state:
         st.session_state['llm_conversation'] = st.session_state['neolangservice'].create_conversation(
-            st.session_state['llm'])
+            st.session_state['llm'], streaming=st.session_state['streaming'],
+            conversation_key=st.session_state['session_id'])
 
     # handle llm switching
     if 'prev_llm' not in st.session_state:
         st.session_state['prev_llm'] = st.session_state['llm']
 
-    # Display chat messages from history on app rerun
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"], avatar=message['avatar']):
-            st.markdown(message["content"])
+    # Display chat messages from history on app rerun; messages added below are drawn as they arrive
+    render_history(st.session_state.messages)
 
     if st.session_state['prev_llm'] != st.session_state['llm']:
         print("switching llm...")
-        message = f"Excuse me while I switch to my {llm} brain and wipe my memory..."
+        message = f"Excuse me while I switch to my {st.session_state['llm']} brain and wipe my memory..."
         st.chat_message("assistant", avatar=llm_avatar).markdown(message)
         st.session_state.messages.append({"role": "assistant", "avatar": llm_avatar, "content": message})
         # on switch, restart the internal llm conversation history with new llm
+        SERVICE_CLASS.forget_conversation(st.session_state['session_id'])
+        # the service's llm type selects the prompt budget, QA chain and logged llm; clients stay shared
+        st.session_state['neolangservice'] = SERVICE_CLASS(temperature=st.session_state['temperature'],
+                                                           llm_type=st.session_state['llm'])
         st.session_state['llm_conversation'] = st.session_state['neolangservice'].create_conversation(
-            st.session_state['llm'])
+            st.session_state['llm'], streaming=st.session_state['streaming'],
+            conversation_key=st.session_state['session_id'])
         st.session_state['prev_llm'] = st.session_state['llm']
 
     # Prompt for user input and save and display
@@ -131,55 +179,36 @@ try:
         st.session_state.messages.append({"role": "user", "avatar": user_avatar, "content": question})
         st.chat_message("user", avatar=user_avatar).markdown(question)
 
-        # start prompt timer
-        prompt_timer_start = time.perf_counter()
-
-        prompt = st.session_state['neolangservice'].create_prompt(question)
-
-        prompt_timer_response = "\n\nPrompt creation took " + str(
-            round(time.perf_counter() - prompt_timer_start, 4)) + " seconds."
-
-        # create new log chain in neo4j database if fresh conversation
-        # and log first user message
-        # if only initial message and user message OR
+        # a fresh conversation log chain is created in neo4j if
+        # only initial message and user message OR
         # if 2 consecutive assistant followed by new user message in history
-        if len(st.session_state['messages']) <= 2 or st.session_state['messages'][-3]['role'] == 'assistant':
-            message_placeholder = st.empty()
-            message_placeholder.status('thinking...')
-            run_timer_start = time.perf_counter()
-            response = st.session_state['llm_conversation'].run(prompt)
-            st.session_state['messages'].append({
-                "role": "assistant",
-                "avatar": llm_avatar,
-                "content": response
-            })
-
-            run_timer_response = "\n\nThis thought took " + str(
-                round(time.perf_counter() - run_timer_start, 4)) + " seconds."
-            st.session_state['neolangservice'].log_new_conversation(llm=st.session_state['llm'], user_input=question)
-
-        # otherwise log user message to neo4j database
-        else:
-            st.session_state['neolangservice'].log_user(user_input=question)
+        new_conversation = len(st.session_state['messages']) <= 2 or \
+            st.session_state['messages'][-3]['role'] == 'assistant'
 
         with st.chat_message('assistant', avatar=llm_avatar):
             message_placeholder = st.empty()
             message_placeholder.status('thinking...')
-            run_timer_start = time.perf_counter()
-            response = st.session_state['llm_conversation'].run(prompt)
+            on_token = streamlit_placeholder_writer(message_placeholder) if st.session_state['streaming'] else None
+            turn = st.session_state['neolangservice'].run_turn(question,
+                                                               st.session_state['llm_conversation'],
+                                                               new_conversation=new_conversation,
+                                                               on_token=on_token,
+                                                               use_cache=st.session_state['use_cache'],
+                                                               conversation_key=st.session_state['session_id'])
+
+            prompt_timer_response = "\n\nPrompt creation took " + str(
+                round(turn.prompt_seconds, 4)) + " seconds."
             run_timer_response = "\n\nThis thought took " + str(
-                round(time.perf_counter() - run_timer_start, 4)) + " seconds."
+                round(turn.timings.get('answer_synthesis', 0), 4)) + " seconds."
+            if turn.cache_hit == 'answer':
+                run_timer_response += " (answer served from cache)"
+            if turn.time_to_first_token is not None:
+                run_timer_response += " First token after " + str(round(turn.time_to_first_token, 4)) + " seconds."
 
-            message_placeholder.markdown(response + prompt_timer_response + run_timer_response)
-            st.session_state['neolangservice'].log_assistant(assistant_output=response, context_indices=context_idxs)
+            message_placeholder.markdown(turn.answer + prompt_timer_response + run_timer_response)
 
         st.session_state.messages.append({"role": "assistant", 'avatar': llm_avatar,
-                                          "content": response + prompt_timer_response + run_timer_response})
-
-    # Display chat messages from history
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"], avatar=message["avatar"]):
-            st.markdown(message["content"])
+                                          "content": turn.answer + prompt_timer_response + run_timer_response})
 
     # rate buttons appear after each llm response
     if len(st.session_state['messages']) > 2 and st.session_state['messages'][-1]['role'] == 'assistant':
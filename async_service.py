@@ -0,0 +1,285 @@
+import asyncio
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+from langchain.chains import ConversationChain
+from langchain.chains.graph_qa.cypher import extract_cypher
+
+import drivers
+from cypher_guard import CYPHER_VALIDATION, record_blocked
+from entity_index import EntityMatch
+from metrics import metrics
+from query_budget import BudgetedResult, QueryBudget, compact_results, run_budgeted_async
+from service import RETRIEVAL_ENABLED, NeoLangService, TurnResult
+
+# turns allowed in flight per process; further turns wait for a slot, which bounds memory under load
+ASYNC_MAX_TURNS = int(os.environ.get('ASYNC_MAX_TURNS', 64))
+# threads for the blocking calls that remain (embeddings, schema introspection, log queue, tokenization)
+ASYNC_THREAD_WORKERS = int(os.environ.get('ASYNC_THREAD_WORKERS', 32))
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_turn_slots = asyncio.Semaphore(ASYNC_MAX_TURNS)
+_turns_in_flight = 0
+
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the process-wide event loop, started on a daemon thread on first use.
+    Every async service, async driver and turn slot lives on this loop.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_THREAD_WORKERS,
+                                                          thread_name_prefix='async-service'))
+            threading.Thread(target=_loop.run_forever, name='async-service-loop', daemon=True).start()
+    return _loop
+
+
+def run_coroutine(coroutine: Coroutine) -> Future:
+    """
+    Schedules `coroutine` on the process-wide event loop from any thread.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, event_loop())
+
+
+def _close_async_drivers():
+    if _loop is not None:
+        try:
+            run_coroutine(drivers.driver_pool.close_async()).result(timeout=5)
+        except Exception as e:
+            print(e)
+
+
+atexit.register(_close_async_drivers)
+metrics.register_collector('async_turns', lambda: {'in_flight': _turns_in_flight, 'max': ASYNC_MAX_TURNS})
+
+
+class AsyncNeoLangService(NeoLangService):
+    """
+    NeoLangService whose turns run as coroutines, so a single worker can hold many conversations in flight.
+
+    Graph queries use the neo4j async driver and LLM calls use LangChain's async API. Stages that don't
+    depend on each other overlap: the schema is fetched while the question is embedded, documents are
+    retrieved while the Cypher is generated and run, and the history is counted while the graph is queried.
+    The remaining blocking calls run on the event loop's thread pool. Cache handling, metrics, state
+    updates and logging are the steps of NeoLangService, shared with `run_turn`.
+    """
+
+    def __init__(self, llm_type, temperature, state=None, async_driver=None, **kwargs):
+        """
+        `async_driver` replaces the shared async Neo4j driver, e.g. with a fake from `fakes.py`;
+        the other arguments are those of NeoLangService.
+        """
+        super().__init__(llm_type, temperature, state=state, **kwargs)
+        self.async_driver = async_driver
+
+    async def _get_async_driver(self):
+        if self.async_driver is None:
+            self.async_driver = await drivers.init_async_driver(self.db_uri, username=self.db_user,
+                                                                password=self.db_password, database=self.db_name)
+        return self.async_driver
+
+    async def agenerate_cypher(self, question: str, use_cache: bool = True) -> Tuple[str, Dict[str, Any]]:
+        """
+        `generate_cypher` with the Cypher generation LLM call awaited; entity resolution, schema pruning
+        and chain setup run on the thread pool.
+        """
+        if use_cache:
+            template = self._lookup_cypher_template(question)
+            if template is not None:
+                return template
+
+        entities = await asyncio.to_thread(self.resolve_entities, question)
+        cypher = await self.avalidate_cypher(question, await self._agenerate_cypher_with_llm(question, entities),
+                                             entities)
+        return self._store_cypher(question, cypher, entities)
+
+    async def _agenerate_cypher_with_llm(self, question: str, entities: Optional[List[EntityMatch]] = None) -> str:
+        # the schema may be refreshed from the database and the chain built on first use
+        chain, inputs = await asyncio.to_thread(self._cypher_generation_inputs, question, entities)
+        return extract_cypher(await chain.cypher_generation_chain.arun(inputs))
+
+    async def avalidate_cypher(self, question: str, cypher: str, entities: Optional[List[EntityMatch]] = None) -> str:
+        """
+        `validate_cypher` with the repair round awaited; the checks and EXPLAIN run on a worker thread.
+        """
+        if not CYPHER_VALIDATION:
+            return cypher
+        with metrics.span('cypher_validation', llm_type=self.llm_type):
+            check = await asyncio.to_thread(self.check_cypher, cypher)
+        if check.ok:
+            return check.cypher
+
+        record_blocked(check, llm_type=self.llm_type)
+        repaired = await self._agenerate_cypher_with_llm(check.repair_question(question), entities)
+        with metrics.span('cypher_validation', llm_type=self.llm_type):
+            repaired_check = await asyncio.to_thread(self.check_cypher, repaired)
+        return self._accept_repair(repaired_check)
+
+    async def aquery_graph(self, cypher: str, params: Optional[Dict[str, Any]] = None,
+                           budget: Optional[QueryBudget] = None) -> BudgetedResult:
+        """
+        `query_graph` over the async driver; tokenizing the results runs on the thread pool.
+        """
+        budget = budget or QueryBudget()
+        result = await run_budgeted_async(await self._get_async_driver(), self.db_name, cypher, params or {}, budget)
+        await asyncio.to_thread(compact_results, result, budget.max_tokens)
+        return self._record_query(result)
+
+    async def arun_turn(self, question: str, conversation: ConversationChain, new_conversation: bool,
+                        on_token: Optional[Callable[[str, str], None]] = None, use_cache: bool = True,
+                        conversation_key: Optional[str] = None) -> TurnResult:
+        """
+        `run_turn` as a coroutine. At most ASYNC_MAX_TURNS turns run at once per process.
+        Stage timings overlap, so the turn's `wall_seconds` is recorded separately.
+        """
+        global _turns_in_flight
+        async with _turn_slots:
+            _turns_in_flight += 1
+            try:
+                return await self._arun_turn(question, conversation, new_conversation, on_token, use_cache,
+                                             conversation_key)
+            finally:
+                _turns_in_flight -= 1
+
+    async def _arun_turn(self, question, conversation, new_conversation, on_token, use_cache, conversation_key):
+        turn = self._new_turn(question)
+        turn_timer_start = time.perf_counter()
+        first_turn = conversation.memory.is_empty()
+        background: List[asyncio.Task] = []
+
+        def start(awaitable, stage: Optional[str] = None) -> asyncio.Task:
+            async def staged():
+                with turn.stage(stage):
+                    return await awaitable
+
+            task = asyncio.create_task(staged() if stage else awaitable)
+            background.append(task)
+            return task
+
+        try:
+            schema_task = start(asyncio.to_thread(self.get_graph_schema), 'schema_fetch')
+            with turn.stage('embedding'):
+                turn.embedding = await asyncio.to_thread(self.embed_question, question)
+            self.state['recent_question_embedding'] = turn.embedding
+            await schema_task
+
+            cached = await asyncio.to_thread(self._lookup_semantic_cache, turn, question, use_cache, first_turn)
+            if self._is_answer_hit(cached):
+                await asyncio.to_thread(self._serve_cached_answer, turn, question, conversation, on_token, cached)
+            else:
+                retrieval_task = start(asyncio.to_thread(self.retrieve_context, turn.embedding), 'retrieval') \
+                    if RETRIEVAL_ENABLED else None
+
+                with turn.stage('cypher_generation'):
+                    if not self._use_cached_cypher(turn, question, cached, use_cache):
+                        turn.cypher, turn.cypher_params = await self.agenerate_cypher(question, use_cache=False)
+
+                history_task = start(asyncio.to_thread(self._history_tokens, conversation))
+                with turn.stage('graph_query'):
+                    while True:
+                        try:
+                            query_result = await self.aquery_graph(turn.cypher, turn.cypher_params)
+                            break
+                        except ValueError:
+                            if not self._drop_cached_cypher(turn, question):
+                                raise
+                        with turn.stage('cypher_fallback'):
+                            turn.cypher, turn.cypher_params = await self.agenerate_cypher(question, use_cache=False)
+                    self._record_graph_result(turn, query_result)
+
+                if retrieval_task is not None:
+                    await asyncio.wait([retrieval_task])
+                self._finish_retrieval(turn, retrieval_task)
+
+                with turn.stage('prompt_creation'):
+                    turn.prompt, turn.prompt_tokens = await asyncio.to_thread(
+                        self.create_prompt, question, query_result.table, history_tokens=await history_task,
+                        documents=turn.documents)
+
+                with turn.stage('answer_synthesis'):
+                    handler = self._stream_handler(on_token)
+                    outputs = await conversation.acall(self._conversation_inputs(turn, question),
+                                                       callbacks=[handler] if handler else None)
+                    turn.answer = outputs[conversation.output_key]
+                    self._record_first_token(turn, handler)
+
+            return await asyncio.to_thread(self._finish_turn, turn, question, conversation, new_conversation,
+                                           use_cache, first_turn, conversation_key, turn_timer_start)
+        finally:
+            # a failed turn leaves nothing running behind it
+            for task in background:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+
+class SyncNeoLangService:
+    """
+    Blocking facade over AsyncNeoLangService for the Streamlit script.
+
+    Turns run on the process-wide event loop; the calling thread only waits for them, and streamed
+    tokens are handed back to it so `on_token` (e.g. a Streamlit placeholder) runs in the script thread.
+    `st.session_state` only resolves in the script thread, so a turn runs on a plain-dict copy of the
+    session state, and the keys it changed are copied back once it is done.
+    Every other attribute is that of the wrapped service.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        self.service = AsyncNeoLangService(*args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.service, name)
+
+    def with_state(self, state: Dict[str, Any]) -> 'SyncNeoLangService':
+        # built without __init__: the facade holds nothing but the wrapped service
+        facade = SyncNeoLangService.__new__(SyncNeoLangService)
+        facade.service = self.service.with_state(state)
+        return facade
+
+    def run_turn(self, question: str, conversation: ConversationChain, new_conversation: bool,
+                 on_token: Optional[Callable[[str, str], None]] = None, use_cache: bool = True,
+                 conversation_key: Optional[str] = None) -> TurnResult:
+        state = self.service.state
+        snapshot = dict(state)
+        self.service.state = snapshot
+        try:
+            return self._run_turn(question, conversation, new_conversation, on_token, use_cache, conversation_key)
+        finally:
+            self.service.state = state
+            for key, value in snapshot.items():
+                if key not in state or state[key] is not value:
+                    state[key] = value
+
+    def _run_turn(self, question, conversation, new_conversation, on_token, use_cache, conversation_key):
+        tokens: "queue.SimpleQueue[Tuple[str, str]]" = queue.SimpleQueue()
+        future = run_coroutine(self.service.arun_turn(
+            question, conversation, new_conversation,
+            on_token=(lambda token, text: tokens.put((token, text))) if on_token is not None else None,
+            use_cache=use_cache, conversation_key=conversation_key))
+
+        if on_token is not None:
+            while not (future.done() and tokens.empty()):
+                try:
+                    token, text = tokens.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+                # repaint once for all tokens that arrived since the last repaint
+                while not tokens.empty():
+                    next_token, text = tokens.get()
+                    token += next_token
+                on_token(token, text)
+        return future.result()
+
+    @staticmethod
+    def forget_conversation(conversation_key: str):
+        NeoLangService.forget_conversation(conversation_key)
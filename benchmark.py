@@ -0,0 +1,192 @@
+"""
+Offline throughput and latency benchmark for NeoLangService.
+
+Replays a question corpus through `run_turn` from many concurrent sessions against the fakes
+in `fakes.py`, then reports turns/sec, p50/p95/p99 per stage, LLM calls and database writes.
+
+    python benchmark.py --sessions 16 --turns 5 --llm-latency 0.8 --max-p95 5
+
+With `--async` all sessions run as coroutines on one event loop through AsyncNeoLangService.
+Exits with status 1 if the p95 turn latency exceeds `--max-p95`, so it can gate CI.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from chain_cache import llm_cache, qa_chain_cache
+from cypher_cache import cypher_cache
+from cypher_guard import plan_cache
+from async_service import AsyncNeoLangService, run_coroutine
+from fakes import FakeAsyncDriver, FakeChatModel, FakeDriver, FakeEmbeddings, FakeGraph, use_offline_encoding
+from log_writer import get_log_writer
+from neo4jwriter import Neo4jWriter
+from semantic_cache import semantic_cache
+from service import NeoLangService
+
+LLM_TYPE = "GPT-4 8k"
+
+
+def load_corpus(path: str) -> List[str]:
+    """
+    Reads one question per JSONL line, from a `question` field or, failing that, a `body` field.
+    """
+    questions = []
+    with open(path) as corpus:
+        for line in corpus:
+            if line.strip():
+                record = json.loads(line)
+                questions.append(record.get('question') or record['body'])
+    return questions
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+    ordered = sorted(values)
+
+    def at(q: float) -> float:
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 4)
+
+    return {'p50': at(0.5), 'p95': at(0.95), 'p99': at(0.99)}
+
+
+def run_benchmark(questions: List[str], sessions: int, turns: int, llm_latency: float, tokens_per_second: float,
+                  query_latency: float, rows: int, streaming: bool, use_cache: bool,
+                  use_async: bool = False) -> Dict[str, Any]:
+    driver = FakeDriver(rows=rows, query_latency=query_latency)
+    graph = FakeGraph(driver)
+    embeddings = FakeEmbeddings()
+    models = []
+
+    def llm_factory(llm_type: str, stream: bool):
+        model = FakeChatModel(latency=llm_latency, tokens_per_second=tokens_per_second, streaming=stream)
+        models.append(model)
+        return model
+
+    def run_session(session_number: int):
+        service = NeoLangService(LLM_TYPE, 0.7, state={'session_id': 'bench-' + str(session_number)},
+                                 driver=driver, graph=graph, llm_factory=llm_factory, embeddings=embeddings)
+        conversation = service.create_conversation(LLM_TYPE, streaming=streaming)
+        results = []
+        for turn_number in range(turns):
+            question = questions[(session_number + turn_number) % len(questions)]
+            results.append(service.run_turn(question, conversation, new_conversation=turn_number == 0,
+                                            on_token=(lambda token, text: None) if streaming else None,
+                                            use_cache=use_cache))
+        return results
+
+    async def run_session_async(session_number: int):
+        service = AsyncNeoLangService(LLM_TYPE, 0.7, state={'session_id': 'bench-' + str(session_number)},
+                                      async_driver=FakeAsyncDriver(driver), driver=driver, graph=graph,
+                                      llm_factory=llm_factory, embeddings=embeddings)
+        conversation = service.create_conversation(LLM_TYPE, streaming=streaming)
+        results = []
+        for turn_number in range(turns):
+            question = questions[(session_number + turn_number) % len(questions)]
+            results.append(await service.arun_turn(question, conversation, new_conversation=turn_number == 0,
+                                                   on_token=(lambda token, text: None) if streaming else None,
+                                                   use_cache=use_cache))
+        return results
+
+    async def run_sessions_async():
+        return await asyncio.gather(*(run_session_async(i) for i in range(sessions)))
+
+    benchmark_timer_start = time.perf_counter()
+    if use_async:
+        turn_results = [turn for session in run_coroutine(run_sessions_async()).result() for turn in session]
+    else:
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            turn_results = [turn for session in executor.map(run_session, range(sessions)) for turn in session]
+    elapsed = time.perf_counter() - benchmark_timer_start
+
+    get_log_writer(driver, None).flush()
+
+    stages: Dict[str, List[float]] = {}
+    for turn in turn_results:
+        for stage, seconds in turn.timings.items():
+            stages.setdefault(stage, []).append(seconds)
+
+    llm_calls: Dict[str, int] = {}
+    for model in models:
+        for kind, count in model.calls.items():
+            llm_calls[kind] = llm_calls.get(kind, 0) + count
+
+    return {
+        'mode': 'async' if use_async else 'threads',
+        'sessions': sessions,
+        'turns': len(turn_results),
+        'seconds': round(elapsed, 4),
+        'turns_per_second': round(len(turn_results) / elapsed, 4) if elapsed else 0.0,
+        'turn': percentiles([turn.total_seconds for turn in turn_results]),
+        'time_to_first_token': percentiles([turn.time_to_first_token for turn in turn_results
+                                            if turn.time_to_first_token is not None]),
+        'stages': {stage: percentiles(values) for stage, values in stages.items()},
+        'cache_hits': {kind: sum(1 for turn in turn_results if turn.cache_hit == kind)
+                       for kind in ('answer', 'cypher', 'template')},
+        'llm_calls': llm_calls,
+        'db': {'reads': driver.reads, 'explains': driver.explains, 'write_transactions': driver.write_transactions,
+               'rows_written': driver.rows_written},
+        'caches': {'semantic': semantic_cache.stats(), 'cypher': cypher_cache.stats(), 'plans': plan_cache.stats(),
+                   'llm': llm_cache.stats(), 'qa_chain': qa_chain_cache.stats()},
+    }
+
+
+def run_writer_benchmark(rows: int, workers: int, batch_size: int) -> Dict[str, Any]:
+    """
+    Measures Neo4jWriter.bulk_write throughput against the fake driver.
+    """
+    writer = Neo4jWriter(driver=FakeDriver(), database=None)
+    generated = ({'id': i, 'name': 'node ' + str(i)} for i in range(rows))
+    return writer.bulk_write("UNWIND $params AS row MERGE (n:Node {id: row.id}) SET n.name = row.name",
+                             generated, batch_size=batch_size, workers=workers)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default='bench_questions.jsonl')
+    parser.add_argument('--sessions', type=int, default=8, help='concurrent chat sessions')
+    parser.add_argument('--turns', type=int, default=5, help='questions per session')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--query-latency', type=float, default=0.05)
+    parser.add_argument('--rows', type=int, default=25, help='records returned per graph query')
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='run sessions as coroutines on one event loop instead of one thread each')
+    parser.add_argument('--no-cache', action='store_true', help='bypass the semantic and Cypher caches')
+    parser.add_argument('--writer-rows', type=int, default=0, help='also benchmark Neo4jWriter.bulk_write')
+    parser.add_argument('--max-p95', type=float, default=None, help='fail if the p95 turn latency exceeds this')
+    parser.add_argument('--output', default=None, help='write the JSON report to this file')
+    parser.add_argument('--offline-tokenizer', action='store_true',
+                        help='count bytes instead of downloading the cl100k_base encoding')
+    args = parser.parse_args(argv)
+
+    if args.offline_tokenizer:
+        use_offline_encoding()
+
+    report = run_benchmark(load_corpus(args.corpus), sessions=args.sessions, turns=args.turns,
+                           llm_latency=args.llm_latency, tokens_per_second=args.tokens_per_second,
+                           query_latency=args.query_latency, rows=args.rows, streaming=args.streaming,
+                           use_cache=not args.no_cache, use_async=args.use_async)
+    if args.writer_rows:
+        report['writer'] = run_writer_benchmark(args.writer_rows, workers=4, batch_size=1000)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output)
+
+    if args.max_p95 is not None and report['turn']['p95'] > args.max_p95:
+        print('p95 turn latency ' + str(report['turn']['p95']) + 's exceeds ' + str(args.max_p95) + 's',
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+from metrics import metrics
+
+
+class ChainCache:
+    """
+    Bounded, thread-safe LRU cache for LLM clients and chains.
+
+    Objects are built once per key, e.g. (llm_type, temperature), and shared by
+    every session. The least recently used entry is evicted once `max_size` is reached.
+    Build ("cold") and lookup ("warm") times are recorded so the saving can be measured.
+    """
+
+    def __init__(self, name: str, max_size: int = int(os.environ.get('CHAIN_CACHE_SIZE', 16))):
+        self.name = name
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        # one lock per key being built, so concurrent sessions don't race to create the same client
+        self._building: Dict[Hashable, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.cold_seconds_total = 0.0
+        self.warm_seconds_total = 0.0
+
+    def _lookup(self, key: Hashable, lookup_timer_start: float) -> Any:
+        # called with self._lock held; returns None on a miss
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.warm_seconds_total += time.perf_counter() - lookup_timer_start
+        return self._entries[key]
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Returns the cached object for `key`, building it with `factory` on a miss.
+        The factory runs outside the cache lock, so a slow build only holds up callers of the same key.
+        """
+        lookup_timer_start = time.perf_counter()
+        with self._lock:
+            value = self._lookup(key, lookup_timer_start)
+            if value is not None:
+                return value
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        with build_lock:
+            with self._lock:
+                # built by another session while this one waited
+                value = self._lookup(key, lookup_timer_start)
+                if value is not None:
+                    return value
+            try:
+                value = factory()
+            except BaseException:
+                with self._lock:
+                    self._building.pop(key, None)
+                raise
+            with self._lock:
+                self._building.pop(key, None)
+                self._entries[key] = value
+                self.misses += 1
+                if len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+
+        elapsed = time.perf_counter() - lookup_timer_start
+        self.cold_seconds_total += elapsed
+        metrics.observe('chain_cache_build_seconds', elapsed, cache=self.name)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'avg_cold_seconds': self.cold_seconds_total / self.misses if self.misses else 0.0,
+            'avg_warm_seconds': self.warm_seconds_total / self.hits if self.hits else 0.0,
+        }
+
+
+llm_cache = ChainCache('llm_cache')
+qa_chain_cache = ChainCache('qa_chain_cache')
+metrics.register_collector('llm_cache', llm_cache.stats)
+metrics.register_collector('qa_chain_cache', qa_chain_cache.stats)
@@ -0,0 +1,27 @@
+import os
+from typing import Any, Dict, List
+
+import streamlit as st
+
+# messages shown before older ones are collapsed into an expander
+CHAT_VISIBLE_MESSAGES = int(os.environ.get('CHAT_VISIBLE_MESSAGES', 20))
+
+
+def render_message(message: Dict[str, Any]) -> None:
+    with st.chat_message(message["role"], avatar=message["avatar"]):
+        st.markdown(message["content"])
+
+
+def render_history(messages: List[Dict[str, Any]]) -> None:
+    """
+    Renders the chat history once per rerun, with all but the last `CHAT_VISIBLE_MESSAGES` messages
+    in a collapsed expander so a long session doesn't push the latest turn off screen.
+    Messages added later in the same rerun are drawn by the caller as they arrive.
+    """
+    hidden = max(len(messages) - CHAT_VISIBLE_MESSAGES, 0)
+    if hidden:
+        with st.expander(str(hidden) + " earlier messages"):
+            for message in messages[:hidden]:
+                render_message(message)
+    for message in messages[hidden:]:
+        render_message(message)
@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import drivers
+
+SAVE_RECORD_QUERY = """
+merge (c:ChatState {id: $id})
+set c.record = $record, c.updateTime = datetime()
+"""
+
+LOAD_RECORD_QUERY = """
+match (c:ChatState {id: $id})
+return c.record as record
+"""
+
+# MERGE on an unindexed id would scan every (:ChatState) node on each save
+CONSTRAINT_QUERY = """
+create constraint chat_state_id if not exists for (c:ChatState) require c.id is unique
+"""
+
+DELETE_RECORD_QUERY = """
+match (c:ChatState {id: $id})
+detach delete c
+"""
+
+
+class ConversationStore(ABC):
+    """
+    Keeps the state of each API conversation between requests, so any API replica can serve any turn.
+
+    A record holds the conversation's llm type and temperature, the service state (session id and
+    latest message ids for logging) and the `RollingSummaryMemory.to_dict()` snapshot of its memory.
+    """
+
+    @abstractmethod
+    def load(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def save(self, conversation_id: str, record: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, conversation_id: str) -> None:
+        ...
+
+
+class InMemoryConversationStore(ConversationStore):
+    """
+    Process-local store keeping the `max_size` most recently used conversations.
+    Only suitable for a single API process, so it has to be selected explicitly with `CONVERSATION_STORE=memory`.
+    """
+
+    def __init__(self, max_size: int = int(os.environ.get('CONVERSATION_STORE_SIZE', 10000))):
+        self.max_size = max_size
+        self._records: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            record = self._records.get(conversation_id)
+            if record is None:
+                return None
+            self._records.move_to_end(conversation_id)
+        # records are kept serialized so callers never share mutable state
+        return json.loads(record)
+
+    def save(self, conversation_id: str, record: Dict[str, Any]) -> None:
+        serialized = json.dumps(record, default=str)
+        with self._lock:
+            self._records[conversation_id] = serialized
+            self._records.move_to_end(conversation_id)
+            if len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+
+    def delete(self, conversation_id: str) -> None:
+        with self._lock:
+            self._records.pop(conversation_id, None)
+
+
+class Neo4jConversationStore(ConversationStore):
+    """
+    Stores each conversation as JSON on a `(:ChatState {id})` node, shared by every API replica.
+    """
+
+    def __init__(self, driver=None, database: Optional[str] = os.environ.get('NEO4J_DATABASE_NAME')):
+        self.driver = driver or drivers.init_driver(os.environ.get('NEO4J_URI'),
+                                                    username=os.environ.get('NEO4J_USERNAME'),
+                                                    password=os.environ.get('NEO4J_PASSWORD'),
+                                                    database=database)
+        self.database = database
+        try:
+            with self.driver.session(database=self.database) as session:
+                session.run(CONSTRAINT_QUERY).consume()
+        except Exception as e:
+            # e.g. a read-only user; lookups still work, just without the index
+            print('chat state constraint not created: ' + repr(e))
+
+    def load(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        with self.driver.session(database=self.database) as session:
+            record = session.execute_read(
+                lambda tx: tx.run(LOAD_RECORD_QUERY, id=conversation_id).single())
+        if record is None or record['record'] is None:
+            return None
+        return json.loads(record['record'])
+
+    def save(self, conversation_id: str, record: Dict[str, Any]) -> None:
+        serialized = json.dumps(record, default=str)
+        with self.driver.session(database=self.database) as session:
+            session.execute_write(
+                lambda tx: tx.run(SAVE_RECORD_QUERY, id=conversation_id, record=serialized).consume())
+
+    def delete(self, conversation_id: str) -> None:
+        with self.driver.session(database=self.database) as session:
+            session.execute_write(lambda tx: tx.run(DELETE_RECORD_QUERY, id=conversation_id).consume())
+
+
+_store: Optional[ConversationStore] = None
+_store_lock = threading.Lock()
+
+
+def get_conversation_store() -> ConversationStore:
+    """
+    Returns the process-wide store selected by `CONVERSATION_STORE`: 'neo4j' (the default), shared by
+    every replica, or 'memory' for a single API process.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            kind = os.environ.get('CONVERSATION_STORE', 'neo4j')
+            if kind == 'neo4j':
+                _store = Neo4jConversationStore()
+            elif kind == 'memory':
+                _store = InMemoryConversationStore()
+            else:
+                raise ValueError(f"Unsupported conversation store: {kind}")
+    return _store
@@ -0,0 +1,157 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import metrics
+
+# identifiers such as serial numbers, build names and config ids: quoted strings,
+# tokens containing a digit (XYZ123, 456) and upper-case codes (ABC)
+LITERAL_PATTERN = re.compile(r"'([^']*)'|\"([^\"]*)\"|\b([A-Za-z0-9_-]*\d[A-Za-z0-9_-]*|[A-Z]{2,}[A-Z0-9_-]*)\b")
+
+# what precedes a bare number used as a property value: `{prop: N}`, `= N`, a comparison or an `IN [...]` list
+VALUE_POSITION = re.compile(r"(?:[:=]|<>|[<>]=?|\bIN\s*\[[^\[\]]*[\[,])\s*\Z", re.IGNORECASE)
+
+
+def extract_literals(question: str) -> List[str]:
+    """
+    Returns the literal values found in the question, in order of appearance.
+    """
+    return [next(group for group in match.groups() if group is not None)
+            for match in LITERAL_PATTERN.finditer(question)]
+
+
+def normalize_question(question: str) -> Tuple[str, List[str]]:
+    """
+    Replaces each literal in the question with a positional placeholder and lower-cases the rest,
+    e.g. "Configurations for engine serial XYZ123?" -> ("configurations for engine serial <0>", ["XYZ123"]).
+    """
+    literals = []
+
+    def placeholder(match):
+        literals.append(next(group for group in match.groups() if group is not None))
+        return '\x00' + str(len(literals) - 1) + '\x00'
+
+    shape = LITERAL_PATTERN.sub(placeholder, question)
+    shape = re.sub(r'[^\w\x00 ]', ' ', shape.lower())
+    shape = re.sub(r'\s+', ' ', shape).strip()
+    return re.sub(r'\x00(\d+)\x00', r'<\1>', shape), literals
+
+
+def parameterize_cypher(cypher: str, literals: List[str], ignore_case: bool = False) -> Tuple[str, Dict[int, type]]:
+    """
+    Replaces literal values in generated Cypher with $p<i> parameters.
+    Returns the template and, per replaced literal index, the Python type to bind it as.
+    Bare numbers are only replaced where they are property values, and only if they occur once.
+    Literals that are not replaced are left out; they must match exactly on reuse.
+    With `ignore_case`, quoted literals are matched regardless of case.
+    """
+    parameters = {}
+    for i, literal in enumerate(literals):
+        quoted = re.compile(r"'" + re.escape(literal) + r"'|\"" + re.escape(literal) + r"\"",
+                            re.IGNORECASE if ignore_case else 0)
+        if quoted.search(cypher):
+            cypher = quoted.sub('$p' + str(i), cypher)
+            parameters[i] = str
+        elif literal.isdigit():
+            bare = re.compile(r"(?<![\w$'\".])" + re.escape(literal) + r"(?![\w'\"]|\.\.)")
+            matches = list(bare.finditer(cypher))
+            # a number repeated in the Cypher, or used as a LIMIT, SKIP or hop bound, is kept as a fixed literal
+            if len(matches) == 1 and VALUE_POSITION.search(cypher, 0, matches[0].start()):
+                cypher = cypher[:matches[0].start()] + '$p' + str(i) + cypher[matches[0].end():]
+                parameters[i] = int
+    return cypher, parameters
+
+
+class CypherTemplateCache:
+    """
+    Cache of generated Cypher as parameterized templates, keyed by question shape.
+
+    A question whose shape matches a cached template (and whose non-parameter literals
+    are identical) is answered by re-running the template with the new literal values,
+    skipping the Cypher generation LLM call. Pinned templates are never evicted.
+    """
+
+    def __init__(self, max_size: int = int(os.environ.get('CYPHER_CACHE_SIZE', 500))):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._templates: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, question: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        Returns (cypher template, parameters) for the question, or None if no template applies.
+        """
+        shape, literals = normalize_question(question)
+        with self._lock:
+            template = self._templates.get(shape)
+            if template is None or any(literals[i] != value for i, value in template['fixed'].items()):
+                self.misses += 1
+                return None
+            self._templates.move_to_end(shape)
+            template['hits'] += 1
+            self.hits += 1
+
+        try:
+            params = {'p' + str(i): cast(literals[i]) for i, cast in template['parameters'].items()}
+        except ValueError:
+            return None
+        return template['cypher'], params
+
+    def store(self, question: str, cypher: str, pinned: bool = False) -> None:
+        """
+        Stores the Cypher generated for `question` as a template for its question shape.
+        """
+        shape, literals = normalize_question(question)
+        template, parameters = parameterize_cypher(cypher, literals)
+        with self._lock:
+            existing = self._templates.get(shape)
+            if existing is not None and existing['pinned'] and not pinned:
+                return
+            self._templates[shape] = {
+                'cypher': template,
+                'parameters': parameters,
+                'fixed': {i: literal for i, literal in enumerate(literals) if i not in parameters},
+                'pinned': pinned,
+                'hits': 0,
+            }
+            self._evict()
+
+    def pin(self, question: str, cypher: str) -> None:
+        """
+        Stores a known-good template that is never evicted or overwritten by generated Cypher.
+        """
+        self.store(question, cypher, pinned=True)
+
+    def invalidate(self, question: str) -> None:
+        """
+        Drops the template for the question's shape, e.g. after it produced an error.
+        """
+        shape, _ = normalize_question(question)
+        with self._lock:
+            self._templates.pop(shape, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._templates.clear()
+
+    def _evict(self) -> None:
+        unpinned = [shape for shape, template in self._templates.items() if not template['pinned']]
+        while len(self._templates) > self.max_size and unpinned:
+            del self._templates[unpinned.pop(0)]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'templates': len(self._templates),
+            'pinned': sum(1 for template in self._templates.values() if template['pinned']),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+cypher_cache = CypherTemplateCache()
+metrics.register_collector('cypher_cache', cypher_cache.stats)
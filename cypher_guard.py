@@ -0,0 +1,364 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from neo4j.exceptions import ClientError
+
+from metrics import metrics
+
+# set to false to run generated Cypher without the schema and plan checks
+CYPHER_VALIDATION = os.environ.get('CYPHER_VALIDATION', 'true').lower() == 'true'
+CYPHER_PLAN_CACHE_SIZE = int(os.environ.get('CYPHER_PLAN_CACHE_SIZE', 1000))
+# estimated rows a label/all-nodes scan, cartesian product or unlimited result may reach before the plan is blocked
+CYPHER_MAX_SCAN_ROWS = int(os.environ.get('CYPHER_MAX_SCAN_ROWS', 10000))
+# upper bound given to variable-length patterns written without one, e.g. -[*]- becomes -[*..6]-
+CYPHER_MAX_HOPS = int(os.environ.get('CYPHER_MAX_HOPS', 6))
+# LIMIT appended to statements that end without one
+CYPHER_DEFAULT_LIMIT = int(os.environ.get('CYPHER_DEFAULT_LIMIT', os.environ.get('QUERY_MAX_ROWS', 200)))
+
+# string literals and comments in one pass, so `//` inside a string and quotes inside a comment are left alone
+LITERAL_OR_COMMENT = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")|//[^\n]*|/\*.*?\*/", re.DOTALL)
+PLACEHOLDER = re.compile(r"\x00(\d+)\x00")
+NUMBER_LITERAL = re.compile(r"(?<![\w$.])\d+(?:\.\d+)?(?![\w.])")
+# write clauses followed by what the clause takes, so aliases and map keys named e.g. `set` don't match
+WRITE_CLAUSE = re.compile(r"""
+    (?<![\w.$`:])(?<!\bAS\s)
+    (CREATE\s*\(|CREATE\s+(?:OR\s+REPLACE\s+)?(?:INDEX|CONSTRAINT|DATABASE|ALIAS|USER|ROLE)\b
+     |MERGE\s*\(|(?:DETACH\s+)?DELETE\s+\w|SET\s+`?\w+`?\s*(?:\.|:|\+?=)|REMOVE\s+`?\w+`?\s*[.:]
+     |DROP\s+\w|FOREACH\s*\(|LOAD\s+CSV\b)
+""", re.IGNORECASE | re.VERBOSE)
+NODE_PATTERN = re.compile(r"\(\s*(\w*)\s*((?::\s*`?\w+`?\s*)+)(?:\{([^}]*)\})?")
+RELATIONSHIP_PATTERN = re.compile(r"\[\s*\w*\s*:\s*(`?\w+`?(?:\s*\|\s*:?\s*`?\w+`?)*)")
+VAR_LENGTH = re.compile(r"\*\s*(\d*)\s*(\.\.\s*(\d*))?\s*(?=[\]{])")
+# LIMIT keyword, not a property, alias or map key named `limit`
+LIMIT_KEYWORD = re.compile(r"(?<![\w.$`:])(?<!\bAS\s)LIMIT\b", re.IGNORECASE)
+# clause keywords that can't appear inside a LIMIT expression
+CLAUSE_KEYWORD = re.compile(r"\b(?:RETURN|WITH|MATCH|UNWIND|CALL|WHERE|ORDER|SKIP|UNION|CREATE|MERGE|SET|DELETE)\b",
+                            re.IGNORECASE)
+
+# leaf operators that read a whole label, relationship type or the whole graph rather than seeking an index
+SCAN_OPERATORS = ('AllNodesScan', 'LabelScan', 'LabelsScan', 'AllRelationshipsScan', 'RelationshipTypeScan')
+LIMIT_OPERATORS = ('Limit', 'Top', 'PartialTop', 'ExhaustiveLimit')
+
+
+def mask_literals(cypher: str) -> Tuple[str, List[str]]:
+    """
+    Removes comments and replaces each string literal with a numbered placeholder.
+    Returns the masked text and the literals, for `unmask_literals`.
+    """
+    literals = []
+
+    def mask(match):
+        if match.group(1) is None:
+            return ' '
+        literals.append(match.group(1))
+        return '\x00' + str(len(literals) - 1) + '\x00'
+
+    return LITERAL_OR_COMMENT.sub(mask, cypher), literals
+
+
+def unmask_literals(text: str, literals: List[str]) -> str:
+    return PLACEHOLDER.sub(lambda match: literals[int(match.group(1))], text)
+
+
+def strip_literals(cypher: str) -> str:
+    """
+    Removes comments and blanks string literals, so clause and pattern scans don't look inside values.
+    """
+    return PLACEHOLDER.sub("''", mask_literals(cypher)[0])
+
+
+def normalize_cypher(cypher: str) -> str:
+    """
+    Plan cache key for a statement: comments removed, literals replaced with `?` and whitespace collapsed,
+    so the same query about a different serial number shares one plan.
+    """
+    text = NUMBER_LITERAL.sub('?', PLACEHOLDER.sub('?', mask_literals(cypher)[0]))
+    return re.sub(r'\s+', ' ', text).strip().rstrip(';').strip()
+
+
+def schema_problems(cypher: str, structured_schema: Optional[Dict[str, Any]]) -> List[Tuple[str, str]]:
+    """
+    Checks a statement against the cached graph schema without a database round trip.
+    Returns (kind, message) pairs for write clauses and for labels, relationship types and
+    properties the schema doesn't have. Properties are only checked on variables bound to a label.
+    """
+    text = strip_literals(cypher)
+    problems = []
+    write = WRITE_CLAUSE.search(text)
+    if write:
+        problems.append(('write', 'statement must be read-only, found ' + write.group(1).split()[0].upper()))
+
+    node_props = (structured_schema or {}).get('node_props') or {}
+    relationships = (structured_schema or {}).get('relationships') or []
+    if not node_props:
+        return problems
+    properties = {label: {prop['property'] for prop in props} for label, props in node_props.items()}
+    relationship_types = {relationship['type'] for relationship in relationships}
+
+    bound: Dict[str, set] = {}
+    for variable, labels, inline in NODE_PATTERN.findall(text):
+        labels = re.findall(r'\w+', labels)
+        unknown = [label for label in labels if label not in properties]
+        for label in unknown:
+            problems.append(('schema', 'unknown label :' + label))
+        if unknown:
+            continue
+        known = set().union(*(properties[label] for label in labels))
+        if variable:
+            bound.setdefault(variable, set()).update(known)
+        for prop in re.findall(r'(\w+)\s*:', inline or ''):
+            if prop not in known:
+                problems.append(('schema', 'unknown property ' + prop + ' on :' + ':'.join(labels)))
+    for types in RELATIONSHIP_PATTERN.findall(text):
+        for relationship_type in re.split(r'\s*\|\s*:?\s*', types):
+            relationship_type = relationship_type.strip('`')
+            if relationship_types and relationship_type not in relationship_types:
+                problems.append(('schema', 'unknown relationship type :' + relationship_type))
+    for variable, prop in re.findall(r'(?<![\w.$])(\w+)\.(\w+)', text):
+        if variable in bound and prop not in bound[variable]:
+            problems.append(('schema', 'unknown property ' + variable + '.' + prop))
+    return list(dict.fromkeys(problems))
+
+
+def ends_with_limit(text: str) -> bool:
+    """
+    True if the masked statement ends with a `LIMIT <expression>` clause, e.g. `LIMIT 10`, `LIMIT 10 + 5`
+    or `LIMIT toInteger($n)`, rather than with a LIMIT inside a subquery or earlier clause.
+    """
+    limits = list(LIMIT_KEYWORD.finditer(text))
+    if not limits:
+        return False
+    expression = text[limits[-1].end():]
+    if not expression.strip() or CLAUSE_KEYWORD.search(expression):
+        return False
+    depth = 0
+    for char in expression:
+        depth += (char in '([{') - (char in ')]}')
+        if depth < 0:
+            # closes a subquery the LIMIT was inside
+            return False
+    return depth == 0
+
+
+def rewrite_cypher(cypher: str) -> Tuple[str, List[str]]:
+    """
+    Applies the safe rewrites: caps unbounded variable-length patterns at `CYPHER_MAX_HOPS`
+    and appends `LIMIT CYPHER_DEFAULT_LIMIT` to a single-part statement that doesn't end with a LIMIT.
+    Returns the statement and the names of the rewrites applied.
+    """
+    rewrites = []
+    # rewrite outside string literals only, then put them back
+    text, literals = mask_literals(cypher)
+    text = text.strip().rstrip(';').rstrip()
+
+    def cap(match):
+        lower, dots, upper = match.group(1), match.group(2), match.group(3)
+        if (dots is None and not lower) or (dots is not None and (not upper or int(upper) > CYPHER_MAX_HOPS)):
+            lower = lower or '1'
+            return '*' + lower + '..' + str(max(int(lower), CYPHER_MAX_HOPS))
+        return match.group(0)
+
+    capped = VAR_LENGTH.sub(cap, text)
+    if capped != text:
+        rewrites.append('hop_limit')
+        text = capped
+    if not ends_with_limit(text) and not re.search(r'\bUNION\b', text, re.IGNORECASE):
+        text += '\nLIMIT ' + str(CYPHER_DEFAULT_LIMIT)
+        rewrites.append('limit')
+    if not rewrites:
+        return cypher, rewrites
+    return unmask_literals(text, literals), rewrites
+
+
+@dataclass
+class PlanSummary:
+    """
+    What the checks need from an EXPLAIN plan, cached per normalized statement.
+    `error` is set instead when the server refused to plan the statement.
+    """
+    operators: List[str] = field(default_factory=list)
+    scans: List[Tuple[str, float]] = field(default_factory=list)
+    cartesian_rows: float = 0.0
+    estimated_rows: float = 0.0
+    limited: bool = False
+    warnings: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+    @property
+    def anchored(self) -> bool:
+        return not self.scans
+
+
+def _operator_name(plan: Dict[str, Any]) -> str:
+    # operator types carry the planner's database suffix, e.g. NodeIndexSeek@neo4j
+    return str(plan.get('operatorType', '')).split('@', 1)[0]
+
+
+def _estimated_rows(plan: Dict[str, Any]) -> float:
+    return float((plan.get('args') or {}).get('EstimatedRows') or 0.0)
+
+
+def summarize_plan(plan: Optional[Dict[str, Any]], notifications: Optional[List[Any]] = None) -> PlanSummary:
+    summary = PlanSummary(estimated_rows=_estimated_rows(plan or {}))
+    pending = [plan] if plan else []
+    while pending:
+        operator = pending.pop()
+        name = _operator_name(operator)
+        children = operator.get('children') or []
+        summary.operators.append(name)
+        if not children and any(scan in name for scan in SCAN_OPERATORS):
+            summary.scans.append((name, _estimated_rows(operator)))
+        if name == 'CartesianProduct':
+            summary.cartesian_rows = max(summary.cartesian_rows, _estimated_rows(operator))
+        if name in LIMIT_OPERATORS:
+            summary.limited = True
+        pending.extend(children)
+    for notification in notifications or []:
+        code = notification.get('code') if isinstance(notification, dict) else getattr(notification, 'code', None)
+        if code:
+            summary.warnings.append(code.rsplit('.', 1)[-1])
+    return summary
+
+
+def plan_problems(summary: PlanSummary) -> List[Tuple[str, str]]:
+    """
+    Blocks plans that scan more than `CYPHER_MAX_SCAN_ROWS` rows without an index anchor, build a
+    cartesian product of that size, expand unbounded paths or return that many rows without a limit.
+    """
+    if summary.error is not None:
+        return [('invalid', summary.error)]
+    problems = []
+    for name, rows in summary.scans:
+        if rows > CYPHER_MAX_SCAN_ROWS:
+            problems.append(('scan', name + ' over ~' + str(int(rows)) + ' rows with no index anchor'))
+    if summary.cartesian_rows > CYPHER_MAX_SCAN_ROWS:
+        problems.append(('cartesian', 'cartesian product of ~' + str(int(summary.cartesian_rows)) + ' rows'))
+    if 'UnboundedVariableLengthPatternWarning' in summary.warnings:
+        problems.append(('unbounded', 'variable-length pattern without an upper bound'))
+    if not summary.limited and summary.estimated_rows > CYPHER_MAX_SCAN_ROWS:
+        problems.append(('limit', 'no LIMIT on ~' + str(int(summary.estimated_rows)) + ' result rows'))
+    return problems
+
+
+class CypherPlanCache:
+    """
+    LRU cache of EXPLAIN plan summaries keyed by (database key, schema version, normalized statement),
+    so a query shape is planned on the server once per schema version.
+    """
+
+    def __init__(self, max_size: int = CYPHER_PLAN_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._plans: "OrderedDict[Tuple[Any, ...], PlanSummary]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[Any, ...]) -> Optional[PlanSummary]:
+        with self._lock:
+            summary = self._plans.get(key)
+            if summary is None:
+                self.misses += 1
+                return None
+            self._plans.move_to_end(key)
+            self.hits += 1
+            return summary
+
+    def store(self, key: Tuple[Any, ...], summary: PlanSummary) -> None:
+        with self._lock:
+            self._plans[key] = summary
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_size:
+                self._plans.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'plans': len(self._plans),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+plan_cache = CypherPlanCache()
+metrics.register_collector('cypher_plans', plan_cache.stats)
+
+
+def explain(driver, database: Optional[str], cypher: str) -> PlanSummary:
+    """
+    Plans the statement on the server without running it.
+    """
+    try:
+        with metrics.span('cypher_explain'):
+            with driver.session(database=database) as session:
+                result = session.run('EXPLAIN ' + cypher).consume()
+    except ClientError as e:
+        # syntax errors, unknown functions and the like: the statement would fail the same way when run
+        return PlanSummary(error=e.message or str(e))
+    return summarize_plan(result.plan, result.notifications)
+
+
+class CypherRejected(ValueError):
+    def __init__(self, cypher: str, problems: List[Tuple[str, str]]):
+        super().__init__("Generated Cypher Statement was rejected: "
+                         + '; '.join(message for _, message in problems) + "\n" + cypher)
+        self.cypher = cypher
+        self.problems = problems
+
+
+@dataclass
+class CypherCheck:
+    cypher: str
+    problems: List[Tuple[str, str]] = field(default_factory=list)
+    rewrites: List[str] = field(default_factory=list)
+    plan: Optional[PlanSummary] = None
+
+    @property
+    def ok(self) -> bool:
+        return not self.problems
+
+    def error(self) -> CypherRejected:
+        return CypherRejected(self.cypher, self.problems)
+
+    def repair_question(self, question: str) -> str:
+        """
+        The question for a repair round: the original question, the rejected statement and why it was rejected.
+        """
+        return (question + "\nThis Cypher statement was rejected:\n" + self.cypher
+                + "\nProblems:\n" + '\n'.join('- ' + message for _, message in self.problems)
+                + "\nWrite a corrected read-only statement using only the schema, anchored on indexed "
+                  "properties where possible, with a LIMIT.")
+
+
+def check_cypher(cypher: str, driver, database: Optional[str], structured_schema: Optional[Dict[str, Any]],
+                 plan_key: Tuple[Any, ...] = ()) -> CypherCheck:
+    """
+    Validates generated Cypher before it runs: schema checks, safe rewrites, then the EXPLAIN plan,
+    taken from `plan_cache` when the normalized statement was planned before under `plan_key`.
+    """
+    problems = schema_problems(cypher, structured_schema)
+    if problems:
+        return CypherCheck(cypher=cypher, problems=problems)
+    cypher, rewrites = rewrite_cypher(cypher)
+    for rewrite in rewrites:
+        metrics.increment('cypher_rewrites_total', rewrite=rewrite)
+
+    key = plan_key + (normalize_cypher(cypher),)
+    summary = plan_cache.get(key)
+    if summary is None:
+        summary = explain(driver, database, cypher)
+        plan_cache.store(key, summary)
+    return CypherCheck(cypher=cypher, problems=plan_problems(summary), rewrites=rewrites, plan=summary)
+
+
+def record_blocked(check: CypherCheck, **labels: Any) -> None:
+    """
+    Counts a rejected statement once per kind of problem in `cypher_blocked_total`.
+    """
+    print('generated cypher blocked: ' + '; '.join(message for _, message in check.problems))
+    for kind in dict.fromkeys(kind for kind, _ in check.problems):
+        metrics.increment('cypher_blocked_total', reason=kind, **labels)
@@ -1,29 +1,118 @@
-import streamlit as st
-from neo4j import GraphDatabase
+import atexit
+import os
+import threading
+from typing import Dict, Optional, Tuple
 
-def init_driver(uri, username, password):
+from neo4j import AsyncDriver, AsyncGraphDatabase, GraphDatabase, Driver
+
+
+class DriverPool:
     """
-    Initiate the Neo4j Driver
+    Process-wide registry of Neo4j drivers.
+
+    Each driver owns a connection pool, so sessions, graphs and writers that
+    point at the same (uri, database, username) borrow the same driver
+    instead of opening a pool of their own.
     """
-    d = GraphDatabase.driver(uri, auth=(username, password))
-    d.verify_connectivity()
-    print('driver created')
-    return d
 
-def get_driver():
+    def __init__(self,
+                 max_connection_pool_size: int = int(os.environ.get('NEO4J_MAX_POOL_SIZE', 100)),
+                 connection_acquisition_timeout: float = float(os.environ.get('NEO4J_ACQUISITION_TIMEOUT', 60)),
+                 liveness_check_timeout: Optional[float] = float(os.environ.get('NEO4J_LIVENESS_CHECK_TIMEOUT', 30))):
+        self.max_connection_pool_size = max_connection_pool_size
+        self.connection_acquisition_timeout = connection_acquisition_timeout
+        self.liveness_check_timeout = liveness_check_timeout
+        self._lock = threading.Lock()
+        self._drivers: Dict[Tuple[str, Optional[str], Optional[str]], Driver] = {}
+        self._async_drivers: Dict[Tuple[str, Optional[str], Optional[str]], AsyncDriver] = {}
+
+    def get(self, uri: str, username: str, password: str, database: Optional[str] = None) -> Driver:
+        """
+        Returns the shared driver for the given connection, creating and verifying it on first use.
+        """
+        key = (uri, database, username)
+        driver = self._drivers.get(key)
+        if driver is not None:
+            return driver
+
+        with self._lock:
+            driver = self._drivers.get(key)
+            if driver is None:
+                driver = GraphDatabase.driver(uri, auth=(username, password),
+                                              max_connection_pool_size=self.max_connection_pool_size,
+                                              connection_acquisition_timeout=self.connection_acquisition_timeout,
+                                              liveness_check_timeout=self.liveness_check_timeout)
+                driver.verify_connectivity()
+                self._drivers[key] = driver
+                print('driver created')
+        return driver
+
+    async def get_async(self, uri: str, username: str, password: str, database: Optional[str] = None) -> AsyncDriver:
+        """
+        Returns the shared async driver for the given connection, creating and verifying it on first use.
+        Async drivers belong to the event loop they were created on, so all callers must share that loop.
+        """
+        key = (uri, database, username)
+        driver = self._async_drivers.get(key)
+        if driver is not None:
+            return driver
+
+        driver = AsyncGraphDatabase.driver(uri, auth=(username, password),
+                                           max_connection_pool_size=self.max_connection_pool_size,
+                                           connection_acquisition_timeout=self.connection_acquisition_timeout,
+                                           liveness_check_timeout=self.liveness_check_timeout)
+        await driver.verify_connectivity()
+        with self._lock:
+            existing = self._async_drivers.setdefault(key, driver)
+        if existing is not driver:
+            # another coroutine created the driver while this one was verifying connectivity
+            await driver.close()
+        else:
+            print('async driver created')
+        return existing
+
+    async def close_async(self) -> None:
+        """
+        Closes every registered async driver. Must run on the event loop the drivers were created on.
+        """
+        with self._lock:
+            async_drivers = list(self._async_drivers.values())
+            self._async_drivers.clear()
+        for driver in async_drivers:
+            await driver.close()
+
+    def close_all(self) -> None:
+        """
+        Closes every registered driver and all remaining open sessions.
+        """
+        with self._lock:
+            for driver in self._drivers.values():
+                driver.close()
+            self._drivers.clear()
+
+
+driver_pool = DriverPool()
+
+
+def init_driver(uri, username, password, database=None):
+    """
+    Get the shared Neo4j Driver for the given connection
+    """
+    return driver_pool.get(uri, username, password, database)
+
+
+async def init_async_driver(uri, username, password, database=None):
     """
-    Get the instance of the Neo4j Driver created in the `initDriver` function
+    Get the shared async Neo4j Driver for the given connection
     """
+    return await driver_pool.get_async(uri, username, password, database)
 
-    return st.session_state.driver
 
-def close_driver():
+def close_drivers():
     """
-    If the driver has been instantiated, close it and all remaining open sessions
+    Close all shared drivers. Registered to run at interpreter shutdown.
     """
+    driver_pool.close_all()
 
-    if st.session_state.driver != None:
-        st.session_state.driver.close()
-        st.session_state.driver = None
 
-        return st.session_state.driver
\ No newline at end of file
+atexit.register(close_drivers)
@@ -0,0 +1,220 @@
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from cypher_cache import extract_literals, parameterize_cypher
+from metrics import metrics
+
+# comma-separated Label.property pairs holding identifiers, e.g. "Engine.serialNumber,EcmCode.code";
+# when unset, string properties with identifier-like names are picked from the graph schema
+ENTITY_PROPERTIES = os.environ.get('ENTITY_PROPERTIES', '')
+IDENTIFIER_PROPERTY_PATTERN = re.compile(r'^id$|Id$|_id$|serial|code|number|^name$', re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class EntityMatch:
+    """
+    A literal from the question that is the value of an identifier property of a node.
+    """
+    literal: str
+    value: Any
+    label: str
+    property: str
+    node_id: str
+
+
+def _quote(name: str) -> str:
+    return '`' + name.replace('`', '``') + '`'
+
+
+def _index_name(label: str, property_name: str) -> str:
+    return re.sub(r'\W', '_', 'entity_' + label + '_' + property_name)
+
+
+class EntityIndex:
+    """
+    In-memory index from identifier values (serial numbers, build names, ECM codes, ...) to the nodes holding them.
+
+    Literals in a question are resolved with one dict lookup each, so the Cypher generation step is told
+    the exact label and property to match on, and the value is bound as a parameter rather than guessed.
+    The index is rebuilt in the background once `ttl` seconds have passed or the schema version changes;
+    lookups keep using the previous index until the new one is swapped in.
+    """
+
+    def __init__(self, ttl: float = float(os.environ.get('ENTITY_INDEX_TTL', 3600)),
+                 max_values: int = int(os.environ.get('ENTITY_INDEX_MAX_VALUES', 1000000)),
+                 create_indexes: bool = os.environ.get('ENTITY_CREATE_INDEXES', 'true').lower() == 'true',
+                 create_constraints: bool = os.environ.get('ENTITY_CREATE_CONSTRAINTS', 'false').lower() == 'true'):
+        self.ttl = ttl
+        self.max_values = max_values
+        self.create_indexes = create_indexes
+        self.create_constraints = create_constraints
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[Tuple[Any, str, str, str], ...]] = {}
+        self._unique: Dict[Tuple[str, str], bool] = {}
+        self._loaded_at = float('-inf')
+        self._schema_version: Optional[int] = None
+        self._refreshing = False
+        self.lookups = 0
+        self.matches = 0
+        self.builds = 0
+        self.last_build_seconds = 0.0
+
+    @staticmethod
+    def identifier_properties(structured_schema: Dict[str, Any]) -> List[Tuple[str, str]]:
+        """
+        Returns the (label, property) pairs to index: `ENTITY_PROPERTIES` if set,
+        otherwise the identifier-like string properties of the schema.
+        """
+        if ENTITY_PROPERTIES:
+            return [tuple(pair.strip().split('.', 1)) for pair in ENTITY_PROPERTIES.split(',') if '.' in pair]
+        return [(label, prop['property'])
+                for label, props in (structured_schema or {}).get('node_props', {}).items()
+                for prop in props
+                if prop.get('type') == 'STRING' and IDENTIFIER_PROPERTY_PATTERN.search(prop['property'])]
+
+    def build(self, driver, database: Optional[str], structured_schema: Dict[str, Any],
+              schema_version: Optional[int] = None) -> None:
+        """
+        Scans the identifier properties and swaps in a new index. At most `max_values` values are kept.
+        """
+        build_timer_start = time.perf_counter()
+        entries: Dict[str, List[Tuple[Any, str, str, str]]] = {}
+        unique: Dict[Tuple[str, str], bool] = {}
+        values = 0
+        with driver.session(database=database) as session:
+            for label, property_name in self.identifier_properties(structured_schema):
+                seen = set()
+                unique[(label, property_name)] = True
+                query = ("MATCH (n:" + _quote(label) + ") WHERE n." + _quote(property_name) + " IS NOT NULL "
+                         "RETURN n." + _quote(property_name) + " AS value, elementId(n) AS id")
+                for record in session.run(query):
+                    if record['value'] is None:
+                        continue
+                    key = str(record['value']).casefold()
+                    if key in seen:
+                        unique[(label, property_name)] = False
+                    seen.add(key)
+                    entries.setdefault(key, []).append((record['value'], label, property_name, record['id']))
+                    values += 1
+                    if values >= self.max_values:
+                        break
+                if values >= self.max_values:
+                    print('entity index truncated at ' + str(values) + ' values')
+                    break
+
+        with self._lock:
+            self._entries = {key: tuple(nodes) for key, nodes in entries.items()}
+            self._unique = unique
+            self._loaded_at = time.monotonic()
+            self._schema_version = schema_version
+        self.builds += 1
+        self.last_build_seconds = time.perf_counter() - build_timer_start
+        metrics.observe('entity_index_build_seconds', self.last_build_seconds)
+        print('entity index built: ' + str(self.stats()))
+
+    def refresh_if_stale(self, driver, database: Optional[str], structured_schema: Dict[str, Any],
+                         schema_version: Optional[int] = None, writer=None) -> None:
+        """
+        Starts a background rebuild when the index has expired or the schema changed, then makes sure
+        the matching Neo4j indexes exist through `writer` (a Neo4jWriter). Returns immediately.
+        """
+        with self._lock:
+            fresh = time.monotonic() - self._loaded_at < self.ttl and schema_version == self._schema_version
+            if fresh or self._refreshing or not structured_schema:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self.build(driver, database, structured_schema, schema_version)
+                if writer is not None and self.create_indexes:
+                    self.ensure_indexes(writer)
+            except Exception as e:
+                print(e)
+                # retry in a minute rather than on every question
+                with self._lock:
+                    self._loaded_at = time.monotonic() - self.ttl + 60
+                    self._schema_version = schema_version
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=refresh, name='entity-index', daemon=True).start()
+
+    def ensure_indexes(self, writer) -> List[str]:
+        """
+        Creates a range index for every indexed property that has none, or a uniqueness constraint
+        instead when `create_constraints` is set and the scanned values were unique.
+        Returns the statements that were run.
+        """
+        with writer.driver.session(database=writer.database) as session:
+            existing = {(tuple(record['labelsOrTypes'] or ()), tuple(record['properties'] or ()))
+                        for record in session.run("SHOW INDEXES YIELD labelsOrTypes, properties")}
+
+        statements = []
+        for (label, property_name), unique in self._unique.items():
+            if ((label,), (property_name,)) in existing:
+                continue
+            if unique and self.create_constraints:
+                statements.append("CREATE CONSTRAINT " + _index_name(label, property_name) + "_unique IF NOT EXISTS "
+                                  "FOR (n:" + _quote(label) + ") REQUIRE n." + _quote(property_name) + " IS UNIQUE")
+            else:
+                statements.append("CREATE INDEX " + _index_name(label, property_name) + " IF NOT EXISTS "
+                                  "FOR (n:" + _quote(label) + ") ON (n." + _quote(property_name) + ")")
+        if statements:
+            writer.build_indexes(statements)
+            print('entity indexes created: ' + str(statements))
+        return statements
+
+    def resolve(self, question: str) -> List[EntityMatch]:
+        """
+        Returns a match for every literal in the question that is a known identifier value.
+        """
+        resolve_timer_start = time.perf_counter()
+        entries = self._entries
+        matches = [EntityMatch(literal, value, label, property_name, node_id)
+                   for literal in extract_literals(question)
+                   for value, label, property_name, node_id in entries.get(literal.casefold(), ())]
+        self.lookups += 1
+        self.matches += len(matches)
+        metrics.observe('entity_resolve_seconds', time.perf_counter() - resolve_timer_start)
+        return matches
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'values': len(self._entries),
+            'properties': len(self._unique),
+            'builds': self.builds,
+            'last_build_seconds': self.last_build_seconds,
+            'lookups': self.lookups,
+            'matches': self.matches,
+        }
+
+
+def describe_entities(matches: List[EntityMatch]) -> str:
+    """
+    One line per match telling the Cypher generation step which label and property an identifier belongs to.
+    """
+    return '\n'.join("'" + match.literal + "' is the " + match.property + " of a " + match.label + " node."
+                     for match in matches)
+
+
+def bind_entities(cypher: str, matches: List[EntityMatch]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Replaces the resolved literals in generated Cypher with parameters bound to the exact stored values,
+    so differences in case or type between the question and the database don't break the match.
+    """
+    literals = list(dict.fromkeys(match.literal for match in matches))
+    values = {match.literal: match.value for match in matches}
+    # the index matches values case-insensitively, so the literal may be written in another case in the Cypher
+    template, parameters = parameterize_cypher(cypher, literals, ignore_case=True)
+    return (re.sub(r'\$p(\d+)\b', r'$e\1', template),
+            {'e' + str(i): values[literals[i]] for i in parameters})
+
+
+entity_index = EntityIndex()
+metrics.register_collector('entity_index', entity_index.stats)
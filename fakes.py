@@ -0,0 +1,375 @@
+"""
+Deterministic stand-ins for the LLM, embedding and Neo4j backends of NeoLangService,
+used by `benchmark.py` to measure the service without Azure/Vertex calls or a live database.
+"""
+import asyncio
+import re
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings.base import Embeddings
+from langchain.pydantic_v1 import PrivateAttr
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult
+
+from cypher_cache import extract_literals
+from neo4jgraph import SharedNeo4jGraph
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model that answers after `latency` seconds and then emits tokens at `tokens_per_second`.
+
+    Prompts are classified as Cypher generation, answer synthesis or memory summarization
+    by their wording, and calls are counted per kind.
+    """
+
+    latency: float = 0.5
+    tokens_per_second: float = 50.0
+    answer_tokens: int = 60
+    streaming: bool = False
+
+    _calls: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    @property
+    def calls(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._calls)
+
+    @staticmethod
+    def _kind(text: str) -> str:
+        if 'Progressively summarize' in text:
+            return 'summary'
+        if 'Graph Query Results' in text:
+            return 'answer'
+        return 'cypher'
+
+    @staticmethod
+    def _cypher_for(text: str) -> str:
+        question = text.rsplit('The question is:', 1)[-1]
+        literals = extract_literals(question)
+        if not literals:
+            return "MATCH (n:Engine) RETURN n.serialNumber AS serialNumber LIMIT 10"
+        return "MATCH (n) WHERE n.id = '" + literals[-1] + "' RETURN n.id AS id, labels(n) AS labels LIMIT 10"
+
+    def _count(self, messages: List[BaseMessage]) -> Tuple[str, str]:
+        text = '\n'.join(str(message.content) for message in messages)
+        kind = self._kind(text)
+        with self._lock:
+            self._calls[kind] = self._calls.get(kind, 0) + 1
+        return kind, text
+
+    def _content(self, kind: str, text: str) -> str:
+        if kind == 'cypher':
+            return self._cypher_for(text)
+        if kind == 'summary':
+            return "The user asked about engine configurations."
+        return ''.join(self._answer_tokens())
+
+    def _answer_tokens(self) -> List[str]:
+        return ['token' + str(i) + ' ' for i in range(self.answer_tokens)]
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        kind, text = self._count(messages)
+        time.sleep(self.latency)
+        if kind == 'answer':
+            for token in self._answer_tokens():
+                time.sleep(1 / self.tokens_per_second)
+                if self.streaming and run_manager is not None:
+                    run_manager.on_llm_new_token(token)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._content(kind, text)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        kind, text = self._count(messages)
+        await asyncio.sleep(self.latency)
+        if kind == 'answer':
+            for token in self._answer_tokens():
+                await asyncio.sleep(1 / self.tokens_per_second)
+                if self.streaming and run_manager is not None:
+                    await run_manager.on_llm_new_token(token)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._content(kind, text)))])
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Hashed bag-of-words embeddings: deterministic, and similar wordings get similar vectors.
+    """
+
+    def __init__(self, size: int = 256, latency: float = 0.05):
+        self.size = size
+        self.latency = latency
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.size
+        for word in re.findall(r'\w+', text.lower()):
+            vector[zlib.crc32(word.encode()) % self.size] += 1.0
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._embed(text)
+
+
+class FakeRecord:
+    def __init__(self, data: Dict[str, Any]):
+        self._data = data
+
+    def data(self) -> Dict[str, Any]:
+        return dict(self._data)
+
+    def __getitem__(self, key: str) -> Any:
+        return self._data.get(key)
+
+
+class FakeSummary:
+    def __init__(self, plan: Optional[Dict[str, Any]] = None):
+        self.plan = plan
+        self.notifications: List[Dict[str, Any]] = []
+
+    def consume(self):
+        return self
+
+
+class FakeResult:
+    """
+    Records of a read, iterable once like a neo4j Result.
+    """
+
+    def __init__(self, records: Iterable[FakeRecord]):
+        self._records = iter(records)
+
+    def __iter__(self):
+        return self._records
+
+    def single(self) -> Optional[FakeRecord]:
+        return next(self._records, None)
+
+    def consume(self) -> FakeSummary:
+        for _ in self._records:
+            pass
+        return FakeSummary()
+
+
+class FakeTransaction:
+    def __init__(self, driver: 'FakeDriver'):
+        self.driver = driver
+
+    def run(self, query: str, parameters: Optional[Dict[str, Any]] = None, **kwargs: Any):
+        parameters = dict(parameters or {}, **kwargs)
+        if query.lstrip().lower().startswith('explain'):
+            return self.driver.explain(query)
+        if 'db.awaitIndexes' in query:
+            return FakeResult([])
+        if 'db.index.vector.queryNodes' in query:
+            return FakeResult(self.driver.document_records(parameters.get('k', 4)))
+        if query.lstrip().lower().startswith(('unwind', 'create', 'merge')):
+            self.driver.count_write(len(parameters.get('params', [])) or 1)
+            return FakeSummary()
+        return FakeResult(self.driver.read_records())
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, driver: 'FakeDriver'):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def run(self, query: str, parameters: Optional[Dict[str, Any]] = None, **kwargs: Any):
+        return FakeTransaction(self.driver).run(query, parameters)
+
+    def begin_transaction(self, timeout: Optional[float] = None) -> FakeTransaction:
+        return FakeTransaction(self.driver)
+
+    def execute_write(self, transaction_function, *args, **kwargs):
+        return transaction_function(FakeTransaction(self.driver), *args, **kwargs)
+
+    def execute_read(self, transaction_function, *args, **kwargs):
+        return transaction_function(FakeTransaction(self.driver), *args, **kwargs)
+
+    def close(self):
+        pass
+
+
+class FakeDriver:
+    """
+    In-process stand-in for the neo4j Driver surface used by the service, log writer and Neo4jWriter.
+    Reads return `rows` records after `query_latency` seconds; writes take `write_latency` and are counted.
+    """
+
+    def __init__(self, rows: int = 25, query_latency: float = 0.05, write_latency: float = 0.01):
+        self.rows = rows
+        self.query_latency = query_latency
+        self.write_latency = write_latency
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.write_transactions = 0
+        self.rows_written = 0
+        self.explains = 0
+
+    def session(self, database: Optional[str] = None, **kwargs: Any) -> FakeSession:
+        return FakeSession(self)
+
+    def read_records(self):
+        time.sleep(self.query_latency)
+        yield from self.records()
+
+    def records(self) -> List[FakeRecord]:
+        with self._lock:
+            self.reads += 1
+        return [FakeRecord({'id': 'CFG' + str(i), 'labels': ['Configuration'], 'description': 'configuration ' + str(i)})
+                for i in range(self.rows)]
+
+    def document_records(self, k: int) -> List[FakeRecord]:
+        time.sleep(self.query_latency)
+        return [FakeRecord({'index': i, 'text': 'service bulletin ' + str(i), 'score': 0.9 - i / 100})
+                for i in range(k)]
+
+    def explain(self, query: str) -> FakeSummary:
+        """
+        A plan shaped like the server's: a label or all-nodes scan estimated at `rows` rows, under a Limit
+        when the query has one.
+        """
+        with self._lock:
+            self.explains += 1
+        scan = 'NodeByLabelScan' if re.search(r'\(\s*\w*\s*:', query) else 'AllNodesScan'
+        plan = {'operatorType': scan + '@neo4j', 'args': {'EstimatedRows': float(self.rows)}, 'children': []}
+        if re.search(r'\bLIMIT\b', query, re.IGNORECASE):
+            plan = {'operatorType': 'Limit@neo4j', 'args': {'EstimatedRows': float(self.rows)}, 'children': [plan]}
+        return FakeSummary({'operatorType': 'ProduceResults@neo4j', 'args': {'EstimatedRows': float(self.rows)},
+                            'children': [plan]})
+
+    def count_write(self, rows: int) -> None:
+        time.sleep(self.write_latency)
+        with self._lock:
+            self.write_transactions += 1
+            self.rows_written += rows
+
+    def verify_connectivity(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeAsyncResult:
+    def __init__(self, records: List[FakeRecord]):
+        self._records = iter(records)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> FakeRecord:
+        try:
+            return next(self._records)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeAsyncTransaction:
+    def __init__(self, driver: FakeDriver):
+        self.driver = driver
+
+    async def run(self, query: str, parameters: Optional[Dict[str, Any]] = None, **kwargs: Any) -> FakeAsyncResult:
+        await asyncio.sleep(self.driver.query_latency)
+        return FakeAsyncResult(self.driver.records())
+
+    async def close(self):
+        pass
+
+
+class FakeAsyncSession:
+    def __init__(self, driver: FakeDriver):
+        self.driver = driver
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def begin_transaction(self, timeout: Optional[float] = None) -> FakeAsyncTransaction:
+        return FakeAsyncTransaction(self.driver)
+
+
+class FakeAsyncDriver:
+    """
+    Async counterpart of FakeDriver for AsyncNeoLangService; reads are counted on the wrapped FakeDriver.
+    """
+
+    def __init__(self, driver: FakeDriver):
+        self.driver = driver
+
+    def session(self, database: Optional[str] = None, **kwargs: Any) -> FakeAsyncSession:
+        return FakeAsyncSession(self.driver)
+
+    async def close(self):
+        pass
+
+
+class FakeGraph(SharedNeo4jGraph):
+    """
+    Graph with a fixed FSE-style schema; `refresh_schema` only sleeps for `schema_latency` seconds.
+    """
+
+    def __init__(self, driver: FakeDriver, schema_latency: float = 0.2):
+        super().__init__(driver=driver, database=None, cache_key=('fake', str(id(self))))
+        self.schema_latency = schema_latency
+
+    def refresh_schema(self) -> None:
+        time.sleep(self.schema_latency)
+        node_props = {
+            'Engine': [{'property': 'serialNumber', 'type': 'STRING'}],
+            'Configuration': [{'property': 'id', 'type': 'STRING'}, {'property': 'description', 'type': 'STRING'}],
+            'Build': [{'property': 'name', 'type': 'STRING'}],
+            'SoftwareComponent': [{'property': 'name', 'type': 'STRING'}],
+            'EcmCode': [{'property': 'code', 'type': 'STRING'}],
+        }
+        relationships = [
+            {'start': 'Engine', 'type': 'HAS_CONFIGURATION', 'end': 'Configuration'},
+            {'start': 'Build', 'type': 'CONTAINS', 'end': 'SoftwareComponent'},
+            {'start': 'Configuration', 'type': 'HAS_ECM_CODE', 'end': 'EcmCode'},
+        ]
+        self.structured_schema = {'node_props': node_props, 'rel_props': {}, 'relationships': relationships}
+        self.schema = ("Node properties are the following:\n"
+                       + str([{'labels': label, 'properties': props} for label, props in node_props.items()])
+                       + "\nRelationship properties are the following:\n[]"
+                       + "\nThe relationships are the following:\n"
+                       + str(['(:' + r['start'] + ')-[:' + r['type'] + ']->(:' + r['end'] + ')' for r in relationships]))
+
+
+def use_offline_encoding(name: str = 'cl100k_base') -> None:
+    """
+    Registers a byte-level tiktoken encoding under `name`, so prompt and result budgets work without
+    downloading the BPE ranks. Every byte counts as a token, so budgets come out tighter than with the
+    real encoding.
+    """
+    import tiktoken
+    import tiktoken.registry
+
+    # tiktoken needs at least one special token to build its matcher
+    encoding = tiktoken.Encoding(name=name + '-offline', pat_str=r"\S+|\s+",
+                                 mergeable_ranks={bytes([i]): i for i in range(256)},
+                                 special_tokens={'<|endoftext|>': 256})
+    with tiktoken.registry._lock:
+        tiktoken.registry.ENCODINGS[name] = encoding
@@ -0,0 +1,301 @@
+import asyncio
+import os
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Any, Dict, List, Optional
+
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import BaseMessage, ChatResult
+
+from metrics import metrics
+
+# model for the Cypher generation step, e.g. a cheaper one than the answer model; defaults to the selected llm
+LLM_CYPHER_MODEL = os.environ.get('LLM_CYPHER_MODEL', '')
+# second provider, used for hedged requests and when the first one fails
+LLM_FALLBACK_MODEL = os.environ.get('LLM_FALLBACK_MODEL', '')
+# seconds without a response before a hedged request goes to the fallback; 0 disables hedging
+LLM_HEDGE_AFTER = float(os.environ.get('LLM_HEDGE_AFTER', 0))
+# in-flight requests allowed per provider, e.g. "GPT-4 8k=8,chat-bison 32k=16"
+LLM_PROVIDER_CONCURRENCY = os.environ.get('LLM_PROVIDER_CONCURRENCY', '')
+LLM_DEFAULT_CONCURRENCY = int(os.environ.get('LLM_DEFAULT_CONCURRENCY', 16))
+# seconds to wait for a free slot before the provider counts as failed
+LLM_QUEUE_TIMEOUT = float(os.environ.get('LLM_QUEUE_TIMEOUT', 30))
+
+_hedge_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('LLM_HEDGE_WORKERS', 32)),
+                                     thread_name_prefix='llm-hedge')
+
+
+class ProviderBusy(Exception):
+    pass
+
+
+class ProviderLimiter:
+    """
+    Caps the requests in flight to one provider across every session of the process.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self._semaphore = threading.BoundedSemaphore(limit)
+        # futures of coroutines waiting in `acquire_async`, each woken on its own loop by `release`
+        self._waiters: List[Any] = []
+        self._waiters_lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def acquire(self, timeout: float = LLM_QUEUE_TIMEOUT) -> None:
+        if not self._semaphore.acquire(timeout=timeout):
+            self.rejected += 1
+            raise ProviderBusy(self.name + " has " + str(self.limit) + " requests in flight")
+        self.in_flight += 1
+
+    async def acquire_async(self, timeout: float = LLM_QUEUE_TIMEOUT) -> None:
+        """
+        Waits for a slot without blocking the event loop. The semaphore is shared with `acquire` callers on
+        other threads, so waiters are futures that `release` wakes with `call_soon_threadsafe`.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        acquired = self._semaphore.acquire(blocking=False)
+        while not acquired:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self.rejected += 1
+                raise ProviderBusy(self.name + " has " + str(self.limit) + " requests in flight")
+            waiter = loop.create_future()
+            with self._waiters_lock:
+                self._waiters.append((loop, waiter))
+            try:
+                # checked again after registering, or a release in between would wake nobody
+                acquired = self._semaphore.acquire(blocking=False)
+                if not acquired:
+                    await asyncio.wait_for(waiter, remaining)
+                    acquired = self._semaphore.acquire(blocking=False)
+            except asyncio.TimeoutError:
+                self._leave(loop, waiter)
+            except asyncio.CancelledError:
+                self._leave(loop, waiter)
+                raise
+            else:
+                self._discard_waiter(loop, waiter)
+        self.in_flight += 1
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._semaphore.release()
+        self._wake_next()
+
+    def _discard_waiter(self, loop: asyncio.AbstractEventLoop, waiter: asyncio.Future) -> bool:
+        """
+        Removes a waiter that is still queued. Returns False if `release` already woke it.
+        """
+        with self._waiters_lock:
+            if (loop, waiter) in self._waiters:
+                self._waiters.remove((loop, waiter))
+                return True
+            return False
+
+    def _leave(self, loop: asyncio.AbstractEventLoop, waiter: asyncio.Future) -> None:
+        if not self._discard_waiter(loop, waiter):
+            # woken for a free slot this waiter won't take: pass the wake-up on
+            self._wake_next()
+
+    def _wake_next(self) -> None:
+        with self._waiters_lock:
+            if not self._waiters:
+                return
+            loop, waiter = self._waiters.pop(0)
+        loop.call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(None))
+
+
+def _concurrency_limits() -> Dict[str, int]:
+    limits = {}
+    for pair in LLM_PROVIDER_CONCURRENCY.split(','):
+        if '=' in pair:
+            name, limit = pair.rsplit('=', 1)
+            limits[name.strip()] = int(limit)
+    return limits
+
+
+_limiters: Dict[str, ProviderLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str) -> ProviderLimiter:
+    with _limiters_lock:
+        if provider not in _limiters:
+            _limiters[provider] = ProviderLimiter(provider, _concurrency_limits().get(provider, LLM_DEFAULT_CONCURRENCY))
+        return _limiters[provider]
+
+
+def limiter_stats() -> Dict[str, Any]:
+    stats = {}
+    for name, limiter in list(_limiters.items()):
+        key = re.sub(r'\W+', '_', name).strip('_').lower()
+        stats[key + '_in_flight'] = limiter.in_flight
+        stats[key + '_rejected'] = limiter.rejected
+    return stats
+
+
+metrics.register_collector('llm_provider', limiter_stats)
+
+
+class _TokenTracker:
+    """
+    Passes callbacks through to the run manager and notes whether any token was streamed,
+    since a provider that failed mid-answer can't be replaced without repeating text.
+    """
+
+    def __init__(self, run_manager):
+        self._run_manager = run_manager
+        self.streamed = False
+
+    def on_llm_new_token(self, *args: Any, **kwargs: Any):
+        self.streamed = True
+        return self._run_manager.on_llm_new_token(*args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._run_manager, name)
+
+
+class RoutedChatModel(BaseChatModel):
+    """
+    Chat model that sends each request to the first of `providers`, under that provider's concurrency limit.
+
+    If the first provider fails (errors, rate limits, no free slot) the next one is tried. With `hedge_after`
+    set, a non-streaming request still unanswered after that many seconds is also sent to the second provider,
+    and whichever answers first wins. The losing request is cancelled; on the sync path a request already
+    running on its thread can't be, and holds its provider slot until it returns. Streamed requests are not
+    hedged, and only fall back before the first token. Latency and errors are recorded per provider and role
+    in `llm_request_seconds` and `llm_request_errors_total`.
+    """
+
+    providers: List[Any]
+    provider_names: List[str]
+    role: str = 'answer'
+    hedge_after: float = LLM_HEDGE_AFTER
+
+    @property
+    def _llm_type(self) -> str:
+        return 'routed:' + ','.join(self.provider_names)
+
+    @property
+    def streaming(self) -> bool:
+        return bool(getattr(self.providers[0], 'streaming', False))
+
+    def _call(self, i: int, messages: List[BaseMessage], stop: Optional[List[str]], run_manager: Any,
+              **kwargs: Any) -> ChatResult:
+        name = self.provider_names[i]
+        limiter = get_limiter(name)
+        limiter.acquire()
+        try:
+            with metrics.span('llm_request', provider=name, role=self.role):
+                return self.providers[i]._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        finally:
+            limiter.release()
+
+    async def _acall(self, i: int, messages: List[BaseMessage], stop: Optional[List[str]], run_manager: Any,
+                     **kwargs: Any) -> ChatResult:
+        name = self.provider_names[i]
+        limiter = get_limiter(name)
+        await limiter.acquire_async()
+        try:
+            with metrics.span('llm_request', provider=name, role=self.role):
+                return await self.providers[i]._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        finally:
+            limiter.release()
+
+    def _fallback(self, start: int, error: Exception) -> None:
+        print('llm provider ' + self.provider_names[start] + ' failed: ' + str(error))
+        if 'RateLimit' in type(error).__name__ or 'ResourceExhausted' in type(error).__name__:
+            metrics.increment('llm_rate_limited_total', provider=self.provider_names[start], role=self.role)
+        if start + 1 < len(self.providers):
+            metrics.increment('llm_fallbacks_total', provider=self.provider_names[start + 1], role=self.role)
+
+    def _hedging(self, run_manager: Any) -> bool:
+        return self.hedge_after > 0 and len(self.providers) > 1 and not (run_manager is not None and self.streaming)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        if self._hedging(run_manager):
+            return self._generate_hedged(messages, stop, **kwargs)
+
+        tracker = _TokenTracker(run_manager) if run_manager is not None else None
+        for i in range(len(self.providers)):
+            try:
+                return self._call(i, messages, stop, tracker, **kwargs)
+            except Exception as e:
+                if i + 1 == len(self.providers) or (tracker is not None and tracker.streamed):
+                    raise
+                self._fallback(i, e)
+
+    def _generate_hedged(self, messages: List[BaseMessage], stop: Optional[List[str]], **kwargs: Any) -> ChatResult:
+        primary = _hedge_executor.submit(self._call, 0, messages, stop, None, **kwargs)
+        try:
+            return primary.result(timeout=self.hedge_after)
+        except FutureTimeout:
+            metrics.increment('llm_hedges_total', provider=self.provider_names[1], role=self.role)
+        except Exception as e:
+            self._fallback(0, e)
+            return self._call(1, messages, stop, None, **kwargs)
+
+        pending = {primary, _hedge_executor.submit(self._call, 1, messages, stop, None, **kwargs)}
+        error: Optional[Exception] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                # a loser still queued never starts; one already running can't be interrupted on its thread,
+                # so it finishes in the background and holds its provider slot until then
+                for loser in pending:
+                    loser.cancel()
+                return result
+        raise error
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        if self._hedging(run_manager):
+            return await self._agenerate_hedged(messages, stop, **kwargs)
+
+        tracker = _TokenTracker(run_manager) if run_manager is not None else None
+        for i in range(len(self.providers)):
+            try:
+                return await self._acall(i, messages, stop, tracker, **kwargs)
+            except Exception as e:
+                if i + 1 == len(self.providers) or (tracker is not None and tracker.streamed):
+                    raise
+                self._fallback(i, e)
+
+    async def _agenerate_hedged(self, messages: List[BaseMessage], stop: Optional[List[str]],
+                                **kwargs: Any) -> ChatResult:
+        primary = asyncio.ensure_future(self._acall(0, messages, stop, None, **kwargs))
+        try:
+            return await asyncio.wait_for(asyncio.shield(primary), self.hedge_after)
+        except asyncio.TimeoutError:
+            metrics.increment('llm_hedges_total', provider=self.provider_names[1], role=self.role)
+        except Exception as e:
+            self._fallback(0, e)
+            return await self._acall(1, messages, stop, None, **kwargs)
+
+        pending = {primary, asyncio.ensure_future(self._acall(1, messages, stop, None, **kwargs))}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+        finally:
+            # cancelling the loser (or both, if the caller was cancelled) releases its provider slot
+            for loser in pending:
+                loser.cancel()
+        raise error
@@ -0,0 +1,205 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from neo4j import Driver
+from neo4j.exceptions import Neo4jError, ServiceUnavailable, SessionExpired, TransientError
+
+# imported before registering our atexit hook so the drivers are closed after the logs are flushed
+import drivers  # noqa: F401
+from metrics import SIZE_BUCKETS, metrics
+
+# queued after the last row to stop the worker thread
+_STOP = object()
+
+
+class BatchLogWriter:
+    """
+    Background writer for conversation logs.
+
+    Callers `submit` a Cypher query and one parameter row and return immediately.
+    A single worker thread drains the bounded queue and writes consecutive rows for
+    the same query as one `UNWIND $params AS row` transaction, in the spirit of
+    `Neo4jWriter.batch_write`. Because there is one worker and one FIFO queue, writes
+    land in submission order, which keeps the NEXT chain of each conversation intact.
+    """
+
+    def __init__(self, driver: Driver, database: Optional[str],
+                 max_queue_size: int = int(os.environ.get('LOG_QUEUE_SIZE', 10000)),
+                 batch_size: int = int(os.environ.get('LOG_BATCH_SIZE', 500)),
+                 flush_interval: float = float(os.environ.get('LOG_FLUSH_INTERVAL', 0.5)),
+                 max_retries: int = 3,
+                 put_timeout: float = 1.0):
+        self.driver = driver
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.put_timeout = put_timeout
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._pending = None
+        self._closed = False
+        self._query_names: Dict[str, str] = {}
+
+        self.submitted = 0
+        self.written = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed = 0
+        self.dropped = 0
+        self.blocked_seconds = 0.0
+        self.max_queue_depth = 0
+
+        self._worker = threading.Thread(target=self._run, name='neo4j-log-writer', daemon=True)
+        self._worker.start()
+
+    def submit(self, cypher_query: str, row: Dict[str, Any], name: str = 'log') -> None:
+        """
+        Queues one parameter row for `cypher_query`, which must read its rows via `UNWIND $params AS row`.
+        If the queue stays full for `put_timeout` seconds the row is dropped and counted in
+        `log_rows_dropped_total`; writing it on the calling thread would overtake queued rows and break
+        the NEXT chain order.
+        `name` labels the write in the metrics.
+        """
+        self._query_names[cypher_query] = name
+        if self._closed:
+            self._write_batch(cypher_query, [row])
+            return
+
+        self.submitted += 1
+        put_timer_start = time.perf_counter()
+        try:
+            self._queue.put((cypher_query, row), timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            metrics.increment('log_rows_dropped_total', query=name)
+            print('log queue full, dropped ' + name + ' row')
+        finally:
+            blocked = time.perf_counter() - put_timer_start
+            self.blocked_seconds += blocked
+            metrics.observe('log_submit_blocked_seconds', blocked, query=name)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def _next_item(self, timeout: Optional[float]):
+        if self._pending is not None:
+            item, self._pending = self._pending, None
+            return item
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _run(self) -> None:
+        while True:
+            item = self._next_item(timeout=None)
+            if item is _STOP:
+                return
+
+            cypher_query, row = item
+            rows = [row]
+            deadline = time.monotonic() + self.flush_interval
+            # coalesce consecutive rows for the same query until the batch is full or the interval elapses
+            while len(rows) < self.batch_size:
+                next_item = self._next_item(timeout=max(deadline - time.monotonic(), 0))
+                if next_item is None:
+                    break
+                if next_item is _STOP or next_item[0] != cypher_query:
+                    self._pending = next_item
+                    break
+                rows.append(next_item[1])
+
+            try:
+                self._write_batch(cypher_query, rows)
+            finally:
+                # flush() and the atexit hook wait on these, so they must happen even if the write raised
+                for _ in rows:
+                    self._queue.task_done()
+
+    def _write_batch(self, cypher_query: str, rows: List[Dict[str, Any]]) -> None:
+        packaged_params = {'params': rows}
+        name = self._query_names.get(cypher_query, 'log')
+        metrics.observe('log_batch_rows', len(rows), buckets=SIZE_BUCKETS, query=name)
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.span('log_write', query=name):
+                    with self.driver.session(database=self.database) as session:
+                        session.execute_write(lambda tx: tx.run(cypher_query, parameters=packaged_params).consume())
+                self.written += len(rows)
+                self.batches += 1
+                return
+            except (TransientError, ServiceUnavailable, SessionExpired) as err:
+                if attempt == self.max_retries:
+                    print(err)
+                    break
+                self.retries += 1
+                time.sleep(0.1 * 2 ** attempt)
+            except Neo4jError as err:
+                print(err)
+                break
+            except Exception as err:
+                # e.g. a DriverError or unserializable parameters: drop the batch, keep the worker alive
+                print('log batch failed: ' + repr(err))
+                break
+        self.failed += len(rows)
+
+    def flush(self) -> None:
+        """
+        Blocks until every queued row has been written.
+        """
+        self._queue.join()
+
+    def close(self) -> None:
+        """
+        Writes all queued rows and stops the worker thread.
+        """
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._queue.put(_STOP)
+        self._worker.join()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': self._queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'submitted': self.submitted,
+            'written': self.written,
+            'batches': self.batches,
+            'avg_batch_size': self.written / self.batches if self.batches else 0.0,
+            'retries': self.retries,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'blocked_seconds': self.blocked_seconds,
+        }
+
+
+_writers: Dict[Tuple[int, Optional[str]], BatchLogWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_log_writer(driver: Driver, database: Optional[str]) -> BatchLogWriter:
+    """
+    Returns the process-wide log writer for the given driver and database.
+    """
+    key = (id(driver), database)
+    with _writers_lock:
+        if key not in _writers:
+            _writers[key] = BatchLogWriter(driver, database)
+            metrics.register_collector('log_writer_' + str(len(_writers)), _writers[key].stats)
+        return _writers[key]
+
+
+def close_log_writers():
+    """
+    Flush and stop all log writers. Runs at interpreter shutdown before `drivers.close_drivers`.
+    """
+    with _writers_lock:
+        for writer in _writers.values():
+            writer.close()
+
+
+atexit.register(close_log_writers)
@@ -0,0 +1,212 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain.chains import LLMChain
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain.pydantic_v1 import PrivateAttr
+from langchain.schema import BaseMessage, messages_from_dict, messages_to_dict, get_buffer_string
+from langchain.schema.language_model import BaseLanguageModel
+
+from metrics import metrics
+
+# shared by every conversation; summarization never runs on the request thread
+_summary_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('MEMORY_SUMMARY_WORKERS', 2)),
+                                       thread_name_prefix='memory-summary')
+
+
+def _encoding():
+    import tiktoken
+
+    return tiktoken.get_encoding('cl100k_base')
+
+
+def _count_tokens(text: str) -> int:
+    return len(_encoding().encode(text))
+
+
+class RollingSummaryMemory(BaseChatMemory):
+    """
+    Conversation memory that keeps the last `k` exchanges verbatim, within `max_token_limit`
+    tiktoken tokens, and folds older ones into a running summary.
+
+    Unlike ConversationSummaryBufferMemory, evicted turns are summarized by a background
+    worker after the answer has been returned, so no user turn waits on a summarization call.
+    Until a summary covering them is ready, evicted turns stay in the history verbatim as far as
+    the token limit allows; the oldest are left out first.
+    When the chain's inputs include `question_key`, only that value is remembered as the user's
+    message, not the whole assembled prompt; `history_tokens_key` lowers the token limit for one call.
+    """
+
+    llm: BaseLanguageModel
+    k: int = int(os.environ.get('MEMORY_WINDOW_TURNS', 3))
+    max_token_limit: int = int(os.environ.get('MEMORY_MAX_TOKENS', 1000))
+    question_key: str = "question"
+    history_tokens_key: str = "history_tokens"
+    moving_summary_buffer: str = ""
+    memory_key: str = "history"
+    human_prefix: str = "Human"
+    ai_prefix: str = "AI"
+    summaries: int = 0
+    summary_seconds_total: float = 0.0
+
+    _pending: List[BaseMessage] = PrivateAttr(default_factory=list)
+    _state_lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _summary_lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def _render(self, summary: str, messages: List[BaseMessage]) -> str:
+        history = get_buffer_string(messages, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)
+        if summary:
+            history = "Summary of earlier conversation: " + summary + "\n" + history
+        return history
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        with self._state_lock:
+            messages = self._pending + self.chat_memory.messages
+            summary = self.moving_summary_buffer
+        max_tokens = min(self.max_token_limit, inputs.get(self.history_tokens_key, self.max_token_limit))
+        history = self._render(summary, messages)
+        # unsummarized turns are the oldest and go first; a single oversized message is cut from the front
+        while messages and _count_tokens(history) > max_tokens:
+            messages = messages[1:]
+            history = self._render(summary, messages)
+        if _count_tokens(history) > max_tokens:
+            history = _encoding().decode(_encoding().encode(history)[-max_tokens:]) if max_tokens > 0 else ""
+        return {self.memory_key: history}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        if self.question_key in inputs:
+            inputs = {self.question_key: inputs[self.question_key]}
+        super().save_context(inputs, outputs)
+        with self._state_lock:
+            messages = self.chat_memory.messages
+            overflow = max(len(messages) - 2 * self.k, 0)
+            # exchanges past the token limit are summarized too; the latest exchange always stays
+            while overflow < len(messages) - 2 and \
+                    _count_tokens(get_buffer_string(messages[overflow:])) > self.max_token_limit:
+                overflow += 2
+            if overflow <= 0:
+                return
+            self._pending.extend(self.chat_memory.messages[:overflow])
+            self.chat_memory.messages = self.chat_memory.messages[overflow:]
+        _summary_executor.submit(self._summarize_pending)
+
+    def _summarize_pending(self) -> None:
+        # one summarization per memory at a time, so summaries are folded in order
+        with self._summary_lock:
+            with self._state_lock:
+                batch = list(self._pending)
+                summary = self.moving_summary_buffer
+            if not batch:
+                return
+
+            summary_timer_start = time.perf_counter()
+            try:
+                new_summary = LLMChain(llm=self.llm, prompt=SUMMARY_PROMPT).predict(
+                    summary=summary,
+                    new_lines=get_buffer_string(batch, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix))
+            except Exception as e:
+                # the turns stay pending and are retried with the next eviction
+                print(e)
+                metrics.increment('memory_summarization_errors_total')
+                return
+
+            with self._state_lock:
+                self.moving_summary_buffer = new_summary
+                del self._pending[:len(batch)]
+            elapsed = time.perf_counter() - summary_timer_start
+            self.summaries += 1
+            self.summary_seconds_total += elapsed
+            metrics.observe('memory_summarization_seconds', elapsed)
+
+    def is_empty(self) -> bool:
+        """
+        Whether the conversation has no history yet: no summary and no exchanges, summarized or not.
+        """
+        with self._state_lock:
+            return not (self.moving_summary_buffer or self._pending or self.chat_memory.messages)
+
+    def clear(self) -> None:
+        super().clear()
+        with self._state_lock:
+            self._pending.clear()
+            self.moving_summary_buffer = ""
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Serializable snapshot of the summary, the unsummarized turns and the window.
+        """
+        with self._state_lock:
+            return {
+                'summary': self.moving_summary_buffer,
+                'pending': messages_to_dict(self._pending),
+                'messages': messages_to_dict(self.chat_memory.messages),
+            }
+
+    @classmethod
+    def from_dict(cls, llm: BaseLanguageModel, data: Optional[Dict[str, Any]], **kwargs: Any) -> 'RollingSummaryMemory':
+        memory = cls(llm=llm, **kwargs)
+        if data:
+            memory.moving_summary_buffer = data.get('summary', "")
+            memory._pending = messages_from_dict(data.get('pending', []))
+            memory.chat_memory.messages = messages_from_dict(data.get('messages', []))
+            if memory._pending:
+                _summary_executor.submit(memory._summarize_pending)
+        return memory
+
+
+class MemoryStore:
+    """
+    Process-wide store of memory snapshots keyed by conversation, so a conversation's memory
+    survives the Streamlit session state being rebuilt.
+
+    Keeps the `max_size` most recently saved conversations, each for at most `ttl` seconds
+    after its last save, since abandoned sessions are never deleted explicitly.
+    """
+
+    def __init__(self, max_size: int = int(os.environ.get('MEMORY_STORE_SIZE', 1000)),
+                 ttl: float = float(os.environ.get('MEMORY_STORE_TTL', 3600))):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._snapshots: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.ttl
+        # oldest save first, so expired entries are at the front
+        while self._snapshots and next(iter(self._snapshots.values()))[0] < cutoff:
+            self._snapshots.popitem(last=False)
+
+    def save(self, key: str, memory: RollingSummaryMemory) -> None:
+        snapshot = memory.to_dict()
+        with self._lock:
+            self._snapshots[key] = (time.monotonic(), snapshot)
+            self._snapshots.move_to_end(key)
+            self._expire()
+            while len(self._snapshots) > self.max_size:
+                self._snapshots.popitem(last=False)
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._expire()
+            entry = self._snapshots.get(key)
+            return entry[1] if entry is not None else None
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._snapshots.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'size': len(self._snapshots)}
+
+
+memory_store = MemoryStore()
+metrics.register_collector('memory_store', memory_store.stats)
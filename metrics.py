@@ -0,0 +1,249 @@
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+# latency buckets in seconds, from cache lookups up to slow LLM calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# count buckets for row, token and batch sizes
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# labels that are written to the JSONL sink but kept out of Prometheus series to bound their number
+HIGH_CARDINALITY_LABELS = ('session',)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """
+    Prometheus-style cumulative histogram that also keeps a window of recent samples for quantiles.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window: int = 2048):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class MetricsRegistry:
+    """
+    Process-wide histograms and counters, with spans for timing request stages.
+
+    Every observation can be appended to a JSONL file (`METRICS_JSONL_PATH`) and all series
+    are served in the Prometheus text format by `start_exporter` (`METRICS_PORT`).
+    JSONL events are buffered in memory and appended by a background thread every
+    `jsonl_flush_interval` seconds; events beyond `jsonl_buffer_size` unflushed ones are dropped.
+    """
+
+    def __init__(self, jsonl_path: Optional[str] = os.environ.get('METRICS_JSONL_PATH'),
+                 jsonl_flush_interval: float = float(os.environ.get('METRICS_JSONL_FLUSH_INTERVAL', 1.0)),
+                 jsonl_buffer_size: int = int(os.environ.get('METRICS_JSONL_BUFFER_SIZE', 100000))):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self._jsonl_path = jsonl_path
+        self.jsonl_flush_interval = jsonl_flush_interval
+        self.jsonl_buffer_size = jsonl_buffer_size
+        self._jsonl_lock = threading.Lock()
+        self._jsonl_flush_lock = threading.Lock()
+        self._jsonl_buffer: List[Dict[str, Any]] = []
+        self._jsonl_worker: Optional[threading.Thread] = None
+        self.jsonl_written = 0
+        self.jsonl_dropped = 0
+        self._server: Optional[ThreadingHTTPServer] = None
+        if jsonl_path:
+            self.register_collector('metrics_jsonl', self.jsonl_stats)
+
+    @staticmethod
+    def _series_key(labels: Dict[str, Any]) -> LabelKey:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()
+                            if k not in HIGH_CARDINALITY_LABELS and v is not None))
+
+    def observe(self, name: str, value: float, buckets=DEFAULT_BUCKETS, **labels: Any) -> None:
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            key = self._series_key(labels)
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+        self._write_jsonl({'type': 'histogram', 'name': name, 'value': value, 'labels': labels})
+
+    def increment(self, name: str, value: float = 1, **labels: Any) -> None:
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            key = self._series_key(labels)
+            series[key] = series.get(key, 0) + value
+        self._write_jsonl({'type': 'counter', 'name': name, 'value': value, 'labels': labels})
+
+    @contextmanager
+    def span(self, name: str, **labels: Any):
+        """
+        Times the enclosed block into the `<name>_seconds` histogram and counts
+        exceptions raised inside it in `<name>_errors_total`.
+        """
+        span_timer_start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment(name + '_errors_total', **labels)
+            raise
+        finally:
+            self.observe(name + '_seconds', time.perf_counter() - span_timer_start, **labels)
+
+    def register_collector(self, name: str, collector: Callable[[], Dict[str, Any]]) -> None:
+        """
+        Registers a callable returning a flat dict of numbers (e.g. a cache's `stats`),
+        exported as gauges named `<name>_<key>`.
+        """
+        self._collectors[name] = collector
+
+    def _write_jsonl(self, event: Dict[str, Any]) -> None:
+        if not self._jsonl_path:
+            return
+        event['ts'] = time.time()
+        # observations only append to the buffer; serializing and file IO happen on the flush thread
+        with self._jsonl_lock:
+            if len(self._jsonl_buffer) >= self.jsonl_buffer_size:
+                self.jsonl_dropped += 1
+                return
+            self._jsonl_buffer.append(event)
+            if self._jsonl_worker is None:
+                self._jsonl_worker = threading.Thread(target=self._run_jsonl, name='metrics-jsonl', daemon=True)
+                self._jsonl_worker.start()
+                atexit.register(self.flush_jsonl)
+
+    def _run_jsonl(self) -> None:
+        while True:
+            time.sleep(self.jsonl_flush_interval)
+            self.flush_jsonl()
+
+    def flush_jsonl(self) -> None:
+        """
+        Appends the buffered events to `METRICS_JSONL_PATH`, one JSON line each.
+        """
+        with self._jsonl_flush_lock:
+            with self._jsonl_lock:
+                events, self._jsonl_buffer = self._jsonl_buffer, []
+            if not events:
+                return
+            lines = ''.join(json.dumps(event, default=str) + '\n' for event in events)
+            try:
+                with open(self._jsonl_path, 'a') as sink:
+                    sink.write(lines)
+            except OSError as e:
+                print('metrics jsonl flush failed: ' + repr(e))
+                with self._jsonl_lock:
+                    self.jsonl_dropped += len(events)
+                return
+            self.jsonl_written += len(events)
+
+    def jsonl_stats(self) -> Dict[str, Any]:
+        return {
+            'buffered': len(self._jsonl_buffer),
+            'written': self.jsonl_written,
+            'dropped': self.jsonl_dropped,
+        }
+
+    def summary(self, name: str) -> Dict[LabelKey, Dict[str, float]]:
+        """
+        Count, mean, p50, p95 and p99 per label set for a histogram.
+        """
+        with self._lock:
+            return {key: {'count': h.count, 'mean': h.sum / h.count if h.count else 0.0,
+                          'p50': h.quantile(0.5), 'p95': h.quantile(0.95), 'p99': h.quantile(0.99)}
+                    for key, h in self._histograms.get(name, {}).items()}
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = []
+
+        def fmt(labels: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ''
+            return '{' + ','.join(k + '="' + v.replace('"', '\\"') + '"' for k, v in pairs) + '}'
+
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                lines.append('# TYPE ' + name + ' histogram')
+                for labels, h in series.items():
+                    cumulative = 0
+                    for bound, count in zip(h.buckets + (float('inf'),), h.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else str(bound)
+                        lines.append(name + '_bucket' + fmt(labels, (('le', le),)) + ' ' + str(cumulative))
+                    lines.append(name + '_sum' + fmt(labels) + ' ' + str(h.sum))
+                    lines.append(name + '_count' + fmt(labels) + ' ' + str(h.count))
+            for name, series in sorted(self._counters.items()):
+                lines.append('# TYPE ' + name + ' counter')
+                for labels, value in series.items():
+                    lines.append(name + fmt(labels) + ' ' + str(value))
+
+        for prefix, collector in sorted(self._collectors.items()):
+            try:
+                values = collector()
+            except Exception as e:
+                print(e)
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('# TYPE ' + prefix + '_' + key + ' gauge')
+                    lines.append(prefix + '_' + key + ' ' + str(value))
+        return '\n'.join(lines) + '\n'
+
+    def start_exporter(self, port: Optional[int] = None) -> None:
+        """
+        Serves `/metrics` on `port` (default `METRICS_PORT`) from a daemon thread. Safe to call repeatedly.
+        """
+        port = port or int(os.environ.get('METRICS_PORT', 0))
+        if not port or self._server is not None:
+            return
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render_prometheus().encode()
+                self.send_response(200 if self.path.startswith('/metrics') else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        with self._lock:
+            if self._server is not None:
+                return
+            try:
+                self._server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+            except OSError as e:
+                # another process in the container already serves this port
+                print(e)
+                return
+        threading.Thread(target=self._server.serve_forever, name='metrics-exporter', daemon=True).start()
+        print('metrics exporter listening on port ' + str(port))
+
+
+metrics = MetricsRegistry()
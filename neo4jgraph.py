@@ -0,0 +1,20 @@
+from typing import Tuple
+
+from langchain.graphs import Neo4jGraph
+from neo4j import Driver
+
+
+class SharedNeo4jGraph(Neo4jGraph):
+    """
+    Neo4jGraph that borrows a driver from the shared pool in `drivers`.
+
+    The stock Neo4jGraph opens its own driver and introspects the schema in its
+    constructor; here both are left to the shared driver pool and the schema cache.
+    """
+
+    def __init__(self, driver: Driver, database: str, cache_key: Tuple[str, str]):
+        self._driver = driver
+        self._database = database
+        self.schema: str = ""
+        self.structured_schema = {}
+        self.cache_key = cache_key
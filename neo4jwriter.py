@@ -1,19 +1,26 @@
-from typing import List, Any, Dict, Iterator, Callable, Union
+from typing import List, Any, Dict, Iterator, Iterable, Optional
+import itertools
 import os
-from neo4j import GraphDatabase, Transaction
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from neo4j import Transaction
 
+import drivers
 
 
 class Neo4jWriter:
     def __init__(self, neo4j_url: str = os.environ.get("NEO4J_URI"),
                  neo4j_user: str = os.environ.get("NEO4J_USER"),
                  neo4j_password: str = os.environ.get("NEO4J_PASSWORD"),
-                 database: str = os.environ.get("NEO4J_DATABASE")):
+                 database: str = os.environ.get("NEO4J_DATABASE"),
+                 driver=None):
 
-        self.driver = GraphDatabase.driver(neo4j_url, auth=(neo4j_user, neo4j_password))
+        self.driver = driver or drivers.init_driver(neo4j_url, username=neo4j_user, password=neo4j_password,
+                                                    database=database)
         self.database = database
 
-    def batch_write(self, cypher_query: str, params: List[Dict[str, Any]], batch_size: int = 10000):
+    def batch_write(self, cypher_query: str, params: Iterable[Dict[str, Any]], batch_size: int = 10000):
         with self.driver.session(database=self.database) as session:
             for batch in Neo4jWriter._batch_parameters(params, batch_size):
                 packaged_params = {'params': batch}
@@ -21,15 +28,120 @@ class Neo4jWriter:
                                                                 params=packaged_params)
                 session.execute_write(tx_function)
 
-    def neo4j_tx_function(self, tx: Transaction, params: List[Dict[str, Any]], cypher_query: str) -> None:
-        tx.run(cypher_query, parameters=params)
+    def bulk_write(self, cypher_query: str, rows: Iterable[Dict[str, Any]], batch_size: int = 10000,
+                   workers: int = 4, indexes: Optional[List[str]] = None, adaptive: bool = True,
+                   target_batch_seconds: float = 2.0, progress_every: float = 10.0) -> Dict[str, Any]:
+        """
+        Streams `rows` into Neo4j with `cypher_query`, which reads its rows via `UNWIND $params AS row`.
 
-    def build_indexes(self, index_list=List[str]):
-        for index in index_list:
-            tx_function = lambda tx: self.neo4j_tx_function(tx, [], index)
-            self.session.execute_write(tx_function)
+        `rows` may be any iterator or generator (see `read_csv` and `read_parquet`); it is consumed
+        one batch at a time and never materialized. Batches are written concurrently on `workers`
+        sessions, with at most `2 * workers` batches in flight. With `adaptive` on, the batch size is
+        scaled towards `target_batch_seconds` per transaction after every batch, full or not. Deadlocks and
+        other transient errors are retried by the driver's managed transactions (`execute_write`) and
+        counted in the report. `indexes` are created before the load starts.
+        Returns a report with row, batch, retry and throughput counts.
+        """
+        if indexes:
+            self.build_indexes(indexes)
+
+        report = {'rows': 0, 'batches': 0, 'retries': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+        lock = threading.Lock()
+        load_timer_start = time.perf_counter()
+        last_progress = load_timer_start
+        current_batch_size = batch_size
+        iterator = iter(rows)
+
+        def write(batch: List[Dict[str, Any]]) -> float:
+            packaged_params = {'params': batch}
+            attempts = []
+
+            def tx_function(tx):
+                # the driver calls this again for every retry of the transaction
+                attempts.append(1)
+                self.neo4j_tx_function(tx=tx, cypher_query=cypher_query, params=packaged_params)
+
+            batch_timer_start = time.perf_counter()
+            with self.driver.session(database=self.database) as session:
+                session.execute_write(tx_function)
+            elapsed = time.perf_counter() - batch_timer_start
+            with lock:
+                report['rows'] += len(batch)
+                report['batches'] += 1
+                report['retries'] += len(attempts) - 1
+            return elapsed
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = {}
+            while True:
+                while len(in_flight) < 2 * workers:
+                    batch = list(itertools.islice(iterator, current_batch_size))
+                    if not batch:
+                        break
+                    in_flight[executor.submit(write, batch)] = len(batch)
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rows_written = in_flight.pop(future)
+                    elapsed = future.result()
+                    if adaptive and elapsed > 0:
+                        # rows that fit the target transaction time at this batch's rate, so partial batches
+                        # count too; at most doubling or halving at once
+                        target_rows = rows_written * target_batch_seconds / elapsed
+                        current_batch_size = max(100, int(min(max(target_rows, current_batch_size / 2),
+                                                              current_batch_size * 2)))
+
+                now = time.perf_counter()
+                if now - last_progress >= progress_every:
+                    last_progress = now
+                    print('bulk write progress: ' + str(report['rows']) + ' rows, '
+                          + str(round(report['rows'] / (now - load_timer_start), 1)) + ' rows/s, batch size '
+                          + str(current_batch_size))
+
+        report['seconds'] = time.perf_counter() - load_timer_start
+        report['rows_per_second'] = report['rows'] / report['seconds'] if report['seconds'] else 0.0
+        report['final_batch_size'] = current_batch_size
+        print('bulk write done: ' + str(report))
+        return report
+
+    def neo4j_tx_function(self, tx: Transaction, params: Dict[str, Any], cypher_query: str) -> None:
+        tx.run(cypher_query, parameters=params).consume()
+
+    def build_indexes(self, index_list: List[str]):
+        """
+        Runs each index or constraint statement, e.g. "CREATE INDEX ... IF NOT EXISTS ...".
+        Schema statements cannot share a transaction with writes, so each runs on its own.
+        """
+        with self.driver.session(database=self.database) as session:
+            for index in index_list:
+                session.execute_write(lambda tx: self.neo4j_tx_function(tx=tx, params={}, cypher_query=index))
+            session.run("CALL db.awaitIndexes()").consume()
+
+    @staticmethod
+    def read_csv(path: str, block_size: int = 1 << 24) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the rows of a CSV file as dicts, reading it in blocks of `block_size` bytes.
+        """
+        from pyarrow import csv
+
+        reader = csv.open_csv(path, read_options=csv.ReadOptions(block_size=block_size))
+        for record_batch in reader:
+            yield from record_batch.to_pylist()
+
+    @staticmethod
+    def read_parquet(path: str, batch_size: int = 65536) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the rows of a Parquet file as dicts, reading `batch_size` rows at a time.
+        """
+        import pyarrow.parquet as pq
+
+        for record_batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield from record_batch.to_pylist()
 
     @staticmethod
-    def _batch_parameters(lst: List[Any], batch_size: int) -> Iterator[List[Any]]:
-        for i in range(0, len(lst), batch_size):
-            yield lst[i:i + batch_size]
\ No newline at end of file
+    def _batch_parameters(params: Iterable[Any], batch_size: int) -> Iterator[List[Any]]:
+        iterator = iter(params)
+        while batch := list(itertools.islice(iterator, batch_size)):
+            yield batch
@@ -0,0 +1,221 @@
+import ast
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# context window per selectable LLM, in tokens
+MODEL_CONTEXT_TOKENS = {
+    "GPT-4 8k": 8192,
+    "chat-bison 2k": 8192,
+    "chat-bison 32k": 32768,
+}
+
+
+def _keywords(text: str) -> Set[str]:
+    """
+    Lower-cased word stems of `text`, splitting camelCase and snake_case identifiers.
+    """
+    words = re.findall(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+', text)
+    return {word.lower().rstrip('s') for word in words if len(word) > 1}
+
+
+class SchemaIndex:
+    """
+    Keyword index over the labels, relationship types and properties of a graph schema.
+
+    Built once per schema version and used to prune the schema to the elements a question mentions.
+    """
+
+    def __init__(self, node_props: Dict[str, List[Dict[str, str]]], rel_props: Dict[str, List[Dict[str, str]]],
+                 relationships: List[Dict[str, str]]):
+        self.node_props = node_props
+        self.rel_props = rel_props
+        self.relationships = relationships
+        self.label_keywords = {label: _keywords(label) | set().union(*[_keywords(p['property']) for p in props])
+                               for label, props in node_props.items()}
+        self.rel_keywords = {rel_type: _keywords(rel_type) for rel_type in
+                             {rel['type'] for rel in relationships} | set(rel_props)}
+
+    @classmethod
+    def from_graph(cls, graph) -> Optional['SchemaIndex']:
+        structured = getattr(graph, 'structured_schema', None)
+        if structured and structured.get('node_props'):
+            return cls(structured['node_props'], structured.get('rel_props', {}), structured.get('relationships', []))
+        return cls.from_schema_text(graph.schema)
+
+    @classmethod
+    def from_schema_text(cls, schema: str) -> Optional['SchemaIndex']:
+        """
+        Parses the schema string produced by `Neo4jGraph.refresh_schema`. Returns None if it cannot be parsed.
+        """
+        try:
+            sections = [ast.literal_eval(line.strip()) for line in schema.splitlines()
+                        if line.strip().startswith('[')]
+            node_list, rel_prop_list, rel_list = sections
+        except (ValueError, SyntaxError):
+            return None
+
+        node_props = {el['labels']: el['properties'] for el in node_list}
+        rel_props = {el['type']: el['properties'] for el in rel_prop_list}
+        relationships = []
+        for rel in rel_list:
+            match = re.match(r'\(:(\w+)\)-\[:(\w+)\]->\(:(\w+)\)', rel)
+            if match:
+                relationships.append({'start': match.group(1), 'type': match.group(2), 'end': match.group(3)})
+        return cls(node_props, rel_props, relationships)
+
+    def prune(self, question: str) -> Optional[str]:
+        """
+        Renders the part of the schema relevant to the question: labels and relationship types
+        sharing a keyword with it, plus their direct neighbours. Returns None if nothing matches.
+        """
+        words = _keywords(question)
+        labels = {label for label, keywords in self.label_keywords.items() if keywords & words}
+        rel_types = {rel_type for rel_type, keywords in self.rel_keywords.items() if keywords & words}
+        if not labels and not rel_types:
+            return None
+
+        relationships = [rel for rel in self.relationships
+                         if rel['type'] in rel_types or rel['start'] in labels or rel['end'] in labels]
+        for rel in relationships:
+            labels.update((rel['start'], rel['end']))
+            rel_types.add(rel['type'])
+
+        node_lines = [label + ' {' + ', '.join(p['property'] + ': ' + p['type'] for p in self.node_props[label]) + '}'
+                      for label in sorted(labels) if label in self.node_props]
+        rel_prop_lines = [rel_type + ' {' + ', '.join(p['property'] + ': ' + p['type'] for p in props) + '}'
+                          for rel_type, props in sorted(self.rel_props.items()) if rel_type in rel_types]
+        rel_lines = ['(:' + rel['start'] + ')-[:' + rel['type'] + ']->(:' + rel['end'] + ')' for rel in relationships]
+        return ("Node properties:\n" + '\n'.join(node_lines)
+                + "\nRelationship properties:\n" + '\n'.join(rel_prop_lines)
+                + "\nThe relationships:\n" + '\n'.join(rel_lines))
+
+
+class PromptAssembler:
+    """
+    Builds the answer synthesis prompt within the selected model's context window.
+
+    The schema is pruned to the question. Conversation history gets at most `history_tokens`, and less if
+    that would leave the query results under `min_result_tokens`. The remaining window after the answer
+    reservation and history is shared out between the query results, retrieved documents (at most
+    `document_tokens`), schema and example questions, in that order of priority, using tiktoken counts.
+    """
+
+    def __init__(self, context_tokens: int, answer_tokens: int = int(os.environ.get('PROMPT_ANSWER_TOKENS', 1024)),
+                 document_tokens: int = int(os.environ.get('PROMPT_DOCUMENT_TOKENS', 1500)),
+                 history_tokens: int = int(os.environ.get('PROMPT_HISTORY_TOKENS', 1000)),
+                 min_result_tokens: int = int(os.environ.get('PROMPT_MIN_RESULT_TOKENS', 500)),
+                 encoding_name: str = 'cl100k_base'):
+        import tiktoken
+
+        self.context_tokens = context_tokens
+        self.answer_tokens = answer_tokens
+        self.document_tokens = document_tokens
+        self.history_tokens = history_tokens
+        self.min_result_tokens = min_result_tokens
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self._indexes: Dict[Tuple[Any, int], Optional[SchemaIndex]] = {}
+        self._lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if max_tokens <= 0:
+            return ""
+        tokens = self.encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        # the marker counts against the budget too
+        marker = "\n(truncated)"
+        if max_tokens <= self.count(marker):
+            return ""
+        return self.encoding.decode(tokens[:max(max_tokens - self.count(marker), 0)]) + marker
+
+    def prune_schema(self, question: str, graph, schema_version: int) -> str:
+        """
+        Returns the schema pruned to the question, or the full schema if it cannot be pruned.
+        """
+        key = (getattr(graph, 'cache_key', id(graph)), schema_version)
+        with self._lock:
+            if key not in self._indexes:
+                self._indexes = {k: v for k, v in self._indexes.items() if k[0] != key[0]}
+                self._indexes[key] = SchemaIndex.from_graph(graph)
+            index = self._indexes[key]
+        pruned = index.prune(question) if index is not None else None
+        return pruned if pruned is not None else graph.schema
+
+    def assemble(self, question: str, schema: str, example_questions: List[str], results: str,
+                 history_tokens: int = 0, documents: str = "") -> Tuple[str, Dict[str, int]]:
+        """
+        Returns the prompt and its per-section token breakdown. `history_tokens` is the size of the conversation
+        history; the breakdown's 'history' is the part of it allotted, which the history must be cut to.
+        Raises ValueError if the question and the answer reservation alone exceed the context window.
+        """
+        template = """
+            Task: Generate Cypher statement to query a graph database.
+            Schema: {schema}
+            Example Questions: {examples}
+            The question is: {question}
+            Graph Query Results: {results}
+            Related Documents: {documents}
+            Answer the question using the graph query results and related documents.
+            Provide explanations or sources if available.
+        """
+        fixed_tokens = self.count(template.format(schema='', examples='', question=question, results='',
+                                                  documents=''))
+        available = self.context_tokens - self.answer_tokens - fixed_tokens
+        if available < 0:
+            raise ValueError('question too long: ' + str(fixed_tokens) + ' prompt tokens leave no room for the answer '
+                             'within ' + str(self.context_tokens))
+        history_tokens = max(min(history_tokens, self.history_tokens, available - self.min_result_tokens), 0)
+        available -= history_tokens
+
+        results = self.truncate(results, available)
+        results_tokens = self.count(results)
+        available -= results_tokens
+
+        documents = self.truncate(documents or "(none)", min(available, self.document_tokens))
+        documents_tokens = self.count(documents)
+        available -= documents_tokens
+
+        schema = self.truncate(schema, available)
+        schema_tokens = self.count(schema)
+        available -= schema_tokens
+
+        examples = []
+        examples_tokens = 0
+        for example in example_questions:
+            example_tokens = self.count(example) + 1
+            if examples_tokens + example_tokens > available:
+                break
+            examples.append(example)
+            examples_tokens += example_tokens
+
+        breakdown = {
+            'fixed': fixed_tokens,
+            'schema': schema_tokens,
+            'examples': examples_tokens,
+            'results': results_tokens,
+            'documents': documents_tokens,
+            'history': history_tokens,
+            'answer_reserved': self.answer_tokens,
+            'context_limit': self.context_tokens,
+        }
+        prompt = template.format(schema=schema, examples=', '.join(examples), question=question, results=results,
+                                 documents=documents)
+        return prompt, breakdown
+
+
+_assemblers: Dict[int, PromptAssembler] = {}
+
+
+def get_prompt_assembler(llm_type: str) -> PromptAssembler:
+    """
+    Returns the shared prompt assembler for the context window of `llm_type`.
+    """
+    context_tokens = MODEL_CONTEXT_TOKENS.get(llm_type, 8192)
+    if context_tokens not in _assemblers:
+        _assemblers[context_tokens] = PromptAssembler(context_tokens)
+    return _assemblers[context_tokens]
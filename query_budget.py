@@ -0,0 +1,160 @@
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from neo4j import READ_ACCESS, AsyncDriver, Driver
+from neo4j.exceptions import ClientError, CypherSyntaxError
+
+# server error codes for a transaction that ran past its timeout, e.g. ...TransactionTimedOutClientConfiguration
+TRANSACTION_TIMED_OUT = 'Neo.ClientError.Transaction.TransactionTimedOut'
+
+
+@dataclass
+class QueryBudget:
+    """
+    Limits applied while streaming the records of a generated query.
+    """
+    max_rows: int = int(os.environ.get('QUERY_MAX_ROWS', 200))
+    max_bytes: int = int(os.environ.get('QUERY_MAX_BYTES', 1 << 20))
+    max_seconds: float = float(os.environ.get('QUERY_MAX_SECONDS', 10))
+    max_tokens: int = int(os.environ.get('QUERY_RESULT_TOKENS', 1500))
+
+
+@dataclass
+class BudgetedResult:
+    records: List[Dict[str, Any]] = field(default_factory=list)
+    rows_scanned: int = 0
+    bytes_scanned: int = 0
+    truncated_by: Optional[str] = None
+    query_seconds: float = 0.0
+    table: str = ""
+    rows_kept: int = 0
+    table_tokens: int = 0
+    serialization_seconds: float = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'rows_scanned': self.rows_scanned,
+            'rows_kept': self.rows_kept,
+            'bytes_scanned': self.bytes_scanned,
+            'truncated_by': self.truncated_by,
+            'table_tokens': self.table_tokens,
+            'query_seconds': self.query_seconds,
+            'serialization_seconds': self.serialization_seconds,
+        }
+
+
+def run_budgeted(driver: Driver, database: Optional[str], cypher: str, params: Dict[str, Any],
+                 budget: QueryBudget) -> BudgetedResult:
+    """
+    Streams the records of `cypher` and stops as soon as the row, byte or time budget is spent.
+    The query runs in a read transaction with a server-side timeout of `budget.max_seconds`, which also
+    bounds the wait for the first record; a server timeout keeps the records read so far, truncated by time.
+    Stopping early rolls the transaction back, which cancels the query on the server.
+    """
+    result = BudgetedResult()
+    query_timer_start = time.perf_counter()
+    # read access routes the query to a reader on a cluster and has the server reject writes
+    with driver.session(database=database, default_access_mode=READ_ACCESS,
+                        fetch_size=min(budget.max_rows, 1000)) as session:
+        tx = session.begin_transaction(timeout=budget.max_seconds)
+        try:
+            for record in tx.run(cypher, params):
+                row = record.data()
+                result.rows_scanned += 1
+                result.bytes_scanned += len(json.dumps(row, default=str))
+                result.records.append(row)
+                if result.rows_scanned >= budget.max_rows:
+                    result.truncated_by = 'rows'
+                elif result.bytes_scanned >= budget.max_bytes:
+                    result.truncated_by = 'bytes'
+                elif time.perf_counter() - query_timer_start >= budget.max_seconds:
+                    result.truncated_by = 'time'
+                if result.truncated_by is not None:
+                    break
+        except CypherSyntaxError as e:
+            raise ValueError(f"Generated Cypher Statement is not valid\n{e}")
+        except ClientError as e:
+            if not (e.code or '').startswith(TRANSACTION_TIMED_OUT):
+                raise
+            result.truncated_by = 'time'
+        finally:
+            # read-only: rolling back releases the transaction and cancels any unread remainder
+            tx.close()
+    result.query_seconds = time.perf_counter() - query_timer_start
+    return result
+
+
+async def run_budgeted_async(driver: AsyncDriver, database: Optional[str], cypher: str, params: Dict[str, Any],
+                             budget: QueryBudget) -> BudgetedResult:
+    """
+    `run_budgeted` for the async driver: records are streamed without blocking the event loop.
+    """
+    result = BudgetedResult()
+    query_timer_start = time.perf_counter()
+    async with driver.session(database=database, default_access_mode=READ_ACCESS,
+                              fetch_size=min(budget.max_rows, 1000)) as session:
+        tx = await session.begin_transaction(timeout=budget.max_seconds)
+        try:
+            async for record in await tx.run(cypher, params):
+                row = record.data()
+                result.rows_scanned += 1
+                result.bytes_scanned += len(json.dumps(row, default=str))
+                result.records.append(row)
+                if result.rows_scanned >= budget.max_rows:
+                    result.truncated_by = 'rows'
+                elif result.bytes_scanned >= budget.max_bytes:
+                    result.truncated_by = 'bytes'
+                elif time.perf_counter() - query_timer_start >= budget.max_seconds:
+                    result.truncated_by = 'time'
+                if result.truncated_by is not None:
+                    break
+        except CypherSyntaxError as e:
+            raise ValueError(f"Generated Cypher Statement is not valid\n{e}")
+        except ClientError as e:
+            if not (e.code or '').startswith(TRANSACTION_TIMED_OUT):
+                raise
+            result.truncated_by = 'time'
+        finally:
+            await tx.close()
+    result.query_seconds = time.perf_counter() - query_timer_start
+    return result
+
+
+def _cell(value: Any) -> str:
+    if isinstance(value, str):
+        return value.replace('|', '/').replace('\n', ' ')
+    return json.dumps(value, default=str, separators=(',', ':'))
+
+
+def compact_results(result: BudgetedResult, max_tokens: int, encoding_name: str = 'cl100k_base') -> BudgetedResult:
+    """
+    Renders the records as a pipe-separated table (header once, one line per record) and keeps
+    as many records as fit in `max_tokens` tiktoken tokens. Fills in the table fields of `result`.
+    """
+    import tiktoken
+
+    serialization_timer_start = time.perf_counter()
+    encoding = tiktoken.get_encoding(encoding_name)
+    if not result.records:
+        result.table = "(no results)"
+    else:
+        columns = list(result.records[0].keys())
+        lines = [' | '.join(columns)]
+        tokens = len(encoding.encode(lines[0]))
+        for row in result.records:
+            line = ' | '.join(_cell(row.get(column)) for column in columns)
+            line_tokens = len(encoding.encode(line)) + 1
+            if tokens + line_tokens > max_tokens:
+                break
+            lines.append(line)
+            tokens += line_tokens
+        result.rows_kept = len(lines) - 1
+        result.table_tokens = tokens
+        result.table = '\n'.join(lines)
+        if result.rows_kept < result.rows_scanned or result.truncated_by is not None:
+            result.table += '\n(' + str(result.rows_kept) + ' rows shown, results truncated)'
+    result.serialization_seconds = time.perf_counter() - serialization_timer_start
+    return result
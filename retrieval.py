@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from neo4j.exceptions import ClientError
+
+from metrics import metrics
+
+VECTOR_INDEX_NAME = os.environ.get('VECTOR_INDEX_NAME', 'document_embeddings')
+DOCUMENT_TEXT_PROPERTY = os.environ.get('DOCUMENT_TEXT_PROPERTY', 'text')
+# 'vector_index' queries the Neo4j vector index; 'numpy' searches all Document embeddings in memory
+RETRIEVAL_BACKEND = os.environ.get('RETRIEVAL_BACKEND', 'vector_index')
+# seconds the fallback serves searches before the vector index is tried again
+RETRIEVAL_FALLBACK_TTL = float(os.environ.get('RETRIEVAL_FALLBACK_TTL', 300))
+# codes of errors meaning the index or the vector procedures don't exist, rather than a failed query
+MISSING_INDEX_CODES = ('Neo.ClientError.Procedure.ProcedureNotFound', 'Neo.ClientError.Schema.IndexNotFound')
+
+VECTOR_QUERY = """
+call db.index.vector.queryNodes($indexName, $k, $embedding) yield node, score
+where score >= $minScore
+return node.index as index, node[$textProperty] as text, score
+"""
+
+LOAD_DOCUMENTS_QUERY = """
+match (d:Document)
+where d.embedding is not null
+return d.index as index, d[$textProperty] as text, d.embedding as embedding
+"""
+
+
+class DocumentRetriever(ABC):
+    """
+    Finds the Documents whose embeddings are closest to a question embedding.
+    Results are dicts with the document's `index`, `text` and cosine `score`, best first.
+    """
+
+    def __init__(self, top_k: int = int(os.environ.get('RETRIEVAL_TOP_K', 4)),
+                 min_score: float = float(os.environ.get('RETRIEVAL_MIN_SCORE', 0.7))):
+        self.top_k = top_k
+        self.min_score = min_score
+
+    @abstractmethod
+    def search(self, embedding: List[float]) -> List[Dict[str, Any]]:
+        ...
+
+
+def is_missing_index(error: ClientError) -> bool:
+    """
+    Whether a vector search failed because the index or the vector procedures don't exist.
+    A missing index is reported as a failed procedure call, so that case is told apart by its message.
+    """
+    if error.code in MISSING_INDEX_CODES:
+        return True
+    return (error.code == 'Neo.ClientError.Procedure.ProcedureCallFailed'
+            and 'no such vector schema index' in (error.message or '').lower())
+
+
+class VectorIndexRetriever(DocumentRetriever):
+    """
+    Queries the Neo4j vector index `index_name` over `(:Document {embedding})`.
+    """
+
+    def __init__(self, driver, database: Optional[str], index_name: str = VECTOR_INDEX_NAME, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.driver = driver
+        self.database = database
+        self.index_name = index_name
+
+    def search(self, embedding: List[float]) -> List[Dict[str, Any]]:
+        with self.driver.session(database=self.database) as session:
+            return session.execute_read(lambda tx: [record.data() for record in tx.run(
+                VECTOR_QUERY, indexName=self.index_name, k=self.top_k, embedding=embedding,
+                minScore=self.min_score, textProperty=DOCUMENT_TEXT_PROPERTY)])
+
+
+class LocalVectorRetriever(DocumentRetriever):
+    """
+    Brute-force cosine search over an in-memory matrix of Document embeddings, for tests and
+    databases without a vector index. Documents are loaded from the graph by `load`, or passed to `add`.
+    """
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self._documents: List[Dict[str, Any]] = []
+        self._matrix: Optional[np.ndarray] = None
+
+    def add(self, documents: List[Dict[str, Any]]) -> None:
+        """
+        Adds documents given as dicts with `index`, `text` and `embedding`.
+        """
+        rows = [np.asarray(document['embedding'], dtype=np.float32) for document in documents]
+        if not rows:
+            return
+        vectors = np.vstack(rows)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            self._documents.extend({'index': d['index'], 'text': d.get('text')} for d in documents)
+            self._matrix = vectors if self._matrix is None else np.vstack([self._matrix, vectors])
+
+    def load(self, driver, database: Optional[str]) -> None:
+        with driver.session(database=database) as session:
+            documents = session.execute_read(lambda tx: [record.data() for record in tx.run(
+                LOAD_DOCUMENTS_QUERY, textProperty=DOCUMENT_TEXT_PROPERTY)])
+        self.add(documents)
+        print('documents loaded for local retrieval: ' + str(len(documents)))
+
+    def search(self, embedding: List[float]) -> List[Dict[str, Any]]:
+        with self._lock:
+            matrix, documents = self._matrix, self._documents
+        if matrix is None:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        scores = matrix @ query
+        k = min(self.top_k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [dict(documents[i], score=float(scores[i])) for i in best if scores[i] >= self.min_score]
+
+
+class FallbackRetriever(DocumentRetriever):
+    """
+    Uses the vector index, and switches to local search while the index does not exist.
+    The index is tried again every `retry_after` seconds; other query errors are raised as they are.
+    """
+
+    def __init__(self, driver, database: Optional[str], retry_after: float = RETRIEVAL_FALLBACK_TTL):
+        super().__init__()
+        self.driver = driver
+        self.database = database
+        self.retry_after = retry_after
+        self.primary: DocumentRetriever = VectorIndexRetriever(driver, database)
+        self._fallback: Optional[LocalVectorRetriever] = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def _try_primary(self) -> bool:
+        if self._fallback is None:
+            return True
+        # one search per interval probes the index; the others keep using the fallback
+        with self._lock:
+            if time.monotonic() < self._retry_at:
+                return False
+            self._retry_at = time.monotonic() + self.retry_after
+            return True
+
+    def search(self, embedding: List[float]) -> List[Dict[str, Any]]:
+        if not self._try_primary():
+            return self._fallback.search(embedding)
+        try:
+            documents = self.primary.search(embedding)
+        except ClientError as e:
+            if not is_missing_index(e):
+                raise
+            return self._use_fallback(e).search(embedding)
+        if self._fallback is not None:
+            with self._lock:
+                self._fallback = None
+            print('vector index available again, leaving local search')
+        return documents
+
+    def _use_fallback(self, error: ClientError) -> LocalVectorRetriever:
+        with self._lock:
+            if self._fallback is None:
+                print('vector index not found, using local search: ' + str(error))
+                fallback = LocalVectorRetriever()
+                fallback.load(self.driver, self.database)
+                self._fallback = fallback
+            self._retry_at = time.monotonic() + self.retry_after
+            return self._fallback
+
+
+_retrievers: Dict[Any, DocumentRetriever] = {}
+_retrievers_lock = threading.Lock()
+
+
+def get_retriever(driver, database: Optional[str]) -> DocumentRetriever:
+    """
+    Returns the process-wide retriever for a database, as selected by `RETRIEVAL_BACKEND`.
+    """
+    key = (id(driver), database)
+    with _retrievers_lock:
+        if key not in _retrievers:
+            if RETRIEVAL_BACKEND == 'numpy':
+                retriever = LocalVectorRetriever()
+                retriever.load(driver, database)
+            else:
+                retriever = FallbackRetriever(driver, database)
+            _retrievers[key] = retriever
+    return _retrievers[key]
+
+
+def retrieve_documents(driver, database: Optional[str], embedding: List[float], **labels: Any) -> List[Dict[str, Any]]:
+    """
+    Runs a document search, recording its latency and result count.
+    """
+    search_timer_start = time.perf_counter()
+    documents = get_retriever(driver, database).search(embedding)
+    metrics.observe('retrieval_seconds', time.perf_counter() - search_timer_start, **labels)
+    metrics.increment('retrieved_documents_total', len(documents), **labels)
+    return documents
+
+
+def format_documents(documents: List[Dict[str, Any]]) -> str:
+    """
+    One line per document, prefixed with its index so the answer can cite it.
+    """
+    return '\n'.join('[' + str(document['index']) + '] ' + str(document.get('text') or '').replace('\n', ' ')
+                     for document in documents)
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from metrics import metrics
+
+
+class SchemaCache:
+    """
+    Process-wide cache of graph schemas.
+
+    Schemas are refreshed from the database at most once per `ttl` seconds
+    per (uri, database) key, or after an explicit `invalidate` call.
+    All sessions share the same entries, so a schema introspection round
+    trip is paid once per TTL window instead of once per question.
+    """
+
+    def __init__(self, ttl: float = float(os.environ.get('SCHEMA_CACHE_TTL', 300))):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_seconds_total = 0.0
+        self.last_refresh_seconds = 0.0
+
+    @staticmethod
+    def _key(graph) -> Tuple[str, str]:
+        # graphs built by NeoLangService carry a (uri, database) cache key so that
+        # every session pointing at the same database shares one entry
+        return getattr(graph, 'cache_key', None) or (str(id(graph)), str(getattr(graph, '_database', '')))
+
+    def _is_fresh(self, entry: Optional[Dict[str, Any]]) -> bool:
+        return entry is not None and (time.monotonic() - entry['loaded_at']) < self.ttl
+
+    def get(self, graph) -> str:
+        """
+        Returns the schema for `graph`, refreshing it from the database only
+        when the cached entry is missing, expired or invalidated.
+        The cached schema is also written back onto the graph object so that
+        chains reading `graph.schema` see the same value.
+        """
+        key = self._key(graph)
+        entry = self._entries.get(key)
+        if self._is_fresh(entry):
+            self.hits += 1
+        else:
+            with self._lock:
+                # another thread may have refreshed while we waited
+                entry = self._entries.get(key)
+                if self._is_fresh(entry):
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    entry = self._refresh(key, graph)
+
+        graph.schema = entry['schema']
+        if entry['structured_schema'] is not None:
+            graph.structured_schema = entry['structured_schema']
+        return entry['schema']
+
+    def _refresh(self, key: Tuple[str, str], graph) -> Dict[str, Any]:
+        refresh_timer_start = time.perf_counter()
+        graph.refresh_schema()
+        elapsed = time.perf_counter() - refresh_timer_start
+
+        previous = self._entries.get(key)
+        version = previous['version'] if previous else 0
+        if previous is None or previous['schema'] != graph.schema:
+            version += 1
+
+        entry = {
+            'schema': graph.schema,
+            'structured_schema': getattr(graph, 'structured_schema', None),
+            'loaded_at': time.monotonic(),
+            'version': version,
+        }
+        self._entries[key] = entry
+        self.refreshes += 1
+        self.refresh_seconds_total += elapsed
+        self.last_refresh_seconds = elapsed
+        metrics.observe('schema_refresh_seconds', elapsed)
+        return entry
+
+    def prewarm(self, graph) -> str:
+        """
+        Loads the schema for `graph` eagerly, e.g. at application startup.
+        """
+        with self._lock:
+            return self._refresh(self._key(graph), graph)['schema']
+
+    def invalidate(self, graph=None) -> None:
+        """
+        Drops the cached schema for `graph`, or every cached schema if no graph is given.
+        The next `get` call will refresh from the database.
+        """
+        with self._lock:
+            if graph is None:
+                for entry in self._entries.values():
+                    entry['loaded_at'] = float('-inf')
+            elif self._key(graph) in self._entries:
+                self._entries[self._key(graph)]['loaded_at'] = float('-inf')
+
+    def version(self, graph) -> int:
+        """
+        Returns a counter that increases every time the schema text for `graph` changes.
+        """
+        entry = self._entries.get(self._key(graph))
+        return entry['version'] if entry else 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'refreshes': self.refreshes,
+            'last_refresh_seconds': self.last_refresh_seconds,
+            'avg_refresh_seconds': self.refresh_seconds_total / self.refreshes if self.refreshes else 0.0,
+        }
+
+
+schema_cache = SchemaCache()
+metrics.register_collector('schema_cache', schema_cache.stats)
@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from metrics import metrics
+
+
+class SemanticCache:
+    """
+    Process-wide answer cache keyed by question embedding.
+
+    Callers pass the question embedding and get back the stored Cypher/answer
+    of the most similar previous question if its cosine similarity is at least `threshold`.
+    Entries are evicted least-recently-used beyond `max_size` and expire after `ttl` seconds.
+    Every entry is tagged with the schema version it was produced under and
+    is dropped once the graph schema changes.
+    """
+
+    def __init__(self,
+                 threshold: float = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.95)),
+                 max_size: int = int(os.environ.get('SEMANTIC_CACHE_SIZE', 1000)),
+                 ttl: float = float(os.environ.get('SEMANTIC_CACHE_TTL', 3600))):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._next_id = 0
+        # preallocated (capacity, dim) matrix; the first len(_matrix_ids) rows hold the live entries
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_ids: List[int] = []
+        self._rows: Dict[int, int] = {}
+        self._schema_version: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _append_row(self, entry_id: int, vector: np.ndarray) -> None:
+        # one contiguous matrix so a lookup is a single matrix-vector product; rows are added in place,
+        # and the matrix is only copied when its capacity doubles
+        rows = len(self._matrix_ids)
+        if self._matrix is None:
+            self._matrix = np.empty((16, vector.shape[0]), dtype=np.float32)
+        elif rows == self._matrix.shape[0]:
+            grown = np.empty((2 * rows, self._matrix.shape[1]), dtype=np.float32)
+            grown[:rows] = self._matrix
+            self._matrix = grown
+        self._matrix[rows] = vector
+        self._rows[entry_id] = rows
+        self._matrix_ids.append(entry_id)
+
+    def _delete(self, entry_id: int) -> None:
+        # the last row moves into the deleted one, so the live rows stay contiguous
+        del self._entries[entry_id]
+        row = self._rows.pop(entry_id)
+        last = len(self._matrix_ids) - 1
+        if row != last:
+            moved = self._matrix_ids[last]
+            self._matrix[row] = self._matrix[last]
+            self._matrix_ids[row] = moved
+            self._rows[moved] = row
+        self._matrix_ids.pop()
+
+    def _similarities(self, query: np.ndarray) -> np.ndarray:
+        return self._matrix[:len(self._matrix_ids)] @ query
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        # entries are in LRU order, not creation order, so every entry is checked
+        for i in [i for i, entry in self._entries.items() if now - entry['created_at'] >= self.ttl]:
+            self._delete(i)
+
+    def sync_schema_version(self, schema_version: int) -> None:
+        """
+        Clears the cache if the graph schema has changed since entries were stored.
+        """
+        with self._lock:
+            if self._schema_version is not None and schema_version != self._schema_version:
+                print('schema changed, clearing semantic cache')
+                self._clear()
+            self._schema_version = schema_version
+
+    def lookup(self, embedding) -> Optional[Dict[str, Any]]:
+        """
+        Returns the cached entry most similar to `embedding`, or None below the similarity threshold.
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            self._expire()
+            if not self._matrix_ids:
+                self.misses += 1
+                return None
+
+            similarities = self._similarities(query)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            entry_id = self._matrix_ids[best]
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            entry = self._entries[entry_id]
+            return {'question': entry['question'], 'cypher': entry['cypher'], 'cypher_params': entry['cypher_params'],
+                    'answer': entry['answer'], 'similarity': float(similarities[best])}
+
+    def store(self, embedding, question: str, cypher: str, cypher_params: Optional[Dict[str, Any]] = None,
+              answer: Optional[str] = None) -> None:
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._entries[self._next_id] = {
+                'question': question,
+                'cypher': cypher,
+                'cypher_params': cypher_params or {},
+                'answer': answer,
+                'created_at': time.monotonic(),
+            }
+            self._append_row(self._next_id, vector)
+            self._next_id += 1
+            while len(self._entries) > self.max_size:
+                self._delete(next(iter(self._entries)))
+
+    def invalidate(self, embedding) -> None:
+        """
+        Drops every entry a lookup of `embedding` could return, e.g. after its Cypher failed to run.
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            if not self._matrix_ids:
+                return
+            similarities = self._similarities(query)
+            for i in [self._matrix_ids[row] for row in np.flatnonzero(similarities >= self.threshold)]:
+                self._delete(i)
+
+    def _clear(self) -> None:
+        self._entries.clear()
+        self._matrix = None
+        self._matrix_ids = []
+        self._rows = {}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+semantic_cache = SemanticCache()
+metrics.register_collector('semantic_cache', semantic_cache.stats)
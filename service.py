@@ -1,35 +1,209 @@
+import copy
 import time
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from langchain.chains import GraphCypherQAChain, ConversationChain
-from langchain.chat_models import AzureChatOpenAI, ChatVertexAI
-from langchain.graphs import Neo4jGraph
-from langchain.memory import ConversationSummaryBufferMemory
-import streamlit as st
 import os
-import openai
-from neo4j.exceptions import ConstraintError
+from langchain.chains.graph_qa.cypher import extract_cypher
 
 import drivers
+from chain_cache import llm_cache, qa_chain_cache
+from cypher_cache import cypher_cache, extract_literals
+from cypher_guard import CYPHER_VALIDATION, CypherCheck, CypherRejected, check_cypher, record_blocked
+from entity_index import EntityMatch, bind_entities, describe_entities, entity_index
+from llm_router import LLM_CYPHER_MODEL, LLM_FALLBACK_MODEL, RoutedChatModel
+from log_writer import get_log_writer
+from memory import RollingSummaryMemory, memory_store
+from metrics import SIZE_BUCKETS, metrics
+from prompt_assembler import get_prompt_assembler
+from query_budget import BudgetedResult, QueryBudget, compact_results, run_budgeted
+from retrieval import format_documents, retrieve_documents
+from neo4jgraph import SharedNeo4jGraph
+from neo4jwriter import Neo4jWriter
+from schema_cache import schema_cache
+from semantic_cache import semantic_cache
+from streaming import TokenStreamHandler
+
+# whether logged conversations are flagged as publicly viewable
+PUBLIC = os.environ.get('LOG_PUBLIC', 'false').lower() == 'true'
+# conversation log writes, batched by the background log writer as `UNWIND $params AS row`.
+# Messages are merged by id so that retried batches are idempotent.
+LOG_CONVERSATION_QUERY = """
+unwind $params as row
+merge (c:Conversation {id: row.convId})
+set c.llm = row.llm, c.temperature = row.temperature,
+    c.public = row.properties.public
+merge (m:Message {id: row.messId})
+set m += row.properties
+merge (c)-[:FIRST]->(m)
+
+with c, row
+merge (s:Session {id: row.sessionId})
+on create set s.createTime = datetime()
+merge (s)-[:HAS_CONVERSATION]->(c)
+"""
+
+LOG_MESSAGE_QUERY = """
+unwind $params as row
+match (pm:Message {id: row.prevMessId})
+merge (m:Message {id: row.messId})
+set m += row.properties
+merge (pm)-[:NEXT]->(m)
+
+with m, row
+unwind row.contextIndices as contextIdx
+match (d:Document)
+where d.index = contextIdx
+
+with m, d
+merge (m)-[:HAS_CONTEXT]->(d)
+"""
+
+RATE_MESSAGE_QUERY = """
+unwind $params as row
+match (m:Message {id: row.messId})
+set m.rating = row.rating,
+    m.ratingMessage = row.message
+"""
+
+# whether semantic cache hits may return a cached answer, or only reuse the cached Cypher
+CACHE_ANSWERS = os.environ.get('SEMANTIC_CACHE_ANSWERS', 'true').lower() == 'true'
+
+# whether related Documents are retrieved by vector search alongside Cypher generation
+RETRIEVAL_ENABLED = os.environ.get('RETRIEVAL_ENABLED', 'true').lower() == 'true'
+_retrieval_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('RETRIEVAL_WORKERS', 8)),
+                                         thread_name_prefix='retrieval')
+
+
+@dataclass
+class TurnResult:
+    """
+    Outcome of one user turn, with the wall-clock seconds spent in each stage.
+    """
+    question: str
+    cypher: str = ""
+    cypher_params: Dict[str, Any] = field(default_factory=dict)
+    graph_result: List[Dict[str, Any]] = field(default_factory=list)
+    query_stats: Dict[str, Any] = field(default_factory=dict)
+    prompt: str = ""
+    prompt_tokens: Dict[str, int] = field(default_factory=dict)
+    answer: str = ""
+    context_indices: List[int] = field(default_factory=list)
+    documents: List[Dict[str, Any]] = field(default_factory=list)
+    timings: Dict[str, float] = field(default_factory=dict)
+    labels: Dict[str, Any] = field(default_factory=dict)
+    time_to_first_token: Optional[float] = None
+    embedding: Optional[List[float]] = None
+    cache_hit: Optional[str] = None
+    # set when stages overlap, since the stage timings then add up to more than the turn
+    wall_seconds: Optional[float] = None
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times the enclosed block into `timings` and the `turn_stage_seconds` histogram, tagged with `labels`.
+        """
+        stage_timer_start = time.perf_counter()
+        try:
+            with metrics.span('turn_stage', stage=name, **self.labels):
+                yield
+        finally:
+            self.timings[name] = time.perf_counter() - stage_timer_start
+
+    @property
+    def total_seconds(self) -> float:
+        if self.wall_seconds is not None:
+            return self.wall_seconds
+        return sum(self.timings.values())
+
+    @property
+    def prompt_seconds(self) -> float:
+        """
+        Seconds spent before answer synthesis, i.e. everything except the answer LLM call and logging.
+        """
+        return self.total_seconds - self.timings.get('answer_synthesis', 0) - self.timings.get('logging', 0)
 
 
 class NeoLangService:
-    def __init__(self, llm_type, temperature):
+    def __init__(self, llm_type, temperature, state=None, driver=None, graph=None, llm_factory=None,
+                 embeddings=None):
+        """
+        `state` holds the per-session values (session id, latest message ids, ...) and defaults to
+        `st.session_state`. `driver`, `graph`, `llm_factory(llm_type, streaming)` and `embeddings`
+        replace the Neo4j and LLM backends, e.g. with the fakes used by `benchmark.py`.
+        """
         self.llm_type = llm_type
         self.temperature = temperature
+        if state is None:
+            # imported here so the API server and benchmarks don't load Streamlit
+            import streamlit as st
+            state = st.session_state
+        self.state = state
+        self.llm_factory = llm_factory
+        self.embeddings = embeddings
         self.text_embedding_model = "textembedding-gecko@001"
         self.db_user = os.environ.get('NEO4J_USERNAME')
         self.db_password = os.environ.get('NEO4J_PASSWORD')
         self.db_uri = os.environ.get('NEO4J_URI')
         self.db_name = os.environ.get('NEO4J_DATABASE_NAME')
-        self.graph = Neo4jGraph(url=self.db_uri, username=self.db_user, password=self.db_password,
-                                database=self.db_name)
-        self.driver = drivers.init_driver(self.db_uri, username=self.db_user,
-                                          password=self.db_password)
+        # sessions borrow the process-wide driver rather than opening a pool each
+        self.driver = driver or drivers.init_driver(self.db_uri, username=self.db_user,
+                                                    password=self.db_password, database=self.db_name)
+        self.graph = graph or SharedNeo4jGraph(driver=self.driver, database=self.db_name,
+                                               cache_key=(self.db_uri, self.db_name))
+        self.log_writer = get_log_writer(self.driver, self.db_name)
 
         self.llm = self._init_llm()
 
-    def _init_llm(self):
-        if self.llm_type == "chat-bison 2k":
+    def with_state(self, state):
+        """
+        Returns a shallow copy of this service that keeps its per-session values in `state`. The driver,
+        graph, clients and log writer stay shared, so one service can serve many conversations.
+        """
+        service = copy.copy(self)
+        service.state = state
+        return service
+
+    def _init_llm(self, llm_type=None, streaming=False, role='answer'):
+        """
+        Returns the shared LLM client for (llm_type, temperature, streaming, role), defaulting to this
+        service's llm_type. The 'cypher' role uses `LLM_CYPHER_MODEL` when it is set.
+        """
+        llm_type = llm_type or self.llm_type
+        if role == 'cypher':
+            llm_type = LLM_CYPHER_MODEL or llm_type
+        key = (llm_type, self.temperature, streaming, role)
+        if self.llm_factory is not None:
+            # the factory itself, not its id: the cache keeps it alive, so a new factory never hits its clients
+            key += (self.llm_factory,)
+        return llm_cache.get_or_create(key, lambda: self._build_routed_llm(llm_type, streaming, role))
+
+    def _build_routed_llm(self, llm_type, streaming, role):
+        """
+        Wraps the client for `llm_type` in a router that falls back to `LLM_FALLBACK_MODEL`,
+        or for the Cypher role to the selected llm when a separate Cypher model is used.
+        """
+        providers, names = [self._build_llm(llm_type, streaming)], [llm_type]
+        fallback = LLM_FALLBACK_MODEL or (self.llm_type if role == 'cypher' else '')
+        if fallback and fallback != llm_type:
+            try:
+                providers.append(self._build_llm(fallback, streaming))
+                names.append(fallback)
+            except Exception as e:
+                # a misconfigured fallback shouldn't take the primary down with it
+                print('fallback llm ' + fallback + ' unavailable: ' + str(e))
+        return RoutedChatModel(providers=providers, provider_names=names, role=role)
+
+    def _build_llm(self, llm_type, streaming=False):
+        if self.llm_factory is not None:
+            return self.llm_factory(llm_type, streaming)
+        # provider SDKs are imported only for the selected backend
+        if llm_type == "chat-bison 2k":
+            from langchain.chat_models.vertexai import ChatVertexAI
             return ChatVertexAI(
                 model_name='chat-bison',
                 max_output_tokens=2048,  # Adjusted for "2k" variant
@@ -37,24 +211,62 @@ class NeoLangService:
                 top_p=0.95,
                 top_k=40
             )
-        elif self.llm_type == "GPT-4 8k":
+        elif llm_type == "chat-bison 32k":
+            from langchain.chat_models.vertexai import ChatVertexAI
+            return ChatVertexAI(
+                model_name='chat-bison-32k',
+                max_output_tokens=8192,
+                temperature=self.temperature,
+                top_p=0.95,
+                top_k=40
+            )
+        elif llm_type == "GPT-4 8k":
+            import openai
+            from langchain.chat_models.azure_openai import AzureChatOpenAI
             return AzureChatOpenAI(
                 openai_api_version=openai.api_version,
                 openai_api_key=openai.api_key,
                 openai_api_base=os.environ.get('OPENAI_API_BASE'),
                 deployment_name=os.environ.get('GPT4_8K_NAME'),
                 model_name='gpt-4',
-                temperature=self.temperature
+                temperature=self.temperature,
+                streaming=streaming
             )
         else:
-            raise ValueError(f"Unsupported LLM type: {self.llm_type}")
+            raise ValueError(f"Unsupported LLM type: {llm_type}")
+
+    def _get_embeddings(self):
+        """
+        Returns the shared text embedding client, or the injected one.
+        """
+        if self.embeddings is not None:
+            return self.embeddings
+
+        def build():
+            from langchain.embeddings.vertexai import VertexAIEmbeddings
+            return VertexAIEmbeddings(model_name=self.text_embedding_model)
+
+        return llm_cache.get_or_create(('embeddings', self.text_embedding_model), build)
+
+    def embed_question(self, question: str) -> List[float]:
+        """
+        Embeds the user's question with the shared text embedding model.
+        """
+        return self._get_embeddings().embed_query(question)
 
     def get_graph_schema(self):
         """
-        Retrieves the graph schema from the Neo4j database.
+        Retrieves the graph schema from the process-wide schema cache.
+        The database is only introspected when the cached schema has expired or been invalidated.
         """
-        self.graph.refresh_schema()
-        return self.graph.schema
+        return schema_cache.get(self.graph)
+
+    def invalidate_graph_schema(self):
+        """
+        Forces the next schema lookup to refresh from the Neo4j database,
+        e.g. after a data load changed labels or properties.
+        """
+        schema_cache.invalidate(self.graph)
 
     def generate_example_questions(self):
         """
@@ -66,55 +278,429 @@ class NeoLangService:
             "List all ECM codes related to configuration ID 456.",
         ]
 
-    def create_prompt(self, question: str):
+    def _get_qa_chain(self):
         """
-        Creates a prompt using GraphCypherQAChain to query the Neo4j graph with the user's question.
+        Returns the GraphCypherQAChain shared by every session with the same
+        (llm_type, temperature, Cypher model, injected llm factory) and database. Its LLM is the 'cypher' role client.
         """
-        schema = self.get_graph_schema()
-        example_questions = self.generate_example_questions()
-
-        chain = GraphCypherQAChain.from_llm(
-            llm=self.llm,
-            graph=self.graph,
-            verbose=True
+        return qa_chain_cache.get_or_create(
+            (self.llm_type, self.temperature, LLM_CYPHER_MODEL, self.llm_factory) + self.graph.cache_key,
+            lambda: GraphCypherQAChain.from_llm(llm=self._init_llm(role='cypher'), graph=self.graph, verbose=True)
         )
 
-        result = chain.run(question)
-        print(result)
+    def generate_cypher(self, question: str, use_cache: bool = True) -> Tuple[str, Dict[str, Any]]:
+        """
+        Returns a Cypher statement and its parameters for the user's question.
+        Questions matching a cached query template reuse it with the question's literals as parameters;
+        otherwise the cached GraphCypherQAChain's Cypher generation step is run and its output cached as a template.
+        Identifiers found in the entity index are described to the generation step and bound as exact parameters.
+        Generated Cypher is validated before it is cached or run (see `validate_cypher`).
+        The chain's own answer step is not run; the conversation synthesizes the answer.
+        """
+        if use_cache:
+            template = self._lookup_cypher_template(question)
+            if template is not None:
+                return template
+
+        entities = self.resolve_entities(question)
+        cypher = self.validate_cypher(question, self._generate_cypher_with_llm(question, entities), entities)
+        return self._store_cypher(question, cypher, entities)
+
+    def _lookup_cypher_template(self, question: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        template = cypher_cache.lookup(question)
+        if template is not None:
+            metrics.increment('cypher_template_hits_total', llm_type=self.llm_type)
+        return template
+
+    @staticmethod
+    def _store_cypher(question: str, cypher: str, entities: List[EntityMatch]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Caches validated Cypher as a template and returns it with the resolved entities bound as parameters.
+        """
+        cypher_cache.store(question, cypher)
+        if entities:
+            return bind_entities(cypher, entities)
+        return cypher, {}
+
+    def resolve_entities(self, question: str) -> List[EntityMatch]:
+        """
+        Looks up the question's identifiers in the entity index, starting a background
+        rebuild (and index creation) first if the index is stale.
+        """
+        entity_index.refresh_if_stale(self.driver, self.db_name, self.graph.structured_schema,
+                                      schema_cache.version(self.graph),
+                                      writer=Neo4jWriter(driver=self.driver, database=self.db_name))
+        entities = entity_index.resolve(question)
+        if entities:
+            metrics.increment('entity_matches_total', len(entities), llm_type=self.llm_type)
+        return entities
+
+    @staticmethod
+    def _entity_question(question: str, entities: List[EntityMatch]) -> str:
+        if not entities:
+            return question
+        return question + "\n" + describe_entities(entities)
+
+    def _cypher_generation_inputs(self, question: str, entities: Optional[List[EntityMatch]] = None):
+        """
+        Returns the shared QA chain and the inputs of its Cypher generation step for the question.
+        """
+        question = self._entity_question(question, entities or [])
+        schema = self.get_pruned_schema(question)
+
+        with metrics.span('chain_setup', llm_type=self.llm_type):
+            chain = self._get_qa_chain()
+        return chain, {"question": question, "schema": schema}
 
+    def _generate_cypher_with_llm(self, question: str, entities: Optional[List[EntityMatch]] = None) -> str:
+        chain, inputs = self._cypher_generation_inputs(question, entities)
+        return extract_cypher(chain.cypher_generation_chain.run(inputs))
 
+    def check_cypher(self, cypher: str) -> CypherCheck:
+        """
+        Runs the schema, rewrite and EXPLAIN plan checks on a statement; plans are cached per schema version.
+        """
+        return check_cypher(cypher, self.driver, self.db_name, self.graph.structured_schema,
+                            plan_key=self.graph.cache_key + (schema_cache.version(self.graph),))
 
-        prompt_template = f"""
-            Task: Generate Cypher statement to query a graph database.
-            Schema: {schema}
-            Example Questions: {', '.join(example_questions)}
-            The question is: {question}
-            Graph Query Results: {result}
-            Answer the question using the graph query results.
-            Provide explanations or sources if available.
+    def validate_cypher(self, question: str, cypher: str, entities: Optional[List[EntityMatch]] = None) -> str:
+        """
+        Returns the statement to run for generated Cypher, with safe rewrites applied. A rejected statement
+        gets one repair round with the Cypher generation step; if the repair is rejected too,
+        CypherRejected (a ValueError) is raised. Blocked statements are counted in `cypher_blocked_total`.
+        """
+        if not CYPHER_VALIDATION:
+            return cypher
+        with metrics.span('cypher_validation', llm_type=self.llm_type):
+            check = self.check_cypher(cypher)
+        if check.ok:
+            return check.cypher
+
+        record_blocked(check, llm_type=self.llm_type)
+        repaired = self._generate_cypher_with_llm(check.repair_question(question), entities)
+        with metrics.span('cypher_validation', llm_type=self.llm_type):
+            repaired_check = self.check_cypher(repaired)
+        return self._accept_repair(repaired_check)
+
+    def _accept_repair(self, repaired_check: CypherCheck) -> str:
+        """
+        Returns the statement of a repaired, accepted check, or raises its CypherRejected.
+        """
+        metrics.increment('cypher_repairs_total', outcome='ok' if repaired_check.ok else 'rejected',
+                          llm_type=self.llm_type)
+        if repaired_check.ok:
+            return repaired_check.cypher
+        record_blocked(repaired_check, llm_type=self.llm_type)
+        raise repaired_check.error()
+
+    def query_graph(self, cypher: str, params: Optional[Dict[str, Any]] = None,
+                    budget: Optional[QueryBudget] = None) -> BudgetedResult:
+        """
+        Streams the results of a generated Cypher statement within a row/byte/time budget
+        and compacts them into a token-bounded table for the prompt.
         """
+        budget = budget or QueryBudget()
+        result = run_budgeted(self.driver, self.db_name, cypher, params or {}, budget)
+        compact_results(result, max_tokens=budget.max_tokens)
+        return self._record_query(result)
+
+    def _record_query(self, result: BudgetedResult) -> BudgetedResult:
+        metrics.observe('graph_rows_scanned', result.rows_scanned, buckets=SIZE_BUCKETS, llm_type=self.llm_type)
+        metrics.observe('graph_rows_kept', result.rows_kept, buckets=SIZE_BUCKETS, llm_type=self.llm_type)
+        metrics.observe('graph_serialization_seconds', result.serialization_seconds, llm_type=self.llm_type)
+        if result.truncated_by:
+            metrics.increment('graph_results_truncated_total', reason=result.truncated_by)
+        return result
+
+    def seed_cypher_templates(self):
+        """
+        Generates Cypher for each example question and pins it as a known-good query template.
+        Questions whose Cypher fails validation are not seeded.
+        """
+        for question in self.generate_example_questions():
+            try:
+                cypher_cache.pin(question, self.validate_cypher(question, self._generate_cypher_with_llm(question)))
+            except CypherRejected as e:
+                print('example question not seeded: ' + str(e))
+        print('cypher templates seeded: ' + str(cypher_cache.stats()))
 
-        print(prompt_template + 'this is the prompt template')
-        return prompt_template
+    def get_pruned_schema(self, question: str) -> str:
+        """
+        Returns the part of the cached graph schema relevant to the question,
+        or the full schema if no label, relationship or property matches.
+        """
+        self.get_graph_schema()
+        return get_prompt_assembler(self.llm_type).prune_schema(question, self.graph,
+                                                                schema_cache.version(self.graph))
 
-    def create_conversation(self, llm_type: str):
+    def create_prompt(self, question: str, result, history_tokens: int = 0,
+                      documents: Optional[List[Dict[str, Any]]] = None) -> Tuple[str, Dict[str, int]]:
+        """
+        Creates the answer synthesis prompt from the user's question, the graph query results,
+        given as the compact table produced by `query_graph`, and any retrieved documents.
+        Schema, examples and results are fitted into the model's context window after reserving
+        room for the answer and `history_tokens` of conversation memory.
+        Returns the prompt and its token breakdown.
+        """
+        prompt_template, breakdown = get_prompt_assembler(self.llm_type).assemble(
+            question, self.get_pruned_schema(question), self.generate_example_questions(), str(result),
+            history_tokens=history_tokens, documents=format_documents(documents or []))
+
+        print('prompt token breakdown: ' + str(breakdown))
+        for section, tokens in breakdown.items():
+            metrics.observe('prompt_tokens', tokens, buckets=SIZE_BUCKETS, section=section, llm_type=self.llm_type)
+        return prompt_template, breakdown
+
+    def retrieve_context(self, embedding: List[float]) -> List[Dict[str, Any]]:
+        """
+        Returns the Documents closest to the question embedding, from the Neo4j vector index
+        or, where there is none, a local search over the Document embeddings.
+        """
+        return retrieve_documents(self.driver, self.db_name, embedding, llm_type=self.llm_type)
+
+    def _start_retrieval(self, turn: TurnResult) -> Optional[Future]:
+        if not RETRIEVAL_ENABLED:
+            return None
+
+        def retrieve():
+            with turn.stage('retrieval'):
+                return self.retrieve_context(turn.embedding)
+
+        return _retrieval_executor.submit(retrieve)
+
+    @staticmethod
+    def _finish_retrieval(turn: TurnResult, retrieval: Optional[Any]) -> None:
+        """
+        Collects the retrieval started by `_start_retrieval` (or the async turn's finished task);
+        a failed search leaves the turn without documents.
+        """
+        if retrieval is None:
+            return
+        try:
+            turn.documents = retrieval.result()
+        except Exception as e:
+            print('document retrieval failed: ' + str(e))
+            turn.documents = []
+        turn.context_indices = [document['index'] for document in turn.documents]
+
+    def _history_tokens(self, conversation: ConversationChain) -> int:
+        """
+        Counts the tokens the conversation memory will add to the next prompt.
+        """
+        history = conversation.memory.load_memory_variables({}).get(conversation.memory.memory_key, "")
+        return get_prompt_assembler(self.llm_type).count(str(history))
+
+    def run_turn(self, question: str, conversation: ConversationChain, new_conversation: bool,
+                 on_token: Optional[Callable[[str, str], None]] = None, use_cache: bool = True,
+                 conversation_key: Optional[str] = None) -> TurnResult:
+        """
+        Runs one user turn: Cypher generation, graph query, answer synthesis and logging.
+        Each stage runs exactly once; the returned TurnResult carries per-stage timings.
+        If `on_token` is given, answer tokens are passed to it as they are generated
+        (requires a conversation created with streaming=True).
+        Near-duplicate questions are answered from the semantic cache unless `use_cache` is False. Answers
+        depend on the conversation history, so they are only cached and served on a conversation's first turn;
+        later turns reuse only the cached Cypher.
+        If `conversation_key` is given, the conversation memory is saved under it after the turn.
+        """
+        turn = self._new_turn(question)
+        turn_timer_start = time.perf_counter()
+        first_turn = conversation.memory.is_empty()
+
+        with turn.stage('schema_fetch'):
+            self.get_graph_schema()
+
+        with turn.stage('embedding'):
+            turn.embedding = self.embed_question(question)
+            self.state['recent_question_embedding'] = turn.embedding
+
+        cached = self._lookup_semantic_cache(turn, question, use_cache, first_turn)
+        if self._is_answer_hit(cached):
+            self._serve_cached_answer(turn, question, conversation, on_token, cached)
+        else:
+            # document retrieval only needs the embedding, so it runs while the Cypher is generated and run
+            retrieval = self._start_retrieval(turn)
+
+            with turn.stage('cypher_generation'):
+                if not self._use_cached_cypher(turn, question, cached, use_cache):
+                    turn.cypher, turn.cypher_params = self.generate_cypher(question, use_cache=False)
+
+            with turn.stage('graph_query'):
+                # cached Cypher that fails to run is replaced by freshly generated Cypher once
+                while True:
+                    try:
+                        query_result = self.query_graph(turn.cypher, turn.cypher_params)
+                        break
+                    except ValueError:
+                        if not self._drop_cached_cypher(turn, question):
+                            raise
+                    with turn.stage('cypher_fallback'):
+                        turn.cypher, turn.cypher_params = self.generate_cypher(question, use_cache=False)
+                self._record_graph_result(turn, query_result)
+
+            self._finish_retrieval(turn, retrieval)
+
+            with turn.stage('prompt_creation'):
+                turn.prompt, turn.prompt_tokens = self.create_prompt(question, query_result.table,
+                                                                     history_tokens=self._history_tokens(conversation),
+                                                                     documents=turn.documents)
+
+            with turn.stage('answer_synthesis'):
+                handler = self._stream_handler(on_token)
+                turn.answer = conversation(self._conversation_inputs(turn, question),
+                                           callbacks=[handler] if handler else None)[conversation.output_key]
+                self._record_first_token(turn, handler)
+
+        return self._finish_turn(turn, question, conversation, new_conversation, use_cache, first_turn,
+                                 conversation_key, turn_timer_start)
+
+    def _new_turn(self, question: str) -> TurnResult:
+        return TurnResult(question=question,
+                          labels={'llm_type': self.llm_type, 'session': self.state.get('session_id')})
+
+    def _lookup_semantic_cache(self, turn: TurnResult, question: str, use_cache: bool,
+                               first_turn: bool) -> Optional[Dict[str, Any]]:
+        """
+        Returns the semantic cache entry for the turn's embedding, or None on a miss or with `use_cache` off.
+        Past a conversation's first turn the entry's answer is left out: it was synthesized without this
+        conversation's history, while its Cypher only depends on the question.
+        """
+        if not use_cache:
+            return None
+        with turn.stage('cache_lookup'):
+            semantic_cache.sync_schema_version(schema_cache.version(self.graph))
+            cached = semantic_cache.lookup(turn.embedding)
+            # near-identical wording about a different serial number or id is not a hit
+            if cached is not None and extract_literals(cached['question']) != extract_literals(question):
+                return None
+            if cached is not None and not first_turn:
+                cached = dict(cached, answer=None)
+            return cached
+
+    @staticmethod
+    def _is_answer_hit(cached: Optional[Dict[str, Any]]) -> bool:
+        return cached is not None and cached['answer'] is not None and CACHE_ANSWERS
+
+    def _serve_cached_answer(self, turn: TurnResult, question: str, conversation: ConversationChain,
+                             on_token: Optional[Callable[[str, str], None]], cached: Dict[str, Any]) -> None:
+        print('semantic cache answer hit, similarity: ' + str(round(cached['similarity'], 4)))
+        turn.cache_hit = 'answer'
+        turn.cypher = cached['cypher']
+        turn.answer = cached['answer']
+        turn.prompt, turn.prompt_tokens = self.create_prompt(question, "(answer served from cache)")
+        # keep the conversation memory consistent with what the user saw
+        conversation.memory.save_context({'question': question}, {'response': turn.answer})
+        if on_token is not None:
+            on_token(turn.answer, turn.answer)
+
+    def _use_cached_cypher(self, turn: TurnResult, question: str, cached: Optional[Dict[str, Any]],
+                           use_cache: bool) -> bool:
+        """
+        Takes the Cypher of a semantic cache hit or, failing that, of a matching query template for the turn;
+        False if there is neither.
+        """
+        if cached is not None:
+            turn.cache_hit = 'cypher'
+            turn.cypher, turn.cypher_params = cached['cypher'], cached['cypher_params']
+            return True
+        template = self._lookup_cypher_template(question) if use_cache else None
+        if template is None:
+            return False
+        turn.cache_hit = 'template'
+        turn.cypher, turn.cypher_params = template
+        return True
+
+    def _drop_cached_cypher(self, turn: TurnResult, question: str) -> bool:
+        """
+        Called when the turn's Cypher failed to run. Drops it from the template and semantic caches so it is
+        not served again, and returns whether it came from a cache, i.e. whether generating fresh Cypher may help.
+        """
+        cypher_cache.invalidate(question)
+        if turn.cache_hit not in ('cypher', 'template'):
+            return False
+        print('cached cypher failed, generating new cypher')
+        metrics.increment('cypher_cache_fallbacks_total', source=turn.cache_hit, llm_type=self.llm_type)
+        semantic_cache.invalidate(turn.embedding)
+        turn.cache_hit = None
+        return True
+
+    @staticmethod
+    def _record_graph_result(turn: TurnResult, query_result: BudgetedResult) -> None:
+        turn.graph_result = query_result.records
+        turn.query_stats = query_result.stats()
+
+    @staticmethod
+    def _conversation_inputs(turn: TurnResult, question: str) -> Dict[str, Any]:
+        """
+        Inputs of the answer call: memory keeps the question rather than the assembled prompt, and cuts
+        the history to what the prompt assembler allotted it.
+        """
+        return {'input': turn.prompt, 'question': question, 'history_tokens': turn.prompt_tokens['history']}
+
+    @staticmethod
+    def _stream_handler(on_token: Optional[Callable[[str, str], None]]) -> Optional[TokenStreamHandler]:
+        return TokenStreamHandler(on_token) if on_token is not None else None
+
+    @staticmethod
+    def _record_first_token(turn: TurnResult, handler: Optional[TokenStreamHandler]) -> None:
+        if handler is None:
+            return
+        turn.time_to_first_token = handler.time_to_first_token
+        if turn.time_to_first_token is not None:
+            metrics.observe('time_to_first_token_seconds', turn.time_to_first_token, **turn.labels)
+
+    def _finish_turn(self, turn: TurnResult, question: str, conversation: ConversationChain, new_conversation: bool,
+                     use_cache: bool, first_turn: bool, conversation_key: Optional[str],
+                     turn_timer_start: float) -> TurnResult:
+        """
+        Caches the turn's Cypher and, on a conversation's first turn, its synthesized answer unless the turn
+        was served from a cache, saves the conversation memory, logs the user and assistant messages and
+        records the turn's duration. Shared by the sync and async turn pipelines.
+        """
+        if use_cache and turn.cache_hit is None:
+            semantic_cache.store(turn.embedding, question=question, cypher=turn.cypher,
+                                 cypher_params=turn.cypher_params, answer=turn.answer if first_turn else None)
+
+        if conversation_key:
+            memory_store.save(conversation_key, conversation.memory)
+
+        with turn.stage('logging'):
+            self.state['general_prompt'] = turn.prompt
+            self.state['num_documents_for_context'] = len(turn.context_indices)
+            if new_conversation:
+                self.log_new_conversation(llm=self.llm_type, user_input=question)
+            else:
+                self.log_user(user_input=question)
+            self.log_assistant(assistant_output=turn.answer, context_indices=turn.context_indices,
+                               summary=conversation.memory.moving_summary_buffer)
+
+        turn.wall_seconds = time.perf_counter() - turn_timer_start
+        metrics.observe('turn_seconds', turn.total_seconds, cache_hit=turn.cache_hit or 'none', **turn.labels)
+        return turn
+
+    def create_conversation(self, llm_type: str, streaming: bool = False, conversation_key: Optional[str] = None,
+                            memory_snapshot: Optional[Dict[str, Any]] = None):
         """
         This function intializes a conversation with the llm.
         The resulting conversation can be prompted successively and will
         remember previous interactions.
+        With streaming=True the llm emits tokens as they are generated.
+        If `conversation_key` is given, memory saved under that key is restored;
+        `memory_snapshot` restores memory from a `RollingSummaryMemory.to_dict()` snapshot instead.
         """
-        create_conversation_timer_start = time.perf_counter()
         print("llm type: ", llm_type)
-        llm = self._init_llm()
+        with metrics.span('create_conversation', llm_type=llm_type):
+            llm = self._init_llm(llm_type, streaming=streaming)
 
-        st.session_state['llm_memory'] = ConversationSummaryBufferMemory(llm=llm, max_token_limit=1000)
+            # summarization uses the non-streaming client so summaries never reach the token callback
+            if memory_snapshot is None and conversation_key:
+                memory_snapshot = memory_store.load(conversation_key)
+            memory = RollingSummaryMemory.from_dict(self._init_llm(llm_type), memory_snapshot)
 
-        res = ConversationChain(
-            llm=llm,
-            memory=st.session_state['llm_memory']
-        )
-        print("Create conversation time: " + str(
-            round(time.perf_counter() - create_conversation_timer_start, 4)) + " seconds.")
+            res = ConversationChain(
+                llm=llm,
+                memory=memory
+            )
 
         return res
 
@@ -123,141 +709,79 @@ class NeoLangService:
         This method creates a new conversation node and logs the
         initial user message in the neo4j database.
         Appropriate relationships are created.
+        The write is queued on the background log writer.
         """
 
-        log_timer_start = time.perf_counter()
-
         print('logging new conversation...')
         messId = 'user-' + str(uuid.uuid4())
         convId = 'conv-' + str(uuid.uuid4())
 
         print('convId: ', convId)
 
-        def log(tx):
-            tx.run("""
-            create (c:Conversation)-[:FIRST]->(m:Message)
-            set c.id = $convId, c.llm = $llm,
-                c.temperature = $temperature,
-                c.public = toBoolean($public),
-                m.id = $messId, m.content = $content,
-                m.role = $role, m.postTime = datetime(),
-                m.embedding = $embedding,
-                m.public = toBoolean($public)
-
-            with c
-            merge (s:Session {id: $sessionId})
-            on create set s.createTime = datetime()
-            merge (s)-[:HAS_CONVERSATION]->(c)
-                      """, convId=convId, llm=llm, messId=messId,
-                   temperature=st.session_state['temperature'],
-                   content=user_input, role='user', sessionId=st.session_state['session_id'],
-                   embedding=st.session_state['recent_question_embedding'],
-                   public=PUBLIC)
+        self.log_writer.submit(LOG_CONVERSATION_QUERY, name='conversation', row={
+            'convId': convId, 'llm': llm, 'temperature': self.temperature,
+            'sessionId': self.state['session_id'], 'messId': messId,
+            'properties': {
+                'content': user_input, 'role': 'user', 'postTime': datetime.now(timezone.utc),
+                'embedding': self.state.get('recent_question_embedding'), 'public': PUBLIC,
+            },
+        })
 
         # update the latest message in the log chain
-        st.session_state['latest_message_id'] = messId
-
-        try:
-            with self.driver.session(database=self.database_name) as session:
-                session.execute_write(log)
-
-        except ConstraintError as err:
-            print(err)
-
-            session.close()
-
-        print(
-            'conversation init & user log time: ' + str(round(time.perf_counter() - log_timer_start, 4)) + " seconds.")
+        self.state['latest_message_id'] = messId
 
     def log_user(self, user_input):
         """
         This method logs a new user message to the neo4j database and
         creates appropriate relationships.
+        The write is queued on the background log writer.
         """
 
-        log_timer_start = time.perf_counter()
         print('logging user message...')
-        prevMessId = st.session_state['latest_message_id']
+        prevMessId = self.state['latest_message_id']
         messId = 'user-' + str(uuid.uuid4())
 
-        def log(tx):
-            tx.run("""
-            match (pm:Message {id: $prevMessId})
-            merge (m:Message {id: $messId})
-            set m.content = $content,
-                m.role = $role, m.postTime = datetime(),
-                m.embedding = $embedding, m.public = toBoolean($public)
-
-            merge (pm)-[:NEXT]->(m)
-                      """, prevMessId=prevMessId, messId=messId, content=user_input, role='user',
-                   embedding=st.session_state['recent_question_embedding'], public=PUBLIC)
+        self.log_writer.submit(LOG_MESSAGE_QUERY, name='user_message', row={
+            'prevMessId': prevMessId, 'messId': messId, 'contextIndices': [],
+            'properties': {
+                'content': user_input, 'role': 'user', 'postTime': datetime.now(timezone.utc),
+                'embedding': self.state.get('recent_question_embedding'), 'public': PUBLIC,
+            },
+        })
 
         # update the latest message in the log chain
-        st.session_state['latest_message_id'] = messId
-
-        try:
-            with self.driver.session(database=self.database_name) as session:
-                session.execute_write(log)
+        self.state['latest_message_id'] = messId
 
-        except Neo4jError as err:
-            print(err)
-
-        print('user log time: ' + str(round(time.perf_counter() - log_timer_start, 4)) + " seconds.")
+    @staticmethod
+    def forget_conversation(conversation_key: str):
+        """
+        Drops the saved memory of a conversation, e.g. when the chat is reset.
+        """
+        memory_store.delete(conversation_key)
 
-    def log_assistant(self, assistant_output, context_indices):
+    def log_assistant(self, assistant_output, context_indices, summary=""):
         """
         This method logs a new assistant message to the neo4j database and
         creates appropriate relationships.
+        The write is queued on the background log writer.
         """
 
-        log_timer_start = time.perf_counter()
-
         print('logging llm message...')
-        prevMessId = st.session_state['latest_message_id']
+        prevMessId = self.state['latest_message_id']
         messId = 'llm-' + str(uuid.uuid4())
 
-        mem = st.session_state['llm_memory'].moving_summary_buffer
-
-        def log(tx):
-            tx.run("""
-            match (pm:Message {id: $prevMessId})
-            merge (m:Message {id: $messId})
-            set m.content = $content,
-                m.role = $role, m.postTime = datetime(),
-                m.numDocs = $numDocs,
-                m.vectorIndexSearch = true,
-                m.prompt = $prompt,
-                m.public = toBoolean($public),
-                m.resultingSummary = $resultingSummary
-
-            merge (pm)-[:NEXT]->(m)
-
-            with m
-            unwind $contextIndices as contextIdx
-            match (d:Document)
-            where d.index = contextIdx
-
-            with m, d
-            merge (m)-[:HAS_CONTEXT]->(d)
-                    """, prevMessId=str(prevMessId), messId=str(messId), content=str(assistant_output),
-                   role='assistant', contextIndices=context_indices,
-                   numDocs=st.session_state['num_documents_for_context'],
-                   prompt=st.session_state['general_prompt'],
-                   resultingSummary=mem,
-                   public=PUBLIC)
+        self.log_writer.submit(LOG_MESSAGE_QUERY, name='assistant_message', row={
+            'prevMessId': str(prevMessId), 'messId': str(messId), 'contextIndices': context_indices,
+            'properties': {
+                'content': str(assistant_output), 'role': 'assistant', 'postTime': datetime.now(timezone.utc),
+                'numDocs': self.state['num_documents_for_context'], 'vectorIndexSearch': True,
+                'prompt': self.state['general_prompt'], 'public': PUBLIC, 'resultingSummary': summary,
+            },
+        })
 
         # update the latest message in the log chain
-        st.session_state['latest_message_id'] = messId
-        st.session_state['latest_llm_message_id'] = messId
-
-        try:
-            with self.driver.session(database=self.database_name) as session:
-                session.execute_write(log)
-
-        except ConstraintError as err:
-            print(err)
-
-        print('assistant log time: ' + str(round(time.perf_counter() - log_timer_start, 4)) + " seconds.")
+        self.state['latest_message_id'] = messId
+        self.state['latest_llm_message_id'] = messId
 
     def rate_message(self, rating_dict):
         """
@@ -266,28 +790,13 @@ class NeoLangService:
         """
 
         print('rating llm message...')
-        if 'latest_llm_message_id' in st.session_state:
-            rate_timer_start = time.perf_counter()
-
-            print('updating id: ', st.session_state['latest_llm_message_id'])
+        if 'latest_llm_message_id' in self.state:
+            print('updating id: ', self.state['latest_llm_message_id'])
 
             # parse rating info
             message = rating_dict['text']
             rating = 'Good' if rating_dict['score'] == '👍' else 'Bad'
 
-            def rate(tx):
-                tx.run("""
-                match (m:Message {id: $messId})
-
-                set m.rating = $rating,
-                    m.ratingMessage = $message
-                        """, rating=rating, message=message, messId=st.session_state['latest_llm_message_id'])
-
-            try:
-                with self.driver.session(database=self.database_name) as session:
-                    session.execute_write(rate)
-
-            except ConstraintError as err:
-                print(err)
-
-            print('assistant rate time: ' + str(round(time.perf_counter() - rate_timer_start, 4)) + " seconds.")
\ No newline at end of file
+            self.log_writer.submit(RATE_MESSAGE_QUERY, name='rating', row={
+                'messId': self.state['latest_llm_message_id'], 'rating': rating, 'message': message,
+            })
@@ -0,0 +1,197 @@
+"""
+Cold start tooling: an import-time profile of the service and a prewarm phase.
+
+    python startup.py --profile        # import cost per top-level package of `service`
+    python startup.py --prewarm        # open the pool, load the schema, build chains; print step timings
+    python startup.py --ui [args]      # prewarm in the background and serve app.py with Streamlit
+
+`prewarm()` is also run in-process by `api_server.py` before it listens, and by `--ui` (the container's
+command) as soon as the Streamlit server starts, so the first request finds every shared resource built.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import metrics
+
+# llm types whose clients and chains are built during prewarm
+PREWARM_LLM_TYPES = [llm_type.strip() for llm_type in os.environ.get('PREWARM_LLM_TYPES', 'GPT-4 8k').split(',')
+                     if llm_type.strip()]
+PREWARM_TEMPERATURE = float(os.environ.get('PREWARM_TEMPERATURE', 0.7))
+# pin validated Cypher templates for the example questions; one Cypher generation call per question
+PREWARM_CYPHER_TEMPLATES = os.environ.get('PREWARM_CYPHER_TEMPLATES', 'true').lower() == 'true'
+
+# provider SDKs that should only be imported when their backend is selected
+PROVIDER_MODULES = ('openai', 'vertexai', 'google.cloud.aiplatform', 'transformers', 'graphdatascience', 'pandas',
+                    'pyarrow')
+
+_prewarm_lock = threading.Lock()
+_prewarm_report: Optional[Dict[str, Any]] = None
+
+
+def import_profile(module: str = 'service', top: int = 15) -> List[Dict[str, Any]]:
+    """
+    Imports `module` in a fresh interpreter with `-X importtime` and returns the `top` packages
+    it pulls in, by cumulative import time in seconds.
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                               capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    entries = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|', 2)
+        if not cumulative.strip().isdigit():
+            continue
+        # every nesting level indents the name by two more spaces
+        entries.append(((len(name) - len(name.lstrip())) // 2, name.strip().split('.')[0], int(cumulative) / 1e6))
+
+    # imports are printed after their children; walked backwards each importer comes first, so a
+    # package is counted once where it is first entered from a different package
+    packages: Dict[str, float] = {}
+    stack: List[Any] = []
+    for level, package, seconds in reversed(entries):
+        while stack and stack[-1][0] >= level:
+            stack.pop()
+        if package != module.split('.')[0] and all(package != parent for _, parent in stack):
+            packages[package] = packages.get(package, 0.0) + seconds
+        stack.append((level, package))
+    if completed.returncode != 0:
+        print(completed.stderr.strip().splitlines()[-1])
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [{'package': package, 'seconds': round(seconds, 4)} for package, seconds in ranked]
+
+
+def loaded_providers() -> List[str]:
+    """
+    Provider SDKs already imported by this process.
+    """
+    return [module for module in PROVIDER_MODULES if module in sys.modules]
+
+
+def prewarm(llm_types: Optional[List[str]] = None, temperature: float = PREWARM_TEMPERATURE) -> Dict[str, Any]:
+    """
+    Builds the shared resources a first request would otherwise pay for: the driver pool, graph schema,
+    LLM clients and QA chains for `llm_types`, the embedding client, tokenizer and entity index, and
+    with `PREWARM_CYPHER_TEMPLATES` the Cypher templates for the example questions.
+    Failing steps are reported and skipped. Returns the seconds spent per step.
+    """
+    from entity_index import entity_index
+    from prompt_assembler import get_prompt_assembler
+    from schema_cache import schema_cache
+    from service import NeoLangService
+
+    llm_types = llm_types or PREWARM_LLM_TYPES
+    report: Dict[str, Any] = {'steps': {}, 'errors': {}}
+    services: Dict[str, NeoLangService] = {}
+
+    def step(name: str, action: Callable[[], Any]) -> None:
+        step_timer_start = time.perf_counter()
+        try:
+            action()
+        except Exception as e:
+            print('prewarm step ' + name + ' failed: ' + str(e))
+            report['errors'][name] = str(e)
+        elapsed = time.perf_counter() - step_timer_start
+        report['steps'][name] = round(elapsed, 4)
+        metrics.observe('prewarm_seconds', elapsed, step=name)
+
+    def build_services():
+        for llm_type in llm_types:
+            # connects the shared driver pool and builds the non-streaming client
+            services[llm_type] = NeoLangService(llm_type, temperature, state={})
+
+    def build_chains():
+        for llm_type, service in services.items():
+            service._get_qa_chain()
+            service._init_llm(llm_type, streaming=True)
+
+    def first_service() -> NeoLangService:
+        return next(iter(services.values()))
+
+    def build_entity_index():
+        service = first_service()
+        entity_index.build(service.driver, service.db_name, service.graph.structured_schema,
+                           schema_cache.version(service.graph))
+
+    def load_tokenizer():
+        import tiktoken
+        # downloads and parses the BPE ranks on first use
+        tiktoken.get_encoding('cl100k_base')
+        for llm_type in llm_types:
+            get_prompt_assembler(llm_type)
+
+    prewarm_timer_start = time.perf_counter()
+    step('services', build_services)
+    if services:
+        step('schema', lambda: schema_cache.prewarm(first_service().graph))
+        step('chains', build_chains)
+        step('embeddings', lambda: first_service()._get_embeddings())
+        step('entity_index', build_entity_index)
+        if PREWARM_CYPHER_TEMPLATES:
+            step('cypher_templates', lambda: first_service().seed_cypher_templates())
+    step('tokenizer', load_tokenizer)
+    report['seconds'] = round(time.perf_counter() - prewarm_timer_start, 4)
+    report['providers_loaded'] = loaded_providers()
+    print('prewarm done: ' + json.dumps(report))
+    return report
+
+
+def prewarm_once() -> Dict[str, Any]:
+    """
+    Runs `prewarm` the first time it is called in this process and returns that report afterwards.
+    """
+    global _prewarm_report
+    with _prewarm_lock:
+        if _prewarm_report is None:
+            _prewarm_report = prewarm()
+    return _prewarm_report
+
+
+def serve_ui(streamlit_args: List[str]) -> int:
+    """
+    Serves `app.py` with Streamlit in this process. Prewarm starts in a background thread when the
+    server starts rather than when the first browser session runs the script; the app's own
+    `prewarm_once` call then returns its report, or waits for the prewarm in progress.
+    """
+    if os.environ.get('PREWARM', 'true').lower() == 'true' and not os.environ.get('CHAT_API_URL'):
+        # run as a script this module is `__main__`; app.py imports `startup`, a separate module with its
+        # own lock and report, so the thread must use that one for the app to find the prewarm in progress
+        import startup
+        threading.Thread(target=startup.prewarm_once, name='prewarm', daemon=True).start()
+
+    from streamlit.web import cli as streamlit_cli
+    sys.argv = ['streamlit', 'run', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')]
+    sys.argv += streamlit_args
+    return streamlit_cli.main()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profile', action='store_true', help='print the import time profile')
+    parser.add_argument('--module', default='service', help='module to profile')
+    parser.add_argument('--prewarm', action='store_true', help='run the prewarm steps and print their timings')
+    parser.add_argument('--ui', action='store_true',
+                        help='serve app.py with Streamlit, prewarming at startup; other arguments go to Streamlit')
+    args, streamlit_args = parser.parse_known_args(argv)
+    if args.ui:
+        return serve_ui(streamlit_args)
+    if streamlit_args:
+        parser.error('unrecognized arguments: ' + ' '.join(streamlit_args))
+
+    report: Dict[str, Any] = {}
+    if args.profile or not args.prewarm:
+        report['imports'] = import_profile(args.module)
+    if args.prewarm:
+        report['prewarm'] = prewarm()
+    print(json.dumps(report, indent=2))
+    return 1 if report.get('prewarm', {}).get('errors') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
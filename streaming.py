@@ -0,0 +1,45 @@
+import time
+from typing import Any, Callable, Optional
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+
+class TokenStreamHandler(BaseCallbackHandler):
+    """
+    LangChain callback that forwards each generated token to `on_token`
+    together with the text accumulated so far, and records time-to-first-token.
+    """
+
+    def __init__(self, on_token: Callable[[str, str], None]):
+        self.on_token = on_token
+        self.text = ""
+        self.start_time = time.perf_counter()
+        self.first_token_time: Optional[float] = None
+
+    def on_llm_start(self, serialized: Any, prompts: Any, **kwargs: Any) -> None:
+        self.start_time = time.perf_counter()
+
+    def on_chat_model_start(self, serialized: Any, messages: Any, **kwargs: Any) -> None:
+        self.start_time = time.perf_counter()
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        self.text += token
+        self.on_token(token, self.text)
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        if self.first_token_time is None:
+            return None
+        return self.first_token_time - self.start_time
+
+
+def streamlit_placeholder_writer(placeholder) -> Callable[[str, str], None]:
+    """
+    Returns an `on_token` callback that repaints a Streamlit placeholder with the partial answer.
+    """
+    def write(token: str, text: str) -> None:
+        placeholder.markdown(text + "▌")
+
+    return write
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# the service modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import use_offline_encoding  # noqa: E402
+
+# prompt and result budgets count tokens; don't download the BPE ranks in tests
+use_offline_encoding()
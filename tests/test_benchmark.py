@@ -0,0 +1,22 @@
+import json
+import os
+
+import pytest
+
+import benchmark
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench_questions.jsonl')
+
+
+@pytest.mark.parametrize('mode', [[], ['--async'], ['--streaming']])
+def test_benchmark_runs_within_latency_budget(tmp_path, mode):
+    output = tmp_path / 'report.json'
+    status = benchmark.main(['--corpus', CORPUS, '--sessions', '2', '--turns', '3', '--llm-latency', '0.01',
+                             '--tokens-per-second', '1000', '--max-p95', '10', '--output', str(output)] + mode)
+
+    report = json.loads(output.read_text())
+    assert status == 0
+    assert report['turns'] == 6
+    # at most one Cypher generation and one answer per turn
+    assert report['llm_calls'].get('cypher', 0) <= report['turns']
+    assert report['llm_calls'].get('answer', 0) <= report['turns']
@@ -0,0 +1,53 @@
+import threading
+import time
+
+from chain_cache import ChainCache
+
+
+def test_concurrent_misses_build_each_key_once():
+    cache = ChainCache('test', max_size=4)
+    builds = []
+
+    def factory():
+        builds.append(1)
+        time.sleep(0.05)
+        return object()
+
+    values = []
+    threads = [threading.Thread(target=lambda: values.append(cache.get_or_create('a', factory))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(builds) == 1
+    assert len({id(value) for value in values}) == 1
+    assert cache.stats()['misses'] == 1 and cache.stats()['hits'] == 7
+
+
+def test_slow_build_does_not_block_other_keys():
+    cache = ChainCache('test', max_size=4)
+    release = threading.Event()
+    slow = threading.Thread(target=lambda: cache.get_or_create('slow', lambda: release.wait(5) and 'slow'))
+    slow.start()
+    try:
+        lookup_start = time.perf_counter()
+        assert cache.get_or_create('fast', lambda: 'fast') == 'fast'
+        assert time.perf_counter() - lookup_start < 1.0
+    finally:
+        release.set()
+        slow.join()
+    assert cache.get_or_create('slow', lambda: 'rebuilt') == 'slow'
+
+
+def test_failed_build_is_not_cached():
+    cache = ChainCache('test', max_size=4)
+
+    def broken():
+        raise RuntimeError('no credentials')
+
+    try:
+        cache.get_or_create('a', broken)
+    except RuntimeError:
+        pass
+    assert cache.get_or_create('a', lambda: 'built') == 'built'
@@ -0,0 +1,56 @@
+import pytest
+
+import api_server
+from conversation_store import ConversationStore, InMemoryConversationStore
+from fakes import FakeChatModel, FakeDriver, FakeEmbeddings, FakeGraph
+from service import NeoLangService
+
+
+def test_conversation_store_is_abstract():
+    with pytest.raises(TypeError):
+        ConversationStore()
+
+
+def test_in_memory_store_evicts_least_recently_used():
+    store = InMemoryConversationStore(max_size=2)
+    store.save('a', {'state': {}})
+    store.save('b', {'state': {}})
+    store.load('a')
+    store.save('c', {'state': {}})
+
+    assert store.load('b') is None
+    assert store.load('a') == {'state': {}}
+
+
+def test_api_requests_share_one_service_per_llm_type(monkeypatch):
+    built = []
+
+    class Service(NeoLangService):
+        def __init__(self, llm_type, temperature, state=None):
+            built.append((llm_type, temperature))
+            self.llm_type, self.temperature, self.state = llm_type, temperature, state
+
+    monkeypatch.setattr(api_server, 'SERVICE_CLASS', Service)
+    monkeypatch.setattr(api_server, '_services', {})
+    first = {'llm_type': "GPT-4 8k", 'temperature': 0.7, 'state': {'session_id': 'a'}}
+    second = {'llm_type': "GPT-4 8k", 'temperature': 0.7, 'state': {'session_id': 'b'}}
+
+    a, b = api_server.get_service(first), api_server.get_service(second)
+
+    assert built == [("GPT-4 8k", 0.7)]
+    assert a.state is first['state'] and b.state is second['state']
+
+
+def test_api_turns_save_only_the_state_needed_to_resume(monkeypatch):
+    store = InMemoryConversationStore()
+    driver = FakeDriver(rows=5, query_latency=0.0, write_latency=0.0)
+    service = NeoLangService("GPT-4 8k", 0.7, state={}, driver=driver, graph=FakeGraph(driver, schema_latency=0.0),
+                             llm_factory=lambda llm_type, streaming: FakeChatModel(latency=0.0, streaming=streaming),
+                             embeddings=FakeEmbeddings(latency=0.0))
+    monkeypatch.setattr(api_server, 'get_conversation_store', lambda: store)
+    monkeypatch.setattr(api_server, '_services', {("GPT-4 8k", 0.7): service})
+
+    conversation_id = api_server.create_conversation({'llm_type': "GPT-4 8k", 'temperature': 0.7})['conversation_id']
+    api_server.run_turn(conversation_id, {'question': "Which builds contain component DL5580?"})
+
+    assert set(store.load(conversation_id)['state']) == {'session_id', 'latest_message_id', 'latest_llm_message_id'}
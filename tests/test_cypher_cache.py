@@ -0,0 +1,24 @@
+from cypher_cache import CypherTemplateCache, parameterize_cypher
+
+
+def test_only_property_values_become_parameters():
+    template, parameters = parameterize_cypher('MATCH (c:Config {id: 10}) RETURN c LIMIT 5', ['10'])
+
+    assert template == 'MATCH (c:Config {id: $p0}) RETURN c LIMIT 5'
+    assert parameters == {0: int}
+
+
+def test_repeated_numbers_and_hop_bounds_stay_fixed():
+    cypher = 'MATCH (c:Config {id: 10}) RETURN c LIMIT 10'
+    assert parameterize_cypher(cypher, ['10']) == (cypher, {})
+
+    cypher = 'MATCH (e:Engine)-[*1..3]-(b) RETURN b'
+    assert parameterize_cypher(cypher, ['3']) == (cypher, {})
+
+
+def test_fixed_literals_must_match_on_lookup():
+    cache = CypherTemplateCache()
+    cache.store('Configurations with ID 10', 'MATCH (c:Config {id: 10}) RETURN c LIMIT 10')
+
+    assert cache.lookup('Configurations with ID 456') is None
+    assert cache.lookup('Configurations with ID 10') == ('MATCH (c:Config {id: 10}) RETURN c LIMIT 10', {})
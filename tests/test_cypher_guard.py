@@ -0,0 +1,123 @@
+import pytest
+
+from cypher_guard import (CYPHER_DEFAULT_LIMIT, CYPHER_MAX_HOPS, check_cypher, normalize_cypher, plan_problems,
+                          rewrite_cypher, schema_problems, summarize_plan)
+from fakes import FakeDriver
+
+SCHEMA = {
+    'node_props': {
+        'Engine': [{'property': 'serialNumber', 'type': 'STRING'}],
+        'Configuration': [{'property': 'id', 'type': 'STRING'}, {'property': 'url', 'type': 'STRING'}],
+    },
+    'rel_props': {},
+    'relationships': [{'start': 'Engine', 'type': 'HAS_CONFIGURATION', 'end': 'Configuration'}],
+}
+
+
+def test_known_schema_passes():
+    cypher = ("MATCH (e:Engine {serialNumber: 'X1'})-[:HAS_CONFIGURATION]->(c:Configuration) "
+              "RETURN c.id LIMIT 5")
+    assert schema_problems(cypher, SCHEMA) == []
+
+
+def test_unknown_label_type_and_property_are_reported():
+    problems = schema_problems("MATCH (e:Engine)-[:HAS_CONFIG]->(c:Config) WHERE e.serial = 'X1' RETURN c", SCHEMA)
+    assert ('schema', 'unknown label :Config') in problems
+    assert ('schema', 'unknown relationship type :HAS_CONFIG') in problems
+    assert ('schema', 'unknown property e.serial') in problems
+
+
+@pytest.mark.parametrize('cypher', [
+    "MATCH (c:Configuration) SET c.id = 'x'",
+    "MATCH (c:Configuration) DETACH DELETE c",
+    "MERGE (e:Engine {serialNumber: 'X1'})",
+    "MATCH (c:Configuration) REMOVE c:Configuration",
+    "CREATE (e:Engine)",
+])
+def test_write_clauses_are_rejected(cypher):
+    assert any(kind == 'write' for kind, _ in schema_problems(cypher, SCHEMA))
+
+
+@pytest.mark.parametrize('cypher', [
+    "MATCH (c:Configuration) RETURN c.id AS set",
+    "MATCH (c:Configuration) WHERE c.id = 'CREATE (x)' RETURN c.id AS delete",
+    "MATCH (c:Configuration) RETURN {set: c.id, merge: c.url} AS m",
+])
+def test_write_words_outside_clause_positions_are_allowed(cypher):
+    assert not any(kind == 'write' for kind, _ in schema_problems(cypher, SCHEMA))
+
+
+def test_double_slash_inside_a_string_is_not_a_comment():
+    cypher = "MATCH (c:Configuration) WHERE c.url = 'http://example.com/x' RETURN c.id"
+    rewritten, rewrites = rewrite_cypher(cypher)
+    assert rewritten == cypher + "\nLIMIT " + str(CYPHER_DEFAULT_LIMIT)
+    assert rewrites == ['limit']
+    assert schema_problems(cypher, SCHEMA) == []
+    assert normalize_cypher(cypher) == "MATCH (c:Configuration) WHERE c.url = ? RETURN c.id"
+
+
+def test_comments_are_dropped_and_existing_limits_kept():
+    cypher = "MATCH (c:Configuration) // don't scan\nRETURN c.id LIMIT 10;"
+    assert rewrite_cypher(cypher) == (cypher, [])
+    assert normalize_cypher(cypher) == "MATCH (c:Configuration) RETURN c.id LIMIT ?"
+
+
+@pytest.mark.parametrize('cypher', [
+    "MATCH (c:Configuration) RETURN c.id LIMIT 10 + 5",
+    "MATCH (c:Configuration) RETURN c.id LIMIT toInteger($n)",
+    "MATCH (c:Configuration) RETURN c.id\nLIMIT $n // at most n\n",
+])
+def test_limit_expressions_are_not_limited_twice(cypher):
+    assert rewrite_cypher(cypher) == (cypher, [])
+
+
+@pytest.mark.parametrize('cypher', [
+    "CALL { MATCH (c:Configuration) RETURN c LIMIT 5 } RETURN c.id",
+    "MATCH (c:Configuration) RETURN c.limit",
+    "MATCH (c:Configuration) WHERE c.url = 'x LIMIT 5' RETURN c.id",
+])
+def test_limits_that_do_not_end_the_statement_get_one_appended(cypher):
+    assert rewrite_cypher(cypher) == (cypher + "\nLIMIT " + str(CYPHER_DEFAULT_LIMIT), ['limit'])
+
+
+@pytest.mark.parametrize('pattern, capped', [
+    ("*", "*1.." + str(CYPHER_MAX_HOPS)),
+    ("*2..", "*2.." + str(CYPHER_MAX_HOPS)),
+    ("*..50", "*1.." + str(CYPHER_MAX_HOPS)),
+    ("*8..", "*8.." + str(max(8, CYPHER_MAX_HOPS))),
+    ("*..3", "*..3"),
+    ("*3", "*3"),
+])
+def test_variable_length_patterns_are_capped(pattern, capped):
+    rewritten, _ = rewrite_cypher("MATCH (e:Engine)-[" + pattern + "]->(c) RETURN c LIMIT 5")
+    assert rewritten == "MATCH (e:Engine)-[" + capped + "]->(c) RETURN c LIMIT 5"
+
+
+def test_plan_problems():
+    plan = {'operatorType': 'ProduceResults@neo4j', 'args': {'EstimatedRows': 50000.0}, 'children': [
+        {'operatorType': 'CartesianProduct@neo4j', 'args': {'EstimatedRows': 50000.0}, 'children': [
+            {'operatorType': 'AllNodesScan@neo4j', 'args': {'EstimatedRows': 50000.0}},
+            {'operatorType': 'NodeIndexSeek@neo4j', 'args': {'EstimatedRows': 1.0}},
+        ]},
+    ]}
+    kinds = {kind for kind, _ in plan_problems(summarize_plan(plan))}
+    assert kinds == {'scan', 'cartesian', 'limit'}
+
+    anchored = {'operatorType': 'ProduceResults@neo4j', 'args': {'EstimatedRows': 10.0}, 'children': [
+        {'operatorType': 'Limit@neo4j', 'args': {'EstimatedRows': 10.0}, 'children': [
+            {'operatorType': 'NodeIndexSeek@neo4j', 'args': {'EstimatedRows': 10.0}},
+        ]},
+    ]}
+    assert plan_problems(summarize_plan(anchored)) == []
+
+
+def test_plans_are_cached_by_normalized_statement():
+    driver = FakeDriver(rows=5, query_latency=0.0)
+    key = ('test_plans_are_cached_by_normalized_statement',)
+
+    first = check_cypher("MATCH (c:Configuration) WHERE c.id = 'A1' RETURN c.id", driver, None, SCHEMA, key)
+    second = check_cypher("MATCH (c:Configuration) WHERE c.id = 'B2' RETURN c.id", driver, None, SCHEMA, key)
+
+    assert first.ok and second.ok
+    assert second.cypher.endswith("LIMIT " + str(CYPHER_DEFAULT_LIMIT))
+    assert driver.explains == 1
@@ -0,0 +1,10 @@
+from entity_index import EntityMatch, bind_entities
+
+
+def test_bound_literals_match_regardless_of_case():
+    matches = [EntityMatch('esn123', 'ESN123', 'Engine', 'serialNumber', '4:abc:1')]
+
+    cypher, parameters = bind_entities("MATCH (e:Engine {serialNumber: 'Esn123'}) RETURN e LIMIT 5", matches)
+
+    assert cypher == "MATCH (e:Engine {serialNumber: $e0}) RETURN e LIMIT 5"
+    assert parameters == {'e0': 'ESN123'}
@@ -0,0 +1,42 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from llm_router import ProviderBusy, ProviderLimiter
+
+
+def test_async_waiter_is_woken_by_a_release_on_another_thread():
+    limiter = ProviderLimiter('test', 1)
+    limiter.acquire()
+    threading.Timer(0.05, limiter.release).start()
+
+    async def wait_for_slot():
+        wait_timer_start = time.perf_counter()
+        await limiter.acquire_async(timeout=5)
+        return time.perf_counter() - wait_timer_start
+
+    assert asyncio.run(wait_for_slot()) < 1
+    assert limiter.in_flight == 1
+
+
+def test_async_waiters_time_out_and_cancelled_waiters_leave_the_queue():
+    limiter = ProviderLimiter('test', 1)
+    limiter.acquire()
+
+    async def scenario():
+        with pytest.raises(ProviderBusy):
+            await limiter.acquire_async(timeout=0.05)
+
+        cancelled = asyncio.ensure_future(limiter.acquire_async(timeout=5))
+        waiting = asyncio.ensure_future(limiter.acquire_async(timeout=5))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await asyncio.sleep(0.01)
+        limiter.release()
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(scenario())
+    assert limiter.rejected == 1
+    assert limiter.in_flight == 1
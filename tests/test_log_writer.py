@@ -0,0 +1,54 @@
+import threading
+import time
+
+from fakes import FakeDriver
+from log_writer import BatchLogWriter
+
+QUERY = "UNWIND $params AS row CREATE (:Message {id: row.id})"
+
+
+class FailingDriver(FakeDriver):
+    """
+    Raises a non-Neo4j error on the first `failures` sessions.
+    """
+
+    def __init__(self, failures: int):
+        super().__init__(write_latency=0.0)
+        self.failures = failures
+
+    def session(self, database=None, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise TypeError("Values of type <class 'object'> are not supported")
+        return super().session(database, **kwargs)
+
+
+def test_unexpected_errors_count_as_failed_and_keep_the_worker_alive():
+    writer = BatchLogWriter(FailingDriver(failures=1), None, flush_interval=0.0)
+
+    writer.submit(QUERY, {'id': 1})
+    flushed = threading.Thread(target=writer.flush, daemon=True)
+    flushed.start()
+    flushed.join(timeout=5)
+    assert not flushed.is_alive()
+    assert writer.stats()['failed'] == 1
+
+    writer.submit(QUERY, {'id': 2})
+    writer.close()
+    assert writer.stats()['written'] == 1
+
+
+def test_rows_are_dropped_not_written_inline_when_the_queue_is_full():
+    writer = BatchLogWriter(FakeDriver(write_latency=0.2), None, max_queue_size=1, batch_size=1,
+                            flush_interval=0.0, put_timeout=0.01)
+
+    submit_timer_start = time.perf_counter()
+    for i in range(5):
+        writer.submit(QUERY, {'id': i})
+    # a row written on the calling thread would take the full write latency
+    assert time.perf_counter() - submit_timer_start < 0.2
+    writer.close()
+
+    stats = writer.stats()
+    assert stats['dropped'] > 0
+    assert stats['written'] + stats['dropped'] == 5
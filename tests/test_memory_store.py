@@ -0,0 +1,45 @@
+import time
+
+from fakes import FakeChatModel
+from memory import MemoryStore, RollingSummaryMemory
+
+
+class Snapshot:
+    def __init__(self, value):
+        self.value = value
+
+    def to_dict(self):
+        return {'value': self.value}
+
+
+def test_keeps_the_most_recently_saved_conversations():
+    store = MemoryStore(max_size=2, ttl=60)
+    store.save('a', Snapshot(1))
+    store.save('b', Snapshot(2))
+    store.save('a', Snapshot(3))
+    store.save('c', Snapshot(4))
+
+    assert store.load('b') is None
+    assert store.load('a') == {'value': 3}
+    assert store.load('c') == {'value': 4}
+
+
+def test_snapshots_expire_after_ttl():
+    store = MemoryStore(max_size=10, ttl=0.05)
+    store.save('a', Snapshot(1))
+    time.sleep(0.1)
+
+    assert store.load('a') is None
+    assert store.stats()['size'] == 0
+
+
+def test_memory_keeps_the_question_within_the_token_limit():
+    memory = RollingSummaryMemory(llm=FakeChatModel(latency=0.0), k=3, max_token_limit=200)
+    for i in range(3):
+        memory.save_context({'input': 'Schema: ' + 'x' * 1000, 'question': 'question ' + str(i)},
+                            {'response': 'answer ' + str(i) + ' ' + 'y' * 80})
+
+    history = memory.load_memory_variables({})['history']
+    assert 'Schema' not in history
+    assert 'question 2' in history
+    assert len(history.encode()) <= 200
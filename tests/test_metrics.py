@@ -0,0 +1,29 @@
+import json
+
+from metrics import MetricsRegistry
+
+
+def test_jsonl_events_are_buffered_until_flushed(tmp_path):
+    path = tmp_path / 'metrics.jsonl'
+    registry = MetricsRegistry(jsonl_path=str(path), jsonl_flush_interval=3600.0)
+
+    registry.observe('stage_seconds', 0.25, stage='cypher', session='s-1')
+    registry.increment('turns_total', stage='cypher')
+    assert not path.exists()
+
+    registry.flush_jsonl()
+    events = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(event['name'], event['value']) for event in events] == [('stage_seconds', 0.25), ('turns_total', 1)]
+    assert events[0]['labels'] == {'stage': 'cypher', 'session': 's-1'}
+    assert registry.jsonl_stats() == {'buffered': 0, 'written': 2, 'dropped': 0}
+
+
+def test_jsonl_buffer_is_bounded(tmp_path):
+    registry = MetricsRegistry(jsonl_path=str(tmp_path / 'metrics.jsonl'), jsonl_flush_interval=3600.0,
+                               jsonl_buffer_size=2)
+
+    for _ in range(5):
+        registry.increment('turns_total')
+
+    assert registry.jsonl_stats() == {'buffered': 2, 'written': 0, 'dropped': 3}
+    assert 'metrics_jsonl_dropped 3' in registry.render_prometheus()
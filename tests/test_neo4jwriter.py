@@ -0,0 +1,65 @@
+import pytest
+
+from fakes import FakeDriver, FakeSession, FakeTransaction
+from neo4jwriter import Neo4jWriter
+
+QUERY = "UNWIND $params AS row MERGE (n:Node {id: row.id})"
+
+
+class RetryingSession(FakeSession):
+    """
+    Runs every transaction function twice, as the driver does after a transient error.
+    """
+
+    def execute_write(self, transaction_function, *args, **kwargs):
+        transaction_function(FakeTransaction(self.driver), *args, **kwargs)
+        return transaction_function(FakeTransaction(self.driver), *args, **kwargs)
+
+
+class RetryingDriver(FakeDriver):
+    def session(self, database=None, **kwargs):
+        return RetryingSession(self)
+
+
+def test_bulk_write_streams_every_row_in_batches():
+    driver = FakeDriver(write_latency=0.0)
+    rows = ({'id': i} for i in range(2500))
+
+    report = Neo4jWriter(driver=driver).bulk_write(QUERY, rows, batch_size=1000, workers=2, adaptive=False)
+
+    assert report['rows'] == 2500
+    assert report['batches'] == 3
+    assert driver.rows_written == 2500
+
+
+def test_partial_batches_resize_the_next_batch():
+    driver = FakeDriver(write_latency=0.05)
+
+    report = Neo4jWriter(driver=driver).bulk_write(QUERY, ({'id': i} for i in range(300)), batch_size=1000,
+                                                   workers=1, target_batch_seconds=0.01)
+
+    assert report['batches'] == 1
+    assert report['final_batch_size'] < 1000
+
+
+def test_driver_retries_are_counted_not_repeated():
+    report = Neo4jWriter(driver=RetryingDriver(write_latency=0.0)).bulk_write(
+        QUERY, ({'id': i} for i in range(10)), batch_size=5, workers=1, adaptive=False)
+
+    assert report['batches'] == 2
+    assert report['retries'] == 2
+
+
+def test_read_csv_and_parquet_yield_rows(tmp_path):
+    pytest.importorskip('pyarrow')
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    csv_path = tmp_path / 'rows.csv'
+    csv_path.write_text('id,name\n1,a\n2,b\n')
+    parquet_path = tmp_path / 'rows.parquet'
+    pq.write_table(pa.table({'id': [1, 2], 'name': ['a', 'b']}), parquet_path)
+
+    expected = [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]
+    assert list(Neo4jWriter.read_csv(str(csv_path))) == expected
+    assert list(Neo4jWriter.read_parquet(str(parquet_path), batch_size=1)) == expected
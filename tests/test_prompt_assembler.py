@@ -0,0 +1,22 @@
+import pytest
+
+from prompt_assembler import PromptAssembler
+
+
+def test_history_cannot_crowd_out_the_results():
+    assembler = PromptAssembler(3000, answer_tokens=500, history_tokens=1000, min_result_tokens=400)
+
+    prompt, breakdown = assembler.assemble("Which builds?", "Node properties: " + "s" * 2000, [], "r" * 600,
+                                           history_tokens=5000)
+
+    assert breakdown['history'] <= 1000
+    assert breakdown['results'] >= 400
+    assert sum(breakdown[section] for section in ('fixed', 'schema', 'examples', 'results', 'documents',
+                                                  'history', 'answer_reserved')) <= 3000
+
+
+def test_question_beyond_the_window_is_rejected():
+    assembler = PromptAssembler(1000, answer_tokens=500)
+
+    with pytest.raises(ValueError):
+        assembler.assemble("q" * 800, "", [], "")
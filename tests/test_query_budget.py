@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+from neo4j.exceptions import Neo4jError
+
+from fakes import FakeAsyncDriver, FakeDriver
+from query_budget import QueryBudget, run_budgeted, run_budgeted_async
+
+QUERY = "MATCH (c:Configuration) RETURN c.id AS id"
+
+
+def timed_out():
+    return Neo4jError.hydrate(code='Neo.ClientError.Transaction.TransactionTimedOutClientConfiguration',
+                              message='The transaction has not completed within the timeout')
+
+
+class TimingOutDriver(FakeDriver):
+    """
+    Streams `rows` records, then fails the way the server does when the transaction timeout is reached.
+    """
+
+    def read_records(self):
+        yield from self.records()
+        raise timed_out()
+
+
+class TimingOutBeforeFirstRecordDriver(FakeDriver):
+    def records(self):
+        raise timed_out()
+
+
+def test_server_timeouts_truncate_by_time():
+    result = run_budgeted(TimingOutDriver(rows=3, query_latency=0.0), None, QUERY, {}, QueryBudget(max_rows=10))
+
+    assert result.truncated_by == 'time'
+    assert result.rows_scanned == 3
+
+
+def test_async_server_timeouts_truncate_by_time():
+    driver = FakeAsyncDriver(TimingOutBeforeFirstRecordDriver(query_latency=0.0))
+    result = asyncio.run(run_budgeted_async(driver, None, QUERY, {}, QueryBudget()))
+
+    assert result.truncated_by == 'time'
+    assert result.records == []
+
+
+def test_other_client_errors_are_raised():
+    class FailingDriver(FakeDriver):
+        def records(self):
+            raise Neo4jError.hydrate(code='Neo.ClientError.Statement.EntityNotFound', message='not found')
+
+    with pytest.raises(Neo4jError):
+        run_budgeted(FailingDriver(query_latency=0.0), None, QUERY, {}, QueryBudget())
@@ -0,0 +1,65 @@
+import pytest
+from neo4j.exceptions import ClientError, Neo4jError
+
+import retrieval
+from retrieval import DocumentRetriever, FallbackRetriever
+
+MISSING_INDEX = ('Neo.ClientError.Procedure.ProcedureCallFailed',
+                 'Failed to invoke procedure `db.index.vector.queryNodes`: Caused by: '
+                 'java.lang.IllegalArgumentException: There is no such vector schema index: document_embeddings')
+SYNTAX_ERROR = ('Neo.ClientError.Statement.SyntaxError', 'Invalid input')
+
+
+class Primary(DocumentRetriever):
+    def __init__(self):
+        super().__init__()
+        self.error = None
+        self.searches = 0
+
+    def search(self, embedding):
+        self.searches += 1
+        if self.error is not None:
+            code, message = self.error
+            raise Neo4jError.hydrate(code=code, message=message)
+        return [{'index': 'vector', 'text': None, 'score': 1.0}]
+
+
+@pytest.fixture
+def retriever(monkeypatch):
+    def load(self, driver, database):
+        self.add([{'index': 'local', 'text': None, 'embedding': [1.0, 0.0]}])
+
+    monkeypatch.setattr(retrieval.LocalVectorRetriever, 'load', load)
+    retriever = FallbackRetriever(driver=None, database=None, retry_after=60.0)
+    retriever.primary = Primary()
+    return retriever
+
+
+def test_document_retriever_is_abstract():
+    with pytest.raises(TypeError):
+        DocumentRetriever()
+
+
+def test_missing_index_switches_to_local_search_until_the_retry(retriever, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retrieval.time, 'monotonic', lambda: now[0])
+    retriever.primary.error = MISSING_INDEX
+
+    assert retriever.search([1.0, 0.0])[0]['index'] == 'local'
+    assert retriever.search([1.0, 0.0])[0]['index'] == 'local'
+    assert retriever.primary.searches == 1
+
+    retriever.primary.error = None
+    now[0] += 61.0
+    assert retriever.search([1.0, 0.0])[0]['index'] == 'vector'
+    assert retriever.search([1.0, 0.0])[0]['index'] == 'vector'
+    assert retriever.primary.searches == 3
+
+
+def test_other_query_errors_are_raised(retriever):
+    retriever.primary.error = SYNTAX_ERROR
+
+    with pytest.raises(ClientError):
+        retriever.search([1.0, 0.0])
+    retriever.primary.error = None
+    assert retriever.search([1.0, 0.0])[0]['index'] == 'vector'
@@ -0,0 +1,180 @@
+import pytest
+
+from async_service import SyncNeoLangService
+from cypher_cache import cypher_cache
+from fakes import FakeAsyncDriver, FakeChatModel, FakeDriver, FakeEmbeddings, FakeGraph
+from semantic_cache import semantic_cache
+from service import NeoLangService
+
+LLM_TYPE = "GPT-4 8k"
+
+
+class Backend:
+    def __init__(self):
+        self.driver = FakeDriver(rows=5, query_latency=0.0, write_latency=0.0)
+        self.graph = FakeGraph(self.driver, schema_latency=0.0)
+        self.embeddings = FakeEmbeddings(latency=0.0)
+        self.models = []
+        self.factory = self.llm_factory
+
+    def llm_factory(self, llm_type, streaming):
+        model = FakeChatModel(latency=0.0, tokens_per_second=10000.0, answer_tokens=5, streaming=streaming)
+        self.models.append(model)
+        return model
+
+    def calls(self, kind):
+        return sum(model.calls.get(kind, 0) for model in self.models)
+
+    def service(self, service_class=NeoLangService, **kwargs):
+        return service_class(LLM_TYPE, 0.7, state={'session_id': 'test-' + str(id(self))}, driver=self.driver,
+                             graph=self.graph, llm_factory=self.factory, embeddings=self.embeddings, **kwargs)
+
+
+@pytest.fixture
+def backend():
+    # the answer and Cypher caches are process-wide
+    semantic_cache.clear()
+    cypher_cache.clear()
+    return Backend()
+
+
+def test_new_conversation_calls_each_llm_stage_once(backend):
+    service = backend.service()
+    conversation = service.create_conversation(LLM_TYPE)
+
+    turn = service.run_turn("Which configurations does engine QX4411 have?", conversation, new_conversation=True)
+
+    assert backend.calls('cypher') == 1
+    assert backend.calls('answer') == 1
+    assert turn.answer
+    assert turn.cache_hit is None
+    assert {'cypher_generation', 'graph_query', 'answer_synthesis', 'logging'} <= set(turn.timings)
+    assert 'latest_llm_message_id' in service.state
+
+
+def test_follow_up_turn_calls_each_llm_stage_once(backend):
+    service = backend.service()
+    conversation = service.create_conversation(LLM_TYPE)
+
+    service.run_turn("List the software components of build RT2207", conversation, new_conversation=True)
+    service.run_turn("Which ECM codes belong to configuration KZ0913?", conversation, new_conversation=False)
+
+    assert backend.calls('cypher') == 2
+    assert backend.calls('answer') == 2
+
+
+def test_streamed_turn_calls_the_answer_llm_once(backend):
+    service = backend.service()
+    conversation = service.create_conversation(LLM_TYPE, streaming=True)
+    tokens = []
+
+    turn = service.run_turn("Which build ships component DL5580?", conversation, new_conversation=True,
+                            on_token=lambda token, text: tokens.append(token))
+
+    assert backend.calls('cypher') == 1
+    assert backend.calls('answer') == 1
+    assert ''.join(tokens) == turn.answer
+
+
+def test_cypher_template_hit_skips_cypher_generation(backend):
+    service = backend.service()
+    conversation = service.create_conversation(LLM_TYPE)
+
+    service.run_turn("What is the description of configuration WB1207?", conversation, new_conversation=True)
+    turn = service.run_turn("What is the description of configuration WB3391?", conversation, new_conversation=False)
+
+    assert backend.calls('cypher') == 1
+    assert backend.calls('answer') == 2
+    assert "WB3391" in turn.cypher_params.values() or "WB3391" in turn.cypher
+
+
+def test_failing_cypher_template_falls_back_to_generation(backend):
+    service = backend.service()
+    conversation = service.create_conversation(LLM_TYPE)
+    service.run_turn("What is the description of configuration WB1207?", conversation, new_conversation=True)
+
+    query_graph = service.query_graph
+    failures = []
+
+    def fail_once(*args, **kwargs):
+        if not failures:
+            failures.append(args)
+            raise ValueError('Generated Cypher Statement is not valid')
+        return query_graph(*args, **kwargs)
+
+    service.query_graph = fail_once
+    turn = service.run_turn("What is the description of configuration WB3391?", conversation, new_conversation=False)
+
+    assert failures
+    assert turn.answer
+    assert turn.cache_hit is None
+    assert backend.calls('cypher') == 2
+
+
+def test_answer_cache_hit_makes_no_llm_calls(backend):
+    service = backend.service()
+    question = "Which engines use configuration HV7720?"
+
+    first = service.run_turn(question, service.create_conversation(LLM_TYPE), new_conversation=True)
+    second = service.run_turn(question, service.create_conversation(LLM_TYPE), new_conversation=True)
+
+    assert second.cache_hit == 'answer'
+    assert second.answer == first.answer
+    assert backend.calls('cypher') == 1
+    assert backend.calls('answer') == 1
+
+
+def test_follow_up_turns_reuse_only_the_cached_cypher(backend):
+    service = backend.service()
+    question = "Which engines use configuration HV7720?"
+    service.run_turn(question, service.create_conversation(LLM_TYPE), new_conversation=True)
+
+    conversation = service.create_conversation(LLM_TYPE)
+    service.run_turn("List the software components of build RT2207", conversation, new_conversation=True)
+    follow_up = service.run_turn(question, conversation, new_conversation=False)
+
+    # the cached answer was synthesized without this conversation's history
+    assert follow_up.cache_hit == 'cypher'
+    assert backend.calls('answer') == 3
+    # a turn served from the cache isn't stored again
+    assert semantic_cache.stats()['size'] == 2
+
+
+def test_async_turn_calls_each_llm_stage_once_and_keeps_state(backend):
+    service = backend.service(SyncNeoLangService, async_driver=FakeAsyncDriver(backend.driver))
+    conversation = service.create_conversation(LLM_TYPE)
+
+    service.run_turn("Which configurations does engine MM6631 have?", conversation, new_conversation=True)
+
+    assert backend.calls('cypher') == 1
+    assert backend.calls('answer') == 1
+    # logging ids written by the turn are copied back into the caller's state
+    assert 'latest_llm_message_id' in service.state
+
+
+def test_failed_async_turn_logs_nothing(backend):
+    service = backend.service(SyncNeoLangService, async_driver=FakeAsyncDriver(backend.driver))
+    conversation = service.create_conversation(LLM_TYPE)
+
+    async def failing_query(*args, **kwargs):
+        raise RuntimeError('graph unavailable')
+
+    service.service.aquery_graph = failing_query
+    with pytest.raises(RuntimeError):
+        service.run_turn("Which configurations does engine MM6631 have?", conversation, new_conversation=True)
+
+    # like run_turn, the user message is only logged once the turn has an answer
+    assert 'latest_message_id' not in service.state
+
+
+def test_services_with_different_llm_factories_get_their_own_chain(backend):
+    other = Backend()
+    other.driver, other.graph = backend.driver, backend.graph
+    service, other_service = backend.service(), other.service()
+
+    service.generate_cypher("Which configurations does engine QX4411 have?", use_cache=False)
+    other_service.generate_cypher("Which configurations does engine QX4411 have?", use_cache=False)
+
+    assert service._get_qa_chain() is not other_service._get_qa_chain()
+    assert backend.calls('cypher') == 1
+    assert other.calls('cypher') == 1
@@ -0,0 +1,32 @@
+import numpy as np
+
+from semantic_cache import SemanticCache
+
+
+def unit(i, dim=8):
+    vector = np.zeros(dim)
+    vector[i] = 1.0
+    return vector
+
+
+def test_eviction_and_invalidation_keep_lookups_aligned():
+    cache = SemanticCache(threshold=0.99, max_size=3, ttl=3600)
+    for i in range(5):
+        cache.store(unit(i), question='q' + str(i), cypher='c' + str(i))
+
+    assert cache.stats()['size'] == 3
+    assert cache.lookup(unit(0)) is None
+    assert cache.lookup(unit(4))['cypher'] == 'c4'
+
+    cache.invalidate(unit(2))
+    assert cache.lookup(unit(2)) is None
+    assert cache.lookup(unit(3))['cypher'] == 'c3'
+    assert cache.lookup(unit(4))['cypher'] == 'c4'
+
+
+def test_the_matrix_grows_past_its_initial_capacity():
+    cache = SemanticCache(threshold=0.99, max_size=100, ttl=3600)
+    for i in range(40):
+        cache.store(unit(i, dim=64), question='q' + str(i), cypher='c' + str(i))
+
+    assert all(cache.lookup(unit(i, dim=64))['cypher'] == 'c' + str(i) for i in range(40))